@@ -0,0 +1,407 @@
+#! /usr/bin/python3
+
+"""Load generator and benchmark for the CLIc server.
+
+Starts a Clicserver on localhost with a throwaway self-signed certificate, connects
+simulated users to it and reports connections/sec, messages/sec and end-to-end
+latency. Examples:
+
+    ./clic-bench.py                              # every scenario, thread mode
+    ./clic-bench.py --mode async --scenario storm
+    ./clic-bench.py --workers 4 --users 5000 --client-processes 4 --json results.json
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clic-server.py")
+HOST = "127.0.0.1" #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> The benchmark never leaves localhost
+FORMAT = "utf-8" #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Text encoding, matching clic-server.py
+HEADER = 64 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> v1 header size, only used until HELLO is answered
+HELLO = "#!@!HELLO!@!#" #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Offers the server v2 framing
+V2_HEADER = struct.Struct("!BI") #>>>>>>>>>>>>>>>>>>>>> v2 header: 1 byte message type, 4 byte big-endian length
+MSG_CHAT = 1
+MSG_DM = 2
+MSG_DISCONNECT = 4
+MSG_KEEPALIVE = 5
+MSG_USERLIST = 6
+MARKER = b"]: bench " #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Chat and DM lines from simulated users carry their send time after this
+MAX_SAMPLES = 200000 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Latency samples kept per client process (a random sample past that)
+
+# Defaults for each scenario, any of which the command line can override.
+#   'users'    - simulated users connected at once
+#   'talkers'  - how many of them send messages
+#   'rate'     - messages per second from each talker
+#   'dm'       - fraction of messages sent as a /dm to a random user instead of chat
+#   'userlist' - fraction of messages replaced by a /u user list request
+SCENARIOS = {
+    "idle": {"users": 2000, "talkers": 10, "rate": 1.0, "dm": 0.0, "userlist": 0.0,
+             "about": "lots of quiet users, a few talking"},
+    "storm": {"users": 200, "talkers": 200, "rate": 2.0, "dm": 0.1, "userlist": 0.01,
+              "about": "everybody talking at once"},
+    "churn": {"users": 100, "talkers": 100, "rate": 0.0, "dm": 0.0, "userlist": 0.0,
+              "about": "users joining, chatting, sending a /dm and a /u, then leaving, over and over"},
+}
+
+
+def make_certificate(directory):
+    """Creates a throwaway self-signed certificate for localhost. Returns (certfile, keyfile)."""
+    certfile = os.path.join(directory, "bench_cert.pem")
+    keyfile = os.path.join(directory, "bench_key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def free_port():
+    """Returns a port nothing on localhost is listening on"""
+    with socket.socket() as probe:
+        probe.bind((HOST, 0))
+        return probe.getsockname()[1]
+
+
+def raise_file_limit():
+    """Lets this process (and the ones it starts) open as many sockets as the system allows"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def serve(args, certfile, keyfile, port, stop):
+    """Runs a Clicserver until 'stop' is set. Has its own process, so it never shares a GIL with the users."""
+    if not args.server_output: # The server prints a line per message, which the benchmark doesn't want to see
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    spec = importlib.util.spec_from_file_location("clic_server", SERVER_PATH) # The hyphen rules out a plain import
+    clic_server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(clic_server)
+    server = clic_server.Clicserver(mode=args.mode, slow_policy=args.slow_policy, workers=args.workers,
+                                    history_dir=None, offline_db=None, host=HOST, port=port, certfile=certfile, keyfile=keyfile)
+    server.start_server()
+    stop.wait()
+    try:
+        server.stop_server()
+    except (SystemExit, OSError):
+        pass
+
+
+def wait_for_server(port, timeout=30):
+    """Waits until the server accepts TCP connections"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((HOST, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"The server never started listening on port {port}")
+
+
+class Results:
+    """What one client process measured. Merged across processes for the report."""
+
+    def __init__(self):
+        self.connects = [] #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds from TCP connect to the welcome, per user
+        self.latency = [] #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds from send to receipt, broadcasts (sampled)
+        self.dm_latency = [] #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds from send to receipt, DMs (sampled)
+        self.seen = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Latency samples offered, for reservoir sampling
+        self.sent = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Messages sent by simulated users
+        self.received = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Frames received by simulated users
+        self.sessions = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Complete join-to-leave sessions (churn)
+        self.errors = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Users that failed to connect or were cut off
+        self.connect_time = 0.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds taken to connect every user
+        self.run_time = 0.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds spent sending
+
+    def sample(self, samples, value):
+        """Keeps a latency sample, or a fair random share of them once MAX_SAMPLES is reached"""
+        self.seen += 1
+        if len(samples) < MAX_SAMPLES:
+            samples.append(value)
+        else:
+            slot = random.randrange(self.seen)
+            if slot < MAX_SAMPLES:
+                samples[slot] = value
+
+    def merge(self, other):
+        for name in ("connects", "latency", "dm_latency"):
+            getattr(self, name).extend(getattr(other, name))
+        for name in ("sent", "received", "sessions", "errors"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.connect_time = max(self.connect_time, other.connect_time) # The processes ran side by side
+        self.run_time = max(self.run_time, other.run_time)
+
+
+class SimUser:
+    """One simulated user: a TLS connection speaking v2 framing, and a task reading everything sent to it"""
+
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+        self.reader = None
+        self.writer = None
+        self.reading = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Task running read_loop()
+        self.joined = 0.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Messages sent before this (history replays) aren't timed
+
+    async def connect(self, port, context):
+        """Connects, negotiates v2 framing and registers the username. Returns once welcomed."""
+        started = time.monotonic()
+        self.reader, self.writer = await asyncio.open_connection(HOST, port, ssl=context)
+        hello = f"{HELLO} 2".encode(FORMAT)
+        self.writer.write(str(len(hello)).encode(FORMAT).ljust(HEADER) + hello)
+        while True: # v1 frames until the server answers HELLO: the greeting, then the answer
+            length = int(await self.reader.readexactly(HEADER))
+            if (await self.reader.readexactly(length)).startswith(HELLO.encode(FORMAT)):
+                break
+        self.joined = time.monotonic()
+        self.send(MSG_CHAT, self.name)
+        while True:
+            kind, payload = await self.read_frame()
+            if b"Welcome" in payload:
+                break
+            if b"in use" in payload:
+                raise RuntimeError(f"Username {self.name} was taken")
+        self.results.connects.append(time.monotonic() - started)
+        self.reading = asyncio.ensure_future(self.read_loop())
+
+    async def read_frame(self):
+        kind, length = V2_HEADER.unpack(await self.reader.readexactly(V2_HEADER.size))
+        return kind, await self.reader.readexactly(length)
+
+    async def read_loop(self):
+        """Counts every frame and times every chat line and DM from another simulated user"""
+        results = self.results
+        try:
+            while True:
+                kind, payload = await self.read_frame()
+                results.received += 1
+                if kind == MSG_KEEPALIVE: # The server's heartbeat, which quiet users have to answer
+                    self.send(MSG_KEEPALIVE, "")
+                    continue
+                marker = payload.find(MARKER)
+                if marker < 0:
+                    continue
+                sent = float(payload[marker + len(MARKER):].split(None, 1)[0])
+                if sent >= self.joined: # Skips anything replayed from before this user arrived
+                    results.sample(results.dm_latency if kind == MSG_DM else results.latency, time.monotonic() - sent)
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError): # The server closed the connection
+            pass
+
+    def send(self, kind, text):
+        message = text.encode(FORMAT)
+        self.writer.write(V2_HEADER.pack(kind, len(message)) + message) # Pipelined, nothing waits for a reply
+
+    def chat(self):
+        self.send(MSG_CHAT, f"bench {time.monotonic():.6f}")
+        self.results.sent += 1
+
+    def dm(self, target):
+        self.send(MSG_DM, f"/dm {target} bench {time.monotonic():.6f}")
+        self.results.sent += 1
+
+    async def disconnect(self, timeout=5):
+        """Says goodbye and waits for the server to close the connection"""
+        try:
+            self.send(MSG_DISCONNECT, "")
+            await asyncio.wait_for(asyncio.shield(self.reading), timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.results.errors += 1
+        finally:
+            self.writer.close()
+
+
+async def connect_users(names, port, context, results, concurrency):
+    """Connects a user for each name, 'concurrency' handshakes at a time. Returns the ones that made it."""
+    gate = asyncio.Semaphore(concurrency)
+
+    async def connect(name):
+        async with gate:
+            user = SimUser(name, results)
+            try:
+                await user.connect(port, context)
+                return user
+            except (OSError, asyncio.IncompleteReadError, RuntimeError, ssl.SSLError):
+                results.errors += 1
+                return None
+
+    started = time.monotonic()
+    users = await asyncio.gather(*(connect(name) for name in names))
+    results.connect_time = time.monotonic() - started
+    return [user for user in users if user]
+
+
+async def talk(user, params, names, deadline):
+    """Sends messages from one user at params['rate'] per second, with jitter, until 'deadline'"""
+    interval = 1 / params["rate"]
+    await asyncio.sleep(random.uniform(0, interval)) # Spreads the talkers out
+    while time.monotonic() < deadline:
+        roll = random.random()
+        if roll < params["userlist"]:
+            user.send(MSG_USERLIST, "")
+        elif roll < params["userlist"] + params["dm"]:
+            user.dm(random.choice(names))
+        else:
+            user.chat()
+        await asyncio.sleep(random.expovariate(1 / interval))
+
+
+async def steady(params, names, port, context, results):
+    """The idle and storm scenarios: connect everyone, let the talkers talk, then everyone leaves"""
+    users = await connect_users(names, port, context, results, params["concurrency"])
+    await asyncio.sleep(1) # Lets the join announcements settle before timing anything
+    started = time.monotonic()
+    talkers = users[:params["talkers"]]
+    names = [user.name for user in users]
+    await asyncio.gather(*(talk(user, params, names, started + params["duration"]) for user in talkers))
+    await asyncio.sleep(1) # Lets the last messages arrive
+    results.run_time = time.monotonic() - started
+    await asyncio.gather(*(user.disconnect() for user in users))
+
+
+async def churn(params, names, port, context, results):
+    """The churn scenario: each user joins, chats, sends a /dm and a /u, leaves and comes back until time's up"""
+    deadline = time.monotonic() + params["duration"]
+
+    async def cycle(name):
+        visit = 0
+        while time.monotonic() < deadline:
+            visit += 1
+            user = SimUser(f"{name}v{visit}", results)
+            try:
+                await user.connect(port, context)
+            except (OSError, asyncio.IncompleteReadError, RuntimeError, ssl.SSLError):
+                results.errors += 1
+                continue
+            user.chat()
+            user.dm(random.choice(names) + "v1")
+            user.send(MSG_USERLIST, "")
+            await user.disconnect()
+            results.sessions += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(cycle(name) for name in names))
+    results.run_time = results.connect_time = time.monotonic() - started
+
+
+def load(params, port, certfile, process, results_queue):
+    """Runs one client process's share of the simulated users and reports what it measured"""
+    context = ssl.create_default_context(cafile=certfile)
+    context.check_hostname = False # The throwaway certificate is for 'localhost', the users connect to 127.0.0.1
+    share = range(process, params["users"], params["client_processes"])
+    names = [f"b{index}" for index in share]
+    params = dict(params, talkers=len(range(process, params["talkers"], params["client_processes"])))
+    results = Results()
+    run = churn if params["scenario"] == "churn" else steady
+    asyncio.run(run(params, names, port, context, results))
+    results_queue.put(results)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def report(params, results):
+    """Turns the merged results in to numbers, and prints them"""
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    summary = {
+        "scenario": params["scenario"], "mode": params["mode"], "workers": params["workers"],
+        "users": params["users"], "talkers": params["talkers"], "rate": params["rate"],
+        "connections": len(results.connects), "errors": results.errors,
+        "connections_per_sec": round(len(results.connects) / results.connect_time, 1) if results.connect_time else None,
+        "connect_p50_ms": ms(percentile(results.connects, 0.5)), "connect_p99_ms": ms(percentile(results.connects, 0.99)),
+        "messages_sent": results.sent, "frames_received": results.received,
+        "sent_per_sec": round(results.sent / results.run_time, 1) if results.run_time else None,
+        "received_per_sec": round(results.received / results.run_time, 1) if results.run_time else None,
+        "latency_p50_ms": ms(percentile(results.latency, 0.5)), "latency_p99_ms": ms(percentile(results.latency, 0.99)),
+        "latency_max_ms": ms(max(results.latency, default=None)),
+        "dm_latency_p50_ms": ms(percentile(results.dm_latency, 0.5)),
+        "dm_latency_p99_ms": ms(percentile(results.dm_latency, 0.99)),
+    }
+    if params["scenario"] == "churn":
+        summary["sessions"] = results.sessions
+        summary["sessions_per_sec"] = round(results.sessions / results.run_time, 1) if results.run_time else None
+    print(f"\n[{params['scenario'].upper()}] {SCENARIOS[params['scenario']]['about']} "
+          f"({params['mode']} mode, {params['workers']} worker{'s' if params['workers'] > 1 else ''})")
+    for key, value in summary.items():
+        if value is not None and key not in ("scenario", "mode", "workers"):
+            print(f"{key:<20} {value}")
+    return summary
+
+
+def run_scenario(args, scenario, certfile, keyfile):
+    """Starts a fresh server, runs one scenario against it, then stops it. Returns the summary."""
+    params = dict(SCENARIOS[scenario], scenario=scenario, mode=args.mode, workers=args.workers,
+                  duration=args.duration, concurrency=args.concurrency, client_processes=args.client_processes)
+    for name in ("users", "talkers", "rate", "dm", "userlist"):
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    params["talkers"] = min(params["talkers"], params["users"])
+    fork = multiprocessing.get_context("fork")
+    port = free_port()
+    stop = fork.Event()
+    server = fork.Process(name="clic-server", target=serve, args=(args, certfile, keyfile, port, stop))
+    server.start()
+    try:
+        wait_for_server(port)
+        results_queue = fork.Queue()
+        clients = [fork.Process(name=f"users {process}", target=load, args=(params, port, certfile, process, results_queue))
+                   for process in range(args.client_processes)]
+        for client in clients:
+            client.start()
+        results = Results()
+        for client in clients:
+            results.merge(results_queue.get())
+        for client in clients:
+            client.join()
+    finally:
+        stop.set()
+        server.join(timeout=15)
+        if server.is_alive():
+            server.terminate()
+    return report(params, results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CLIc server with simulated users on localhost")
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all", help="which load to generate")
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread", help="server connection engine")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes (sharded mode above 1)")
+    parser.add_argument("--slow-policy", choices=["drop_oldest", "coalesce", "disconnect"], default="drop_oldest",
+                        help="server slow consumer policy")
+    parser.add_argument("--users", type=int, help="simulated users (overrides the scenario)")
+    parser.add_argument("--talkers", type=int, help="users sending messages (overrides the scenario)")
+    parser.add_argument("--rate", type=float, help="messages per second per talker (overrides the scenario)")
+    parser.add_argument("--dm", type=float, help="fraction of messages sent as a /dm (overrides the scenario)")
+    parser.add_argument("--userlist", type=float, help="fraction of messages replaced by /u (overrides the scenario)")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of talking (or churning) per scenario")
+    parser.add_argument("--concurrency", type=int, default=100, help="handshakes in flight at once per client process")
+    parser.add_argument("--client-processes", type=int, default=1, help="processes to spread the simulated users over")
+    parser.add_argument("--server-output", action="store_true", help="show what the server prints")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE as JSON")
+    args = parser.parse_args()
+    raise_file_limit()
+    scenarios = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    with tempfile.TemporaryDirectory(prefix="clic-bench-") as directory:
+        certfile, keyfile = make_certificate(directory)
+        summaries = [run_scenario(args, scenario, certfile, keyfile) for scenario in scenarios]
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(summaries, output, indent=2)
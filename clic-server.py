@@ -1,38 +1,186 @@
 #! /usr/bin/python3
 
+import os
 import socket
 import ssl
 import threading
+import asyncio
+import argparse
 import select
-import traceback
 import re
+import struct
+import itertools
+import heapq
+import zlib
+import sys
+import queue
+import logging
+import logging.handlers
+import json
+import mmap
+import stat
+import multiprocessing
+import sqlite3
+from multiprocessing.connection import Listener, Client, wait
+from collections import deque
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from sys import exit
-from time import time
+from time import time, sleep, perf_counter, strftime, localtime
 
 class Clicserver:
     """The base class for a Clic (Command line chat) server"""
 
-    def __init__(self):              
+    def __init__(self, mode="thread", slow_policy="drop_oldest", workers=1, history_dir="history", stats_socket=None,
+                 host=None, port=33333, certfile="acme_chain.pem", keyfile="acme_key.pem", heartbeat=30, idle_timeout=None,
+                 msg_rate=None, byte_rate=None, rate_disconnect=None, compression=True,
+                 log_level="info", log_file=None, log_max_bytes=10485760, log_backups=5, user_timeout=30,
+                 backlog=1024, nodelay=True, send_buffer=None, recv_buffer=None, tcp_keepalive=None,
+                 tcp_keepalive_interval=10, tcp_keepalive_probes=3, max_connections=None, accept_batch=64,
+                 offline_db="offline.db"):
         """Init class for Clic server. """
+        # 'mode' selects the connection engine: "thread" spawns a thread per client,
+        # "async" multiplexes every client on a single asyncio event loop.
+        # 'slow_policy' is what happens when a client's outbound queue overflows:
+        # "drop_oldest", "coalesce" or "disconnect". See Outbox.
+        # 'workers' above 1 runs that many server processes sharing the port. See ShardHub.
+        # 'history_dir' is where the message history log is kept, None keeps history in memory only.
+        # 'stats_socket' is a Unix socket path that hands out the server stats as JSON, None for no socket.
+        # 'host' and 'port' are where to listen, the host's own IP if 'host' isn't given.
+        # 'certfile' and 'keyfile' are the TLS certificate chain and private key.
+        # 'heartbeat' is how many quiet seconds pass before a user is sent a KEEPALIVE they must answer, 0 for never.
+        # 'idle_timeout' disconnects users who haven't sent anything but KEEPALIVEs for that many seconds, None for never.
+        # 'msg_rate' and 'byte_rate' cap what each user can send per second, None for no cap. See RateLimiter.
+        # 'rate_disconnect' disconnects a user who hits those caps that many times in a minute, None for never.
+        # 'compression' offers clients framing v3, which deflates large messages. See compressed_frame().
+        # 'log_level', 'log_file', 'log_max_bytes' and 'log_backups' set up the server log. See ServerLog.
+        # 'user_timeout' is how many seconds a new connection gets to pick a username.
+        # The rest are the socket profile, see tune_socket() and admit(): the listen() 'backlog', whether
+        # 'nodelay' turns Nagle's algorithm off, the kernel 'send_buffer' and 'recv_buffer' sizes in bytes
+        # (None leaves the OS default), TCP keepalive probes after 'tcp_keepalive' idle seconds (None for
+        # off), 'max_connections' open at once (None for no cap) and how many connections 'accept_batch'
+        # takes off the listening socket each time it wakes up.
         self.HEADER = 64 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Size in bytes of header used to communicate message size
         self.hname = socket.gethostname() #>>>>>>>>>>>>>>>>> Returns the hostname of the host chat server is running on
-        self.server_ip = socket.gethostbyname(self.hname) #> Returns server host IP via DNS. Comment, then uncomment below if used.
+        self.server_ip = host or socket.gethostbyname(self.hname) #> Returns server host IP via DNS unless one was given. Comment, then uncomment below if used.
         # self.server_ip = "10.13.69.71" #>>>>>>>>>>>>>>>>>>>>>> Manually set server IP. Uncomment line above if using.
-        self.server_port = 33333 #>>>>>>>>>>>>>>>>>>>>>>>>>>> Port the server will run on (integer, not string)
+        self.server_port = port #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Port the server will run on (integer, not string)
         self.server_tuple = (self.server_ip, self.server_port) #> Tuple holding socket info
         self.FORMAT = "utf-8" #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> self.FORMAT text will be transmitted in
         self.DISCONNECT_MESSAGE = "#!@!DISCONNECT!@!#" #>>>> Message the client will send to disconnect
-        self.USER_TIMEOUT = 30 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Time to wait for blocking sockets (especially when waiting for username)
+        self.USER_TIMEOUT = user_timeout #>>>>>>>>>>>>>>>>>> Time to wait for blocking sockets (especially when waiting for username)
         self.KEEPALIVE = "#!@!KEEPALIVE!@!#" #>>>>>>>>>>>>>> Message sent to client to confirm socket is up
         self.GIVECLIENTS = "#!@!GIVECLIENT!@!#" #>>>>>>>>>>> Message triggers server to send client list
+        self.HELLO = "#!@!HELLO!@!#" #>>>>>>>>>>>>>>>>>>>>>> Sent by a client during the username handshake to offer newer framing
+        self.PROTO_VERSION = 3 if compression else 2 #>>>>>> Newest framing version the server speaks. v3 is v2 plus compression.
+        self.V2_HEADER = struct.Struct("!BI") #>>>>>>>>>>>>> v2 header: 1 byte message type, 4 byte big-endian length
+        # v2 message types. v1 clients get the same meaning from the magic strings above.
+        self.MSG_CHAT = 1 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Chat line (also the username during the handshake)
+        self.MSG_DM = 2 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Direct message
+        self.MSG_SERVER = 3 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Notice from the server
+        self.MSG_DISCONNECT = 4 #>>>>>>>>>>>>>>>>>>>>>>>>>>> Disconnect request from a client, or disconnect notice to one
+        self.MSG_KEEPALIVE = 5 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Confirms the connection is up
+        self.MSG_USERLIST = 6 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> User list request from a client, or the list sent back
+        self.MSG_HELLO = 7 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Framing negotiation
+        self.MSG_CHANNEL = 8 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Channel command from a client (/join, /leave or /channels)
+        self.MSG_PRESENCE = 9 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Presence subscription from a client ("on" or "off"), or an update to one. See Presence.
+        self.CHANNEL_COMMANDS = ("/join", "/leave", "/channels", "/history") # v1 clients send these as plain text
+        self.CHANNEL_NAME = re.compile(r"#?([\w-]{1,32})") #> Channel names are letters, numbers, - and _, with an optional #
+        self.LOBBY = "lobby" #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Channel every user is put in when they arrive
+        self.MAX_MESSAGE = 1048576 #>>>>>>>>>>>>>>>>>>>>>>>> Largest message accepted from a client, in bytes
+        self.COMPRESSED = 0x80 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> v3 flag on the type byte: the payload is deflated with COMPRESS_DICT
+        self.COMPRESS_MIN = 256 #>>>>>>>>>>>>>>>>>>>>>>>>>>> Messages this size or smaller always go out uncompressed, in bytes
+        self.COMPRESS_LEVEL = 6 #>>>>>>>>>>>>>>>>>>>>>>>>>>> zlib compression level, 1 (fastest) to 9 (smallest)
+        self.COMPRESS_DICT = ( # Preset deflate dictionary of things chat is full of. Must match client.py.
+            b"Traceback (most recent call last):\n  File \"\", line , in \n    def __init__(self, return None import from "
+            b"https://www.github.com/ http://localhost .com/ .org/ .py .txt error Error: exception warning failed "
+            b"because about after again already also always any anyone anything around back before being could "
+            b"didn't does doesn't don't even every first from going good got great have here how into it's just "
+            b"know let's like look make maybe more much need never new now only other people please pretty really "
+            b"right said see should since some something still sure than thanks that's their them then there these "
+            b"they thing think this those though time today too try want was way well were what when where which "
+            b"while who why will with work would yeah yes you you're your lol haha ok okay hey hi hello "
+            b"[CHANNEL] You joined #. Your messages go there now.\n[HISTORY] The last  messages in #Current users are:"
+            b"\n[SERVER] \n[DISCONNECT] User \" has been disconnected by the server has disconnected.\n"
+            b"[NEW CONNECTION]  has joined the chat\n\n[*DM*] [#lobby  the  and  to  of  a  in  is  that  for  it  I  "
+            b"you  on  be  with  not  but  so  do  if  can  what  this  are  was  have  just  ]: "
+        )
+        self.RECV_BUFFER = 4096 #>>>>>>>>>>>>>>>>>>>>>>>>>>> Starting size of each connection's receive buffer (grows as needed)
         self.shutdown_flag = threading.Event() #>>>>>>>>>>>> Flag indicating a server shutdown has been triggered
         self.kicked_user_flag = threading.Event() #>>>>>>>>> Flag indicating a user was kicked off
         self.kicked_by = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Holds the name of the thread that closed the user's connection
-        self.user_vanished = threading.Event() #>>>>>>>>>>>> Flag set by user_heartbeat() to indicate dropped connection
-        self.user_list = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Dictionary containing list of active users
+        self.user_vanished = threading.Event() #>>>>>>>>>>>> Flag set by check_heartbeat() when it drops an unresponsive user
+        self.HEARTBEAT_INTERVAL = heartbeat #>>>>>>>>>>>>>>>> Quiet seconds before a user is sent a KEEPALIVE, 0 turns heartbeats off
+        self.HEARTBEAT_TIMEOUT = 30 #>>>>>>>>>>>>>>>>>>>>>>> Seconds a user gets to answer a KEEPALIVE before being disconnected
+        self.IDLE_TIMEOUT = idle_timeout #>>>>>>>>>>>>>>>>>> Seconds without a real message before a user is disconnected, None for never
+        self.heartbeats = TimerWheel() #>>>>>>>>>>>>>>>>>>>> One heartbeat timer per registered user, see TimerWheel
+        self.RATE_BURST = 3 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds' worth of msg_rate and byte_rate a user can send in one go
+        self.RATE_DISCONNECT = rate_disconnect #>>>>>>>>>>>> Times a user can hit the rate limits in RATE_WINDOW before being disconnected
+        self.RATE_WINDOW = 60 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds without hitting the limits that wipes a user's slate clean
+        self.rate_limits = RateLimiter(msg_rate, byte_rate, self.RATE_BURST) # Token buckets for every connection and username
+        self.user_list = UserRegistry() #>>>>>>>>>>>>>>>>>>> Thread-safe list of active users, see UserRegistry
+        self.channels = ChannelIndex() #>>>>>>>>>>>>>>>>>>>> Which users are in which channels, see ChannelIndex
+        self.presence = Presence(self) #>>>>>>>>>>>>>>>>>>>> Users subscribed to join and leave updates, see Presence
+        self.USERLIST_PAGE = 1000 #>>>>>>>>>>>>>>>>>>>>>>>>> Usernames per page when a user asks for a page of the user list, e.g. '/u 2'
+        self.mode = mode #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Connection engine, "thread" or "async"
+        self.loop = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> asyncio event loop (async mode only)
+        self.loop_thread = None #>>>>>>>>>>>>>>>>>>>>>>>>>>> Ident of the thread running the event loop
+        self.async_clients = set() #>>>>>>>>>>>>>>>>>>>>>>>> Open connections on the event loop (async mode only)
+        self.thread_clients = set() #>>>>>>>>>>>>>>>>>>>>>>> Open connections with their own threads (thread mode only)
+        self.OUTBOX_FRAMES = 256 #>>>>>>>>>>>>>>>>>>>>>>>>>> Most messages queued for one client before slow_policy applies
+        self.OUTBOX_BYTES = 1048576 #>>>>>>>>>>>>>>>>>>>>>>> Most bytes queued for one client before slow_policy applies
+        self.CLOSE_TIMEOUT = 5 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds a closing connection gets to send what's queued before it's aborted
+        self.SLOW_POLICY = slow_policy #>>>>>>>>>>>>>>>>>>>> What to do with a client whose outbound queue overflows
+        self.outbox_counts = {"dropped": 0, "coalesced": 0, "disconnected": 0} # Slow consumer policy counters
+        self.outbox_lock = threading.Lock() #>>>>>>>>>>>>>>> Guards outbox_counts
+        self.HANDSHAKE_WORKERS = 8 #>>>>>>>>>>>>>>>>>>>>>>>> Threads doing TLS handshakes off the accept loop (thread mode)
+        self.HANDSHAKE_BACKLOG = 256 #>>>>>>>>>>>>>>>>>>>>>> Most handshakes waiting for a worker before new connections are refused
+        self.HANDSHAKE_TIMEOUT = 10 #>>>>>>>>>>>>>>>>>>>>>>> Seconds a client gets to finish its TLS handshake
+        self.BACKLOG = backlog #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Connections the kernel holds waiting for accept() (capped by net.core.somaxconn)
+        self.TCP_NODELAY = nodelay #>>>>>>>>>>>>>>>>>>>>>>>> Turns off Nagle's algorithm, frames are already written whole
+        self.SEND_BUFFER = send_buffer #>>>>>>>>>>>>>>>>>>>> SO_SNDBUF for each connection in bytes, None for the OS default
+        self.RECV_BUFFER_SIZE = recv_buffer #>>>>>>>>>>>>>>> SO_RCVBUF for each connection in bytes, None for the OS default
+        self.TCP_KEEPALIVE = tcp_keepalive #>>>>>>>>>>>>>>>> Idle seconds before the kernel probes a connection, None for no probes
+        self.TCP_KEEPALIVE_INTERVAL = tcp_keepalive_interval # Seconds between keepalive probes
+        self.TCP_KEEPALIVE_PROBES = tcp_keepalive_probes #>> Unanswered keepalive probes before the kernel drops the connection
+        self.MAX_CONNECTIONS = max_connections #>>>>>>>>>>>> Most connections open at once, handshakes included. None for no cap.
+        self.ACCEPT_BATCH = accept_batch #>>>>>>>>>>>>>>>>>> Most connections accepted each time the listening socket wakes up
+        self.ACCEPT_BACKOFF = 1 #>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds accepting stops for when accept() fails, e.g. out of file descriptors
+        self.open_connections = 0 #>>>>>>>>>>>>>>>>>>>>>>>>> Connections accepted and not yet closed
+        self.connections_lock = threading.Lock() #>>>>>>>>>> Guards open_connections
+        self.SESSION_TICKETS = 2 #>>>>>>>>>>>>>>>>>>>>>>>>>> TLS 1.3 session tickets issued per handshake, for resumption
+        self.handshake_pool = None #>>>>>>>>>>>>>>>>>>>>>>>> ThreadPoolExecutor doing the handshakes (thread mode only)
+        self.handshake_slots = threading.BoundedSemaphore(self.HANDSHAKE_BACKLOG) # Limits queued handshakes
+        self.tls_stats = {"started": 0, "completed": 0, "resumed": 0, "failed": 0, "rejected": 0,
+                          "total_time": 0.0, "max_time": 0.0} # Handshake counters and latency (seconds)
+        self.tls_lock = threading.Lock() #>>>>>>>>>>>>>>>>>> Guards tls_stats
+        self.WORKERS = workers #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Worker processes sharing the port (1 serves everyone from this process)
+        self.BUS_TIMEOUT = 5 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds a worker waits for the hub to answer a username claim
+        self.worker_id = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Which worker this process is (sharded mode workers only)
+        self.hub = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> ShardHub relaying between the workers (sharded mode supervisor only)
+        self.bus = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> ShardBus linking a worker to the hub (sharded mode workers only)
+        self.processes = [] #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Worker processes (sharded mode supervisor only)
+        self.HISTORY_FRAMES = 100 #>>>>>>>>>>>>>>>>>>>>>>>>> Messages per channel kept in memory and replayed to users as they join
+        self.HISTORY_AGE = 86400 #>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds before a message is too old to replay, or keep on disk
+        self.HISTORY_REPLAY = 1000 #>>>>>>>>>>>>>>>>>>>>>>>> Most messages '/history' will fetch from the log
+        self.HISTORY_DIR = history_dir #>>>>>>>>>>>>>>>>>>>> Directory for the message history log, None for no log
+        self.HISTORY_SEGMENT_BYTES = 4194304 #>>>>>>>>>>>>>> Size at which the log moves on to a new segment file
+        self.HISTORY_LOG_BYTES = 67108864 #>>>>>>>>>>>>>>>>> Most bytes of log segments kept, per process
+        self.OFFLINE_DB = offline_db #>>>>>>>>>>>>>>>>>>>>>> SQLite file for DMs to offline users, None to refuse them as before
+        self.OFFLINE_DM_LIMIT = 100 #>>>>>>>>>>>>>>>>>>>>>>> Most DMs kept waiting for one offline user
+        self.OFFLINE_DM_AGE = 604800 #>>>>>>>>>>>>>>>>>>>>>> Seconds an offline DM is kept before it's thrown away
+        self.offline = OfflineDMs(self) if offline_db else None # DMs waiting for their recipients, see OfflineDMs
+        self.stats = ServerStats() #>>>>>>>>>>>>>>>>>>>>>>>> Counters and latency histograms, see ServerStats
+        self.STATS_SOCKET = stats_socket #>>>>>>>>>>>>>>>>>> Unix socket path for scraping the stats as JSON
+        self.log = ServerLog(self.stats, log_level, log_file, log_max_bytes, log_backups) # Queued log writer, see ServerLog
+        self.history = MessageHistory(self) # Recent channel messages, see MessageHistory. After the stats, as reloading counts compression.
         
-        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH) # Context wrapper to apply TLS over sockets
-        self.context.load_cert_chain(certfile='acme_chain.pem', keyfile="acme_key.pem")
+        # PROTOCOL_TLS_SERVER, as the context create_default_context() gives on Python 3.8 can't set num_tickets
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER) # Context wrapper to apply TLS over sockets
+        self.context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+        self.context.options &= ~ssl.OP_NO_TICKET # Session tickets let reconnecting clients skip the full handshake
+        self.context.num_tickets = self.SESSION_TICKETS
         
         # self.context.load_default_certs(ssl.Purpose.CLIENT_AUTH)
         #!*!*!*!*!* WARNING: INSECURE! For testing/dev only! *!*!*!*!*!
@@ -47,16 +195,65 @@ class Clicserver:
         #
         # 'server_handler_func' is the function for the server handler.
         # Should always be server_handler unless you're making pretty heavy changes.
-        print("\n[SERVER IS STARTING]")
+        if self.WORKERS > 1 and self.worker_id is None: # This process only supervises, the workers serve clients
+            return self.start_shards()
+        self.log.start(self.worker_id)
+        self.log.info("[SERVER IS STARTING]")
+        if self.history.log:
+            self.history.log.start()
+        if self.offline:
+            self.offline.start()
         self.server_socket = (socket.socket(socket.AF_INET, socket.SOCK_STREAM)) # Creates the server socket
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # A restart doesn't wait out TIME_WAIT
+        self.tune_socket(self.server_socket) # Buffer sizes have to be set before listen() to size the TCP window
+        if self.worker_id is not None: # Every worker listens on the same port and the kernel spreads connections between them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind(self.server_tuple) # Binds the server socket to the given IP and port
-        server = threading.Thread(target=self.server_handler, daemon=True)
+        if self.mode == "async": # The event loop gets the thread instead of the accept loop
+            server = threading.Thread(target=self.async_server_handler, daemon=True)
+        else:
+            self.handshake_pool = ThreadPoolExecutor(max_workers=self.HANDSHAKE_WORKERS, thread_name_prefix="handshake")
+            server = threading.Thread(target=self.server_handler, daemon=True)
+            if self.HEARTBEAT_INTERVAL: # The event loop ticks the wheel itself in async mode
+                heartbeat = threading.Thread(name="heartbeat", target=self.heartbeat_handler, daemon=True)
+                heartbeat.start()
         server.start()
+        if self.STATS_SOCKET:
+            stats = threading.Thread(name="stats", target=self.stats_handler, daemon=True)
+            stats.start()
+
+    def start_shards(self):
+        """Starts the worker processes and the hub that ties them in to one chat (sharded mode)"""
+        # Workers are forked before any thread starts, so each gets a clean copy of the server, TLS
+        # context included. Sharing the context means sharing its session ticket keys, so a client can
+        # resume its TLS session on whichever worker the kernel hands its next connection to.
+        self.hub = ShardHub(self)
+        fork = multiprocessing.get_context("fork")
+        for worker_id in range(self.WORKERS):
+            worker = fork.Process(name=f"worker {worker_id}", target=self.shard_worker, args=(worker_id,), daemon=True)
+            worker.start()
+            self.processes.append(worker)
+        self.log.start() # Only now, as the workers can't inherit the writer thread
+        self.log.info("[SERVER IS STARTING]")
+        self.hub.accept(self.WORKERS) # Waits for every worker to connect to the bus
+        self.log.info(f"[SHARDED] {self.WORKERS} worker processes are sharing {self.server_tuple}")
+        hub = threading.Thread(name="hub", target=self.hub.run, daemon=True)
+        hub.start()
+
+    def shard_worker(self, worker_id):
+        """Runs in each worker process. Serves its share of the clients until the hub says to stop."""
+        self.worker_id = worker_id
+        self.bus = ShardBus(self, Client(self.hub.address, family="AF_UNIX", authkey=self.hub.authkey))
+        self.hub = None # The hub lives in the supervisor
+        self.start_server()
+        self.bus.run() # Returns once the supervisor shuts down or goes away
+        self.stop_server()
 
     def server_handler(self):
         """Main function running the server."""
-        self.server_socket.listen() # Listens on the server socket
-        print(f"\n[LISTENING] Server is listening on {self.server_tuple}")
+        self.server_socket.listen(self.BACKLOG) # Listens on the server socket
+        self.server_socket.setblocking(False) # So accept() can take every waiting connection and stop when there are none
+        self.log.info(f"[LISTENING] Server is listening on {self.server_tuple}")
         client_poll = select.poll() # Polling object is created to check if a client tries to connect.
                                     # Note: polling does not work on Windows. Supposedly it works with 
                                     # sockets only, but I've never managed that. Either run the server 
@@ -68,169 +265,837 @@ class Clicserver:
             client_accept = client_poll.poll() # This is where the polling object checks the sock
             if self.shutdown_flag.is_set(): # Another shutdown check. There are many places are an unclean shutdown
                 return False                # could cause errors.
-            if client_accept: # If the polling object detects a connection attempt this allows it and spawns its own thread
+            if client_accept: # If the polling object detects connection attempts this allows them and hands each to
+                for conn, addr in self.accept_batch(): # a handshake worker, so a slow handshake never holds up accept
+                    accepted = perf_counter()
+                    if not self.handshake_slots.acquire(blocking=False): # Every worker is busy and the queue is full
+                        self.count_handshake("rejected")
+                        self.reject(conn)
+                        self.release_connection()
+                        continue
+                    self.handshake_pool.submit(self.tls_handshake, conn, addr, accepted)
+
+    def accept_batch(self):
+        """Yields (socket, address) for up to ACCEPT_BATCH waiting connections, taking only those admit() lets in"""
+        # The listening socket is non-blocking, so this stops as soon as nobody else is waiting
+        for _ in range(self.ACCEPT_BATCH):
+            try:
                 conn, addr = self.server_socket.accept()
-                tlsconn = self.context.wrap_socket(conn, server_side=True)
-                clients = threading.Thread(name=conn, target = self.client_handler, args = (tlsconn, addr))
-                clients.start()
-                print(f"\n[ACTIVE CONNECTIONS] {threading.activeCount() - 2}")
+            except (BlockingIOError, InterruptedError, ConnectionAbortedError): # None left, or one gave up waiting
+                return
+            except OSError as err: # Out of file descriptors, most likely. Backs off rather than spin on it.
+                self.log.error(f"[ERROR] Can't accept connections: {err}")
+                self.pause_accepting()
+                return
+            self.stats.count("accepted")
+            if self.admit(conn):
+                yield conn, addr
+
+    def pause_accepting(self):
+        """Stops accepting for ACCEPT_BACKOFF seconds. A listener that's out of file descriptors stays readable."""
+        if self.mode == "async": # Sleeping would stall every client, so the loop stops watching the socket instead
+            self.loop.remove_reader(self.server_socket)
+            self.loop.call_later(self.ACCEPT_BACKOFF, self.resume_accepting)
+        else: # The accept thread has nothing else to do
+            sleep(self.ACCEPT_BACKOFF)
+
+    def resume_accepting(self):
+        """Watches the listening socket again after pause_accepting() (async mode)"""
+        if not self.shutdown_flag.is_set(): # async_shutdown() has closed it
+            self.loop.add_reader(self.server_socket, self.async_accept)
+
+    def admit(self, conn):
+        """Counts a newly accepted connection and tunes its socket. Turns it away if MAX_CONNECTIONS are open."""
+        # Rejecting happens before the TLS handshake, so a server at its cap spends next to nothing on
+        # the connections it can't take. Every admitted connection must be given back with release_connection().
+        with self.connections_lock:
+            full = self.MAX_CONNECTIONS is not None and self.open_connections >= self.MAX_CONNECTIONS
+            if not full:
+                self.open_connections += 1
+        if full:
+            self.stats.count("rejected_full")
+            self.reject(conn)
+            return False
+        self.tune_socket(conn)
+        return True
+
+    def reject(self, conn):
+        """Closes a connection that was just accepted, with a reset so it leaves nothing behind in TIME_WAIT"""
+        try:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        except OSError:
+            pass
+        conn.close()
+
+    def release_connection(self):
+        """Gives back the place an admitted connection took up once it has closed"""
+        with self.connections_lock:
+            self.open_connections -= 1
+
+    def tune_socket(self, sock):
+        """Applies the socket profile to the listening socket or to a connection"""
+        if self.SEND_BUFFER:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SEND_BUFFER)
+        if self.RECV_BUFFER_SIZE:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECV_BUFFER_SIZE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.TCP_NODELAY else 0)
+        if self.TCP_KEEPALIVE:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"): # Linux. Elsewhere the OS's own keepalive timings apply.
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.TCP_KEEPALIVE)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.TCP_KEEPALIVE_INTERVAL)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.TCP_KEEPALIVE_PROBES)
+
+    def tls_handshake(self, conn, addr, accepted):
+        """Runs in a handshake worker. Wraps a new connection in TLS, then spawns its client thread."""
+        # 'conn' is the plain TCP socket for the connecting client
+        # 'addr' is the socket tuple for the connecting client.
+        # 'accepted' is when accept() returned it, to time how long it waited for a worker
+        tlsconn = None
+        try:
+            self.stats.timing("accept", perf_counter() - accepted)
+            self.count_handshake("started")
+            started = perf_counter()
+            conn.setblocking(False) # A client that stalls its handshake only ties up this worker, and not for long
+            tlsconn = self.context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+            self.finish_handshake(tlsconn, started + self.HANDSHAKE_TIMEOUT)
+            tlsconn.setblocking(True)
+            self.record_handshake(perf_counter() - started, tlsconn.session_reused)
+        except (OSError, ValueError) as err: # Timeouts, TLS errors and clients that hung up
+            self.count_handshake("failed")
+            self.log.warning(f"[TLS] Handshake with {addr} failed: {err}")
+            conn.close()
+            if tlsconn is not None: # wrap_socket() moved the socket in to it
+                tlsconn.close()
+            self.release_connection()
+            return False
+        finally:
+            self.handshake_slots.release()
+        client = ClientConnection(self, tlsconn, addr) # Starts the writer thread for the connection
+        clients = threading.Thread(name=conn, target = self.client_handler, args = (client, addr))
+        clients.start()
+        self.log.debug(f"[ACTIVE CONNECTIONS] {len(self.thread_clients)}")
+        return True
+
+    def finish_handshake(self, tlsconn, deadline):
+        """Runs the TLS handshake on a non-blocking socket, raising TimeoutError if it isn't done by 'deadline'"""
+        # A socket timeout would only limit each read, so a client dribbling out its handshake a byte
+        # at a time could keep a worker forever. This holds the whole handshake to one deadline.
+        poller = select.poll()
+        poller.register(tlsconn, select.POLLIN)
+        while True:
+            try:
+                tlsconn.do_handshake()
+                return
+            except ssl.SSLWantReadError:
+                poller.modify(tlsconn, select.POLLIN)
+            except ssl.SSLWantWriteError:
+                poller.modify(tlsconn, select.POLLOUT)
+            remaining = deadline - perf_counter()
+            if remaining <= 0 or not poller.poll(remaining * 1000):
+                raise TimeoutError("the handshake took too long")
+
+    def count_handshake(self, event):
+        """Counts a TLS handshake event ("started", "failed" or "rejected")"""
+        with self.tls_lock:
+            self.tls_stats[event] += 1
+
+    def record_handshake(self, elapsed, resumed):
+        """Records a finished TLS handshake, how long it took and whether the session was resumed"""
+        self.stats.timing("tls", elapsed)
+        with self.tls_lock:
+            stats = self.tls_stats
+            stats["completed"] += 1
+            stats["resumed"] += resumed
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+
+    def list_tls_stats(self):
+        """Prints TLS handshake latency and the session resumption hit rate"""
+        with self.tls_lock:
+            stats = dict(self.tls_stats)
+        completed = stats["completed"] or 1 # Avoids dividing by zero before the first handshake
+        print("TLS handshakes:")
+        print(f"started ......... {stats['started']}")
+        print(f"completed ....... {stats['completed']}")
+        print(f"failed .......... {stats['failed']}")
+        print(f"rejected ........ {stats['rejected']}")
+        print(f"resumed ......... {stats['resumed']} ({100 * stats['resumed'] / completed:.1f}% hit rate)")
+        print(f"average time .... {1000 * stats['total_time'] / completed:.2f} ms")
+        print(f"max time ........ {1000 * stats['max_time']:.2f} ms")
+        print(f"session cache ... {self.context.session_stats()}")
+        return True
+
+    def stats_handler(self):
+        """Hands the stats, as one line of JSON, to anything that connects to STATS_SOCKET"""
+        # e.g. 'socat - UNIX-CONNECT:stats.sock'. In sharded mode each worker has its own socket.
+        path = self.STATS_SOCKET if self.worker_id is None else f"{self.STATS_SOCKET}.worker{self.worker_id}"
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode): # Left behind by the last run
+            os.remove(path)
+        stats_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stats_socket.bind(path)
+        os.chmod(path, 0o600) # Only the user running the server can read it
+        stats_socket.listen()
+        while not self.shutdown_flag.is_set():
+            conn, addr = stats_socket.accept()
+            with conn:
+                try:
+                    conn.sendall(json.dumps(self.snapshot_stats()).encode(self.FORMAT) + b"\n")
+                except OSError: # The scraper hung up
+                    pass
+
+    def snapshot_stats(self):
+        """Returns every counter, histogram and connection's numbers as plain data"""
+        clients = []
+        for conn in list(self.async_clients if self.mode == "async" else self.thread_clients):
+            details = self.user_list.get(conn) or {}
+            clients.append({"addr": conn.addr, "username": details.get("username"),
+                            "bytes_in": conn.decoder.bytes_in, "frames_in": conn.decoder.frames_in,
+                            "bytes_out": conn.outbox.total_bytes, "frames_out": conn.outbox.total_frames,
+                            "queued_frames": len(conn.outbox), "queued_bytes": conn.outbox.size,
+                            "throttled": conn.throttled})
+        with self.outbox_lock:
+            outbox = dict(self.outbox_counts)
+        with self.tls_lock:
+            tls = dict(self.tls_stats)
+        return {"worker": self.worker_id, "time": time(), "mode": self.mode,
+                "connections": len(clients), "users": len(self.user_list), "heartbeat_timers": len(self.heartbeats),
+                "log_queued": self.log.queue.qsize(), "open_connections": self.open_connections,
+                "counters": self.stats.counters_snapshot(),
+                "latency": {stage: histogram.snapshot() for stage, histogram in self.stats.histograms.items()},
+                "outbox": outbox, "tls": tls, "clients": clients}
+
+    def list_stats(self, top=20):
+        """Prints the counters, stage latencies and the 'top' busiest connections"""
+        stats = self.snapshot_stats()
+        print(f"Server stats ({stats['connections']} connections, {stats['users']} users):")
+        for counter, count in stats["counters"].items():
+            print(f"{counter} ......... {count}")
+        print("\nLatency (count, average, p50, p99, max):")
+        for stage, histogram in self.stats.histograms.items():
+            print(f"{stage:<12} {histogram.count:>8}  {1000 * histogram.average():8.2f} ms  "
+                  f"{1000 * histogram.percentile(0.5):8.2f} ms  {1000 * histogram.percentile(0.99):8.2f} ms  "
+                  f"{1000 * histogram.max:8.2f} ms")
+        print("\nBusiest connections (in messages/bytes, out messages/bytes, queued, times rate limited):")
+        clients = sorted(stats["clients"], key=lambda client: (client["queued_bytes"], client["bytes_out"]), reverse=True)
+        for client in clients[:top]:
+            print(f"{client['username'] or '(no username)'} {client['addr']}  in {client['frames_in']}/{client['bytes_in']}  "
+                  f"out {client['frames_out']}/{client['bytes_out']}  queued {client['queued_frames']}/{client['queued_bytes']}  "
+                  f"throttled {client['throttled']}")
+        return True
+
+    def async_server_handler(self):
+        """Runs the asyncio event loop that serves every client connection in async mode."""
+        # One loop multiplexes all TLS connections, so an idle user costs a transport and a protocol
+        # object rather than a thread polling its socket every 100ms.
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop_thread = threading.get_ident()
+        self.server_socket.listen(self.BACKLOG) # Listens on the server socket
+        self.server_socket.setblocking(False)
+        self.loop.add_reader(self.server_socket, self.async_accept)
+        self.log.info(f"[LISTENING] Server is listening on {self.server_tuple} (async mode)")
+        if self.HEARTBEAT_INTERVAL:
+            self.loop.call_later(self.heartbeats.TICK, self.async_heartbeat)
+        self.loop.run_forever()
+
+    def async_accept(self):
+        """Called by the loop when the listening socket has connections waiting. Starts a handshake for each."""
+        for conn, addr in self.accept_batch():
+            self.loop.create_task(self.async_handshake(conn, addr, perf_counter()))
+
+    async def async_handshake(self, conn, addr, accepted):
+        """Runs the TLS handshake on the loop, then hands the connection to an AsyncClientProtocol"""
+        # 'accepted' is when accept() returned it, to time how long it waited for the loop
+        self.stats.timing("accept", perf_counter() - accepted)
+        try:
+            await self.loop.connect_accepted_socket(lambda: AsyncClientProtocol(self), conn, ssl=self.context,
+                                                    ssl_handshake_timeout=self.HANDSHAKE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as err: # Timeouts, TLS errors and clients that hung up
+            self.count_handshake("failed")
+            self.log.warning(f"[TLS] Handshake with {addr} failed: {err}")
+            conn.close()
+            self.release_connection()
+
+    def async_heartbeat(self):
+        """Ticks the heartbeat wheel on the event loop, then schedules the next tick (async mode)"""
+        self.heartbeat_tick()
+        self.loop.call_later(self.heartbeats.TICK, self.async_heartbeat)
+
+    def heartbeat_handler(self):
+        """Ticks the heartbeat wheel from its own thread until shutdown (thread mode)"""
+        while not self.shutdown_flag.wait(self.heartbeats.TICK):
+            self.heartbeat_tick()
+
+    def heartbeat_tick(self):
+        """Checks every user whose heartbeat timer has run out. Costs nothing for the users whose hasn't."""
+        now = time()
+        for conn in self.heartbeats.advance(now):
+            self.check_heartbeat(conn, now)
+
+    def check_heartbeat(self, conn, now):
+        """Sends a quiet user a KEEPALIVE, or disconnects them if the last one went unanswered"""
+        # Anything received counts as an answer, so a chatty user is never pinged at all: their
+        # timer just gets pushed back to a full interval after the last thing they sent. IDLE_TIMEOUT
+        # is checked here too, so an idle user can outstay it by up to a heartbeat round trip.
+        # 'now' is the time of the tick
+        if conn not in self.user_list: # Left since the timer fired
+            return
+        if conn.pinged is not None and conn.last_heard < conn.pinged:
+            if conn.paused_until > conn.pinged: # Reading was paused for the rate limits, so an answer could be sitting unread.
+                due = conn.paused_until + self.HEARTBEAT_TIMEOUT - now # They get the full timeout once reading resumes.
+                if due > 0:
+                    self.heartbeats.schedule(conn, due, now)
+                    return
+            self.log.warning(f"[HEARTBEAT] {conn} didn't answer a KEEPALIVE within {self.HEARTBEAT_TIMEOUT} seconds, disconnecting.")
+            self.stats.count("evicted_unresponsive")
+            self.user_vanished.set()
+            self.disconnect_user(conn)
+            conn.abort() # A dead peer would never let the disconnect notice drain
+            return
+        conn.pinged = None
+        if self.IDLE_TIMEOUT and now - conn.last_active >= self.IDLE_TIMEOUT:
+            self.log.info(f"[IDLE] {conn} has been idle for {self.IDLE_TIMEOUT} seconds, disconnecting.")
+            self.stats.count("evicted_idle")
+            self.disconnect_user(conn)
+            return
+        if conn.proto < 2: # v1 clients predate the heartbeat and never answer one, so only IDLE_TIMEOUT applies to them
+            if self.IDLE_TIMEOUT:
+                self.heartbeats.schedule(conn, self.IDLE_TIMEOUT - (now - conn.last_active), now)
+            return
+        quiet = now - conn.last_heard
+        if quiet < self.HEARTBEAT_INTERVAL: # Heard from recently, so checks again once they've been quiet a full interval
+            due = self.HEARTBEAT_INTERVAL - quiet
+            if self.IDLE_TIMEOUT:
+                due = min(due, self.IDLE_TIMEOUT - (now - conn.last_active))
+            self.heartbeats.schedule(conn, due, now)
+            return
+        conn.pinged = now
+        self.stats.count("heartbeats")
+        self.send_msg(self.KEEPALIVE, conn, self.MSG_KEEPALIVE)
+        self.heartbeats.schedule(conn, self.HEARTBEAT_TIMEOUT, now)
+
+    def in_loop_thread(self):
+        """Returns True if called from the thread running the asyncio event loop"""
+        return threading.get_ident() == self.loop_thread
 
     def client_handler(self, conn, addr):
         """Main client management function. It is spun off by server_handler in a separate thread for each client."""
         # 'conn' is the connection object for the connecting client
         # 'addr' is the socket tuple for the connecting client.
         try:
-            print(f"\n[NEW CONNECTION] {addr} connected.")
+            self.log.info(f"[NEW CONNECTION] {addr} connected.")
             if self.get_username(conn, addr) == True: # Calls the get_username() function. If a valid username is
                                                  # returned before timing out, client_handler proceeds.
                 connected = True
                 username = self.user_list[conn]['username']
-                new_user_notify = f"[NEW CONNECTION] {username} has joined the chat\n"
-                self.disseminate(conn, new_user_notify)
-                conn_check = select.poll() # A polling object is created to check if the connection to the client
-                                           # is still up. It's registered to the client connection and checks for
-                                           # errors.
-                conn_check.register(conn, select.POLLERR | select.POLLHUP | select.POLLNVAL)
-                msg_listen = select.poll() # A polling object to check for messages from the client.
-                msg_listen.register(conn, select.POLLIN) # Registered to client connection and checks for inbound messages
+                conn_check = select.poll() # A polling object is created to check the connection to the client for
+                                           # inbound messages and for errors.
+                conn_check.register(conn, select.POLLIN | select.POLLERR | select.POLLHUP | select.POLLNVAL)
                 while connected == True:
-                    conn_confirm = conn_check.poll(100) # This is where the connection check happens every 100ms
-                    if conn_confirm: # If the connection has an error, first we check if the user was kicked out.
-                        if self.kicked_user_flag.is_set():
+                    for kind, msg in self.decode_messages(conn.decoder): # Handles every complete message already
+                        connected = self.process_message(conn, username, kind, msg) # received, pipelined ones included
+                        if not connected:
                             return False
-                        print("\n[ABRUPT DISCONNECT] User \"{username}\" ({addr}) improperly disconnected.")
-                        self.disconnect_user(conn) # If the user wasn't kicked out, the server closes the connection as best it can.
-                        self.disconnect_user.clear()
-                        connected = False
-                        return False
-                    msg_ready = msg_listen.poll(100) # This is where the polling object checks for inbound messages every 100ms
+                        pause = self.throttle(conn)
+                        if pause is None: # Disconnected for flooding
+                            return False
+                        if pause: # Over the rate limits. Not reading leaves the rest in the socket, and TCP pushes back.
+                            if self.shutdown_flag.wait(pause) or conn not in self.user_list:
+                                return False
+                    conn_ready = conn_check.poll(100) # Wakes for a message or an error, or after 100ms to check for shutdown
                     if self.shutdown_flag.is_set(): # If a server shutdown was triggered this ends the function to avoid errors.
                         return False
-                    if msg_ready: # If a message is received checks to make sure the user hasn't been kicked.
-                        if self.kicked_user_flag.is_set():
+                    if conn_ready: # Before reading, checks to make sure the user hasn't been kicked.
+                        if conn not in self.user_list:
                             return False
-                        msg_length = conn.recv(self.HEADER).decode(self.FORMAT) # Receives the header that communicates the
-                        if msg_length == '':                                    # length of message server should expect.
-                            msg_length = 0
-                        msg_length = int(msg_length)
-                        msg = conn.recv(msg_length).decode(self.FORMAT)
-                        if msg == self.DISCONNECT_MESSAGE: # If the user has issued a nice disconnect request, this executes it.
-                            self.send_msg("\n[DISCONNECTED] See you again soon!\n\n", conn)
-                            conn.shutdown(2) # Removes the socket's read/write ability
-                            conn.close() # Closes the socket                
-                            print(f"\n[DISCONNECT] User \"{self.user_list[conn]}\" {addr} has disconnected.\n")
-                            self.disseminate(conn, f"[DISCONNECT] {username} has disconnected.\n")
-                            del self.user_list[conn] # Removes the connection from active user list
-                            connected = False
+                        # An empty read, or a socket the writer thread already closed, means the connection
+                        # dropped without a goodbye
+                        if conn_ready[0][1] & select.POLLNVAL or conn.fill() == 0:
+                            self.log.info(f"[ABRUPT DISCONNECT] User \"{username}\" ({addr}) improperly disconnected.")
+                            self.disconnect_user(conn) # If the user wasn't kicked out, the server closes the connection as best it can.
                             return False
-                        if msg == self.GIVECLIENTS: #If the user requests active user list, send it to them
-                            self.send_msg("Current users are:", conn)
-                            for user in self.user_list:
-                                self.send_msg(f"{self.user_list[user]['username']}", conn)
-                        if msg[0:3] == "/dm":
-                            self.send_dm(msg, conn)
-                            continue 
-                        if msg: # If a message is not a disconnect, prints it to the server log and relays to other users
-                            print(f"\n[NEW MESSAGE] {username}: {msg}")
-                            share_msg = f"\n[{username}]: {msg}"
-                            self.disseminate(conn, share_msg)
-                            continue
+                return False
             else:
-                print("\n[ABRUPT DISCONNECT] Could not complete connection.")
-                print(f"\n[ABRUPT DISCONNECT] Connection: {conn}")
-                conn.shutdown(2) # Removes the socket's read/write ability
-                conn.close() # Closes the socket
+                self.log.info(f"[ABRUPT DISCONNECT] Could not complete connection: {conn}")
+                conn.close()
                 return False
 
         except(ConnectionResetError):
-            print(f"\n[ERROR] CONNECTION RESET ERROR {addr}")
-            conn.shutdown(2) # Removes the socket's read/write ability
-            conn.close() # Closes the socket
+            self.log.warning(f"[ERROR] CONNECTION RESET ERROR {addr}")
+            conn.close()
             connected = False
             return False
 
+        except FrameError as err: # The client sent something that isn't a valid message
+            self.log.warning(f"[ERROR] {err} from {addr}, closing connection.")
+            if conn in self.user_list:
+                self.disconnect_user(conn)
+            else:
+                conn.close()
+            return False
+
         except Exception as err:
             if err.args[0] == 9:
-                print("\n[ERROR] Errno 9 BAD FILE DESCRIPTOR")
-                print("\n[ERROR] Connection already closed")
-                print(traceback.format_exc())
+                self.log.error("[ERROR] Errno 9 BAD FILE DESCRIPTOR, connection already closed", exc_info=True)
+                return False
+            else:
+                self.log.error(f"[ERROR] UNEXPECTED ERROR {err} (err.args[0] = {err.args[0]})", exc_info=True)
+                return False
+
+    def decode_messages(self, decoder):
+        """Yields (type, text) for every complete message waiting in a connection's FrameDecoder"""
+        for kind, payload in decoder.frames():
+            self.stats.count("messages_in")
+            if kind and kind & self.COMPRESSED:
+                if decoder.proto < 3:
+                    raise FrameError("Compressed message without having agreed to compression")
+                kind &= ~self.COMPRESSED
+                payload = self.inflate(payload)
+            msg = str(payload, self.FORMAT, "replace") # The only copy made of the received bytes
+            yield kind or self.classify(msg), msg
+
+    def classify(self, msg):
+        """Works out the message type of a v1 message from its magic strings"""
+        if msg == self.DISCONNECT_MESSAGE:
+            return self.MSG_DISCONNECT
+        if msg == self.GIVECLIENTS:
+            return self.MSG_USERLIST
+        if msg == self.KEEPALIVE:
+            return self.MSG_KEEPALIVE
+        if msg.startswith(self.HELLO):
+            return self.MSG_HELLO
+        if msg.split(" ", 1)[0] in self.CHANNEL_COMMANDS:
+            return self.MSG_CHANNEL
+        if msg[0:3] == "/dm":
+            return self.MSG_DM
+        return self.MSG_CHAT
+
+    def negotiate(self, conn, offer):
+        """Answers a client's HELLO and switches the connection to the newest framing both sides speak"""
+        # 'offer' is the HELLO message, e.g. "#!@!HELLO!@!# 3". The reply goes out in v1 framing and
+        # everything after it, in both directions, uses the agreed version. v2 and v3 share a header,
+        # v3 clients have also agreed that messages flagged COMPRESSED can go either way.
+        try:
+            version = min(int(offer.split()[1]), self.PROTO_VERSION)
+        except (IndexError, ValueError):
+            version = 1
+        self.send_msg(f"{self.HELLO} {version}", conn, self.MSG_HELLO)
+        conn.proto = version
+        conn.decoder.proto = version
+        self.log.debug(f"[PROTOCOL] {conn.addr} is using framing v{version}")
+
+    def process_message(self, conn, username, kind, msg):
+        """Acts on a single message from a registered user. Returns False once the user has left."""
+        # Shared by the threaded client_handler and the async engine so both speak the same protocol.
+        # 'conn' is the connection object for the sending client
+        # 'username' is the sender's registered username
+        # 'kind' is the message type, from the v2 header or classify()
+        # 'msg' is the decoded message text
+        if kind == self.MSG_KEEPALIVE: # An answer to a heartbeat. Reading it was all it needed.
+            return True
+        conn.last_active = time()
+        if kind == self.MSG_DISCONNECT: # If the user has issued a nice disconnect request, this executes it.
+            self.send_msg("\n[DISCONNECTED] See you again soon!\n\n", conn, self.MSG_DISCONNECT)
+            conn.close() # Closes the connection once the goodbye has been sent
+            user = self.unregister_user(conn) # Removes the connection from active user list
+            if user: # Unless the server got there first
+                self.log.info(f"[DISCONNECT] User \"{username}\" {user['addr']} has disconnected.")
+                self.disseminate(conn, f"[DISCONNECT] {username} has disconnected.\n")
+            return False
+        if kind == self.MSG_USERLIST: #If the user requests active user list, send it to them
+            self.send_user_list(conn, msg)
+            return True
+        if kind == self.MSG_PRESENCE:
+            if msg.strip() == "off":
+                self.presence.unsubscribe(conn)
+            else:
+                self.presence.subscribe(conn)
+            return True
+        if kind == self.MSG_DM:
+            self.send_dm(msg, conn)
+            return True
+        if kind == self.MSG_CHANNEL:
+            self.channel_command(conn, username, msg)
+            return True
+        if kind == self.MSG_CHAT and msg: # If a message is not a disconnect, prints it to the server log and relays
+            channel = self.channels.active(conn)   # to the other users in the sender's channel
+            if channel is None:
+                self.send_msg("[CHANNEL] You aren't in any channels. '/join <channel>' to start talking.", conn)
+                return True
+            self.log.message("[NEW MESSAGE] #%s %s: %s", self.channels.name(channel), username, msg) # Sampled when busy
+            share_msg = self.channel_line(channel, f"[{username}]: {msg}")
+            self.disseminate(conn, share_msg, self.MSG_CHAT, channel)
+        return True
+
+    def throttle(self, conn):
+        """Charges a message, and the bytes read since the last one, to the sender's token buckets"""
+        # Returns how many seconds to stop reading from the connection for, 0 if they are within their limits.
+        # Going over is a strike, but only once until a message is within the limits again. Past
+        # RATE_DISCONNECT strikes the user is disconnected instead, and None is returned.
+        if conn.limits is None:
+            return 0
+        now = time()
+        received = conn.decoder.bytes_in - conn.bytes_charged
+        conn.bytes_charged += received
+        pause = 0.0
+        for buckets in (conn.limits, conn.user_limits):
+            if buckets is None:
+                continue
+            messages, size = buckets
+            if messages:
+                pause = max(pause, messages.take(1, now))
+            if size:
+                pause = max(pause, size.take(received, now))
+        if not pause:
+            conn.over_limits = False
+            return 0
+        conn.throttled += 1
+        self.stats.count("throttled")
+        conn.paused_until = max(conn.paused_until, now + pause)
+        if conn.over_limits: # Still the same flood, the messages read before the pause are only catching up
+            return pause
+        conn.over_limits = True
+        if now - conn.last_strike > self.RATE_WINDOW:
+            conn.strikes = 0
+        conn.strikes += 1
+        conn.last_strike = now
+        if self.RATE_DISCONNECT and conn.strikes >= self.RATE_DISCONNECT:
+            self.log.warning(f"[RATE LIMIT] {conn} went over the rate limits {conn.strikes} times, disconnecting.")
+            self.stats.count("rate_disconnected")
+            self.disconnect_user(conn)
+            return None
+        return pause
+
+    def channel_command(self, conn, username, msg):
+        """Handles the /join, /leave and /channels commands. Returns False if the command was refused."""
+        # '/join <channel>' subscribes to a channel, creating it if needed, and sends the user's messages there
+        # '/leave [channel]' unsubscribes, from the channel they're talking in if none is given
+        # '/channels' lists every channel and how many are in it
+        words = msg.split()
+        command = words[0] if words else ""
+        if command == "/channels":
+            return self.list_channels(conn)
+        if command == "/join":
+            match = self.CHANNEL_NAME.fullmatch(words[1]) if len(words) == 2 else None
+            if match is None:
+                self.send_msg("[CHANNEL] Usage: /join <channel>. Names can have letters, numbers, - and _, up to 32 of them.", conn)
                 return False
+            channel = self.join_channel(conn, username, match.group(1))
+            self.send_msg(f"[CHANNEL] You joined #{self.channels.name(channel)}. Your messages go there now.", conn)
+            self.replay_history(conn, channel)
+            return True
+        if command == "/history": # Older messages than the ones replayed on joining, from the log
+            channel = self.channels.active(conn)
+            try:
+                count = min(int(words[1]), self.HISTORY_REPLAY) if len(words) > 1 else self.HISTORY_REPLAY
+            except ValueError:
+                count = 0
+            if channel is None or count < 1:
+                self.send_msg(f"[HISTORY] Usage: /history [count], up to {self.HISTORY_REPLAY}, in a channel you've joined.", conn)
+                return False
+            if self.mode == "async": # Reading the log mustn't hold up the event loop
+                self.loop.run_in_executor(None, self.send_history, conn, channel, count)
             else:
-                print('[ERROR] UNEXPECTED ERROR', err)
-                print(f"err.args[0] = {err.args[0]}")
-                print(traceback.format_exc())
+                self.send_history(conn, channel, count)
+            return True
+        if command == "/leave":
+            channel = words[1].lstrip("#").casefold() if len(words) > 1 else self.channels.active(conn)
+            name = self.channels.name(channel) if channel else None
+            if channel is None or not self.leave_channel(conn, username, channel):
+                self.send_msg("[CHANNEL] You aren't in that channel.", conn)
                 return False
+            active = self.channels.active(conn)
+            if active is None:
+                self.send_msg(f"[CHANNEL] You left #{name}. '/join <channel>' to keep talking.", conn)
+            else:
+                self.send_msg(f"[CHANNEL] You left #{name}. Your messages go to #{self.channels.name(active)} now.", conn)
+            return True
+        self.send_msg("[CHANNEL] Channel commands are /join <channel>, /leave [channel], /channels and /history [count].", conn)
+        return False
+
+    def join_channel(self, conn, username, channel, announce=True):
+        """Subscribes a user to a channel and makes it the one they talk in. Returns the channel's key."""
+        # 'announce' tells the channel's other members they've arrived
+        if self.bus: # Keeps the name the channel already has on other workers
+            channel = self.bus.channel_name(channel) or channel
+        channel = self.channels.join(conn, channel)
+        if self.bus: # The hub routes the channel's messages to every worker with someone in it
+            self.bus.subscribe(channel, self.channels.name(channel), username)
+        if announce:
+            self.disseminate(conn, self.channel_line(channel, f"[CHANNEL] {username} has joined."), self.MSG_SERVER, channel)
+        return channel
+
+    def leave_channel(self, conn, username, channel):
+        """Unsubscribes a user from a channel. Returns False if they weren't in it."""
+        if not self.channels.leave(conn, channel):
+            return False
+        if self.bus:
+            self.bus.unsubscribe(channel, username)
+        self.disseminate(conn, self.channel_line(channel, f"[CHANNEL] {username} has left."), self.MSG_SERVER, channel)
+        return True
+
+    def replay_history(self, conn, channel, count=None):
+        """Sends a user a channel's recent messages as a single write. Returns False if there weren't any."""
+        # 'count' fetches that many from the on-disk log, otherwise the in-memory history is replayed
+        if count is None:
+            frames = self.history.recent(channel, conn.proto)
+        else:
+            frames = self.history.search(channel, conn.proto, count)
+        if not frames:
+            return False
+        notice = self.frame_msg(f"[HISTORY] The last {len(frames)} messages in #{self.channels.name(channel)}:", self.MSG_SERVER, conn.proto)
+        conn.sendall(b"".join([notice, *frames])) # Already framed, so catching up costs one join and one write
+        return True
+
+    def send_history(self, conn, channel, count):
+        """Sends a user up to 'count' of a channel's latest messages from the log, or tells them there aren't any"""
+        if not self.replay_history(conn, channel, count):
+            self.send_msg(f"[HISTORY] Nothing has been said in #{self.channels.name(channel)} lately.", conn)
+
+    def channel_line(self, channel, text):
+        """Labels a line of text with the channel it was said in. Lobby lines look like they always have."""
+        if channel == self.LOBBY:
+            return f"\n{text}"
+        return f"\n[#{self.channels.name(channel)}] {text}"
+
+    def list_channels(self, conn):
+        """Sends a user every channel, how many are in it and which ones they're in"""
+        counts = {channel: [name, count] for channel, name, count in self.channels.counts()}
+        if self.bus: # Members on other workers
+            for channel, name, count in self.bus.channel_counts():
+                counts.setdefault(channel, [name, 0])[1] += count
+        subscribed = self.channels.subscribed(conn)
+        active = self.channels.active(conn)
+        lines = ["Channels:"]
+        for channel, (name, count) in sorted(counts.items()):
+            if channel == active:
+                note = " <- you're talking here"
+            elif channel in subscribed:
+                note = " (joined)"
+            else:
+                note = ""
+            lines.append(f"#{name} ({count}){note}")
+        self.send_msg("\n".join(lines), conn) # One message, so the list arrives in one piece
+        return True
 
     def get_username(self, conn, addr):
         """Attempts to receive a username from the connection. If attempt times out, closes connection."""
         # 'conn' is the connection object for the connecting client
         # 'addr' is the socket tuple for the connecting client.
-        print(f"\n[WAITING FOR USERNAME] Awaiting username from {addr}")
+        self.log.debug(f"[WAITING FOR USERNAME] Awaiting username from {addr}")
         self.send_msg("\n[SERVER] Hello! What is your username?", conn)
         timeout = time() + self.USER_TIMEOUT # Creates a final time based on current time plus the USER_TIMEOUT length
         conn.settimeout(self.USER_TIMEOUT) # Assigns the timeout period to the connection.
         while True:
             try:
-                msg_length = conn.recv(self.HEADER).decode(self.FORMAT) # Receives the header that communicates the
-                if msg_length == '':                                    # length of message server should expect.
-                    msg_length = 0
-                msg_length = int(msg_length)
-                username = conn.recv(msg_length).decode(self.FORMAT)
-                for user in self.user_list:
-                    if self.user_list[user]['username'].lower() == username.lower():
-                        self.send(f"\n[SERVER] The username {username} is currently in use.")
-                        self.send(f"\n[SERVER] Please choose another.\n")
-                        continue
-                if len(username) > 64: # Rejects username if longer than 64 bytes
-                    self.send_msg("\n[SERVER] Please choose a username with less than 64 characters.", conn)
-                    self.send_msg(f"{int(timeout - time())} seconds remaining.", conn)
-                    continue
-                elif len(username) == '': # Rejects empty usernames
-                    self.send_msg("[SERVER] Choose a username. Any username.", conn)
-                    self.send_msg(f"{int(timeout - time())} seconds remaining.", conn)
-                    continue
-
-                # except BrokenPipeError:
-                #     print("\n[ABRUPT DISCONNECT] User improperly disconnected.")
-                #     print(f"\n[ABRUPT DISCONNECT] Connection: {conn}")
-                #     conn.shutdown(2) # Removes the socket's read/write ability
-                #     conn.close() # Closes the socket
-                #     return False
-                
-                else: # If the username is successful they are registered in the userlist and welcomed@
-                    print(f"\n[NEW USERNAME] Username '{username}' belongs to {addr}")
-                    self.user_list[conn] = {"username": username, "addr": addr}
-                    self.send_msg(f"\n[SERVER] Welcome, {username}!", conn)
-                    return True
+                for kind, username in self.decode_messages(conn.decoder): # Every complete message received so far
+                    if kind == self.MSG_HELLO: # A newer client offering better framing before it sends its username
+                        self.negotiate(conn, username)
+                    elif self.check_username(username, conn, timeout) and self.register_user(conn, username, addr):
+                        conn.settimeout(None) # Username is in, so the connection goes back to blocking
+                        return True # Anything the client sent after its username stays buffered for client_handler
+                if conn.fill() == 0: # An empty read means the client hung up before picking a username
+                    return False
 
             except socket.timeout: # Closes the connection if the socket times out.
-                self.send_msg("\n[SERVER] No response received. Disconnecting.", conn)
-                self.send_msg("\n\n[DISCONNECTED] You have been disconnected by the server.\n\n", conn)
+                self.username_timeout(conn)
                 self.kicked_user_flag.set() # Sets the kicked user flag to indicate to other functions that this was intentional
-                print(f"\n[USERNAME TIMEOUT] The user timed out:")
-                print(f"[USERNAME TIMEOUT] {conn}")
-                conn.shutdown(2) # Removes the socket's read/write ability
-                conn.close() # Closes the socket
+                conn.close()
                 return False
+
+            except FrameError:
+                raise # client_handler closes the connection
             
             except Exception as err:
                 self.handle_errors(err)
                 return False
 
-    def send_msg(self, msg, conn):
+    def check_username(self, username, conn, timeout):
+        """Checks a requested username, telling the user why if it is refused. Returns True if it can be used."""
+        # 'username' is the requested username
+        # 'conn' is the connection object for the connecting client
+        # 'timeout' is the time at which the user's chance to pick a username runs out
+        if self.user_list.lookup(username) is not None:
+            self.username_taken(username, conn)
+            return False
+        if len(username) > 64: # Rejects username if longer than 64 bytes
+            self.send_msg("\n[SERVER] Please choose a username with less than 64 characters.", conn)
+            self.send_msg(f"{int(timeout - time())} seconds remaining.", conn)
+            return False
+        elif username == '': # Rejects empty usernames
+            self.send_msg("[SERVER] Choose a username. Any username.", conn)
+            self.send_msg(f"{int(timeout - time())} seconds remaining.", conn)
+            return False
+        elif not username.isprintable(): # A line break would split it in two in the user list and presence updates
+            self.send_msg("[SERVER] Usernames can't contain line breaks or other control characters.", conn)
+            self.send_msg(f"{int(timeout - time())} seconds remaining.", conn)
+            return False
+        return True
+
+    def username_taken(self, username, conn):
+        """Tells a user the username they asked for is already in use"""
+        self.send_msg(f"\n[SERVER] The username {username} is currently in use.", conn)
+        self.send_msg(f"\n[SERVER] Please choose another.\n", conn)
+
+    def register_user(self, conn, username, addr):
+        """Adds a user to the active user list, welcomes them and announces them to everyone else"""
+        # Returns False if someone else took the username since check_username() looked
+        if not self.user_list.register(conn, username, addr):
+            self.username_taken(username, conn)
+            return False
+        if self.bus and not self.bus.claim(username): # Someone on another worker has it
+            self.user_list.unregister(conn)
+            self.username_taken(username, conn)
+            return False
+        self.welcome_user(conn, username, addr)
+        return True
+
+    def welcome_user(self, conn, username, addr):
+        """Welcomes a user whose username is now theirs, on every worker, and announces them to everyone else"""
+        # If the username is successful they are registered in the userlist and welcomed
+        self.stats.timing("username", perf_counter() - conn.connected)
+        self.stats.count("registered")
+        conn.last_active = time()
+        conn.user_limits = self.rate_limits.user_buckets(username)
+        if self.HEARTBEAT_INTERVAL: # From here on the heartbeat wheel keeps an eye on them
+            self.heartbeats.schedule(conn, self.HEARTBEAT_INTERVAL)
+        self.log.info(f"[NEW USERNAME] Username '{username}' belongs to {addr}")
+        self.join_channel(conn, username, self.LOBBY, announce=False) # Everyone hears the arrival below
+        self.send_msg(f"\n[SERVER] Welcome, {username}!", conn)
+        self.replay_history(conn, self.LOBBY) # Catches them up on what was said before they arrived
+        if self.offline: # And hands over any DMs that came while they were away
+            self.offline.arrived(conn, username)
+        self.presence.changed("+", username)
+        self.disseminate(conn, f"[NEW CONNECTION] {username} has joined the chat\n")
+
+    def unregister_user(self, conn):
+        """Removes a user from the active user list. Returns their details, or None if they were already gone."""
+        user = self.user_list.unregister(conn)
+        self.channels.drop(conn)
+        self.heartbeats.cancel(conn)
+        self.presence.unsubscribe(conn)
+        if user:
+            self.stats.count("disconnected")
+            self.rate_limits.release(user['username'])
+            if self.offline:
+                self.offline.left(user['username'])
+            if not self.shutdown_flag.is_set(): # Nobody is left to tell at shutdown
+                self.presence.changed("-", user['username'])
+        if user and self.bus and not self.shutdown_flag.is_set(): # Frees the username and its channels on every worker
+            self.bus.release(user['username'])
+        return user
+
+    def usernames(self):
+        """Returns the username of every active user, on every worker in sharded mode"""
+        names = [details['username'] for conn, details in self.user_list.items()]
+        if self.bus:
+            names += self.bus.usernames()
+        return names
+
+    def send_user_list(self, conn, request):
+        """Sends a user the user list as one message, or one page of it if they asked for a page"""
+        # 'request' is whatever followed '/u', e.g. "2" for the second page of USERLIST_PAGE names.
+        # v1 clients can only send '/u' on its own, so they always get the whole list.
+        names = sorted(self.usernames(), key=str.casefold) # Sorted so the pages don't shift about
+        try:
+            page = int(request)
+        except ValueError:
+            page = None
+        if page is None or page < 1:
+            lines = ["Current users are:"] + names
+        else:
+            pages = max(1, -(-len(names) // self.USERLIST_PAGE))
+            page = min(page, pages)
+            start = (page - 1) * self.USERLIST_PAGE
+            lines = [f"Current users ({len(names)}, page {page} of {pages}):"] + names[start:start + self.USERLIST_PAGE]
+            if page < pages:
+                lines.append(f"'/u {page + 1}' for the next page")
+        self.send_msg("\n".join(lines), conn, self.MSG_USERLIST) # One message however many users there are
+
+    def username_timeout(self, conn):
+        """Tells a user who never sent a username that they are being disconnected"""
+        self.send_msg("\n[SERVER] No response received. Disconnecting.", conn)
+        self.send_msg("\n\n[DISCONNECTED] You have been disconnected by the server.\n\n", conn, self.MSG_DISCONNECT)
+        self.log.info(f"[USERNAME TIMEOUT] The user timed out: {conn}")
+
+    def send_msg(self, msg, conn, kind=None):
         """Sends messages to users"""
         # 'msg' is the message text to be sent
         # 'conn' is the connection object for the connecting client
+        # 'kind' is the v2 message type, MSG_SERVER if not given
         try:
-            message = msg.encode(self.FORMAT) # Encodes the message as a bytes object using the specified format
-            msg_length = len(message) # Gets the length of the message
-            send_length = str(msg_length).encode(self.FORMAT) # Gets a byte-encoded string of the message length
-            send_length += b' ' * (self.HEADER - len(send_length)) # Fills out the header to the full 64 bytes
-            conn.sendall(send_length) # Sends the header
-            conn.sendall(message) # sends the full message
-
+            conn.sendall(self.frame_msg(msg, kind, conn.proto))
         except Exception as err:
-            self.handle_errors(self, err)
+            self.handle_errors(err)
+
+    def frame_msg(self, msg, kind=None, proto=1):
+        """Encodes a message and its header in to one immutable buffer, ready to send"""
+        # Header and message travel as a single write, so they go out in one TLS record and the
+        # slow consumer policy never splits them. Broadcasts build this once for every recipient.
+        # 'kind' is the v2 message type (v1 has no types), 'proto' the framing version to use.
+        message = msg.encode(self.FORMAT) # Encodes the message as a bytes object using the specified format
+        msg_length = len(message) # Gets the length of the message
+        if proto >= 2: # v2 is a type byte and a 4 byte length instead of the padded text header
+            kind = kind or self.MSG_SERVER
+            if proto == 3 and msg_length > self.COMPRESS_MIN: # Worth a try. Broadcasts do this once for every v3 recipient.
+                frame = self.compressed_frame(kind, message)
+                if frame:
+                    return frame
+            return self.V2_HEADER.pack(kind, msg_length) + message
+        send_length = str(msg_length).encode(self.FORMAT) # Gets a byte-encoded string of the message length
+        send_length += b' ' * (self.HEADER - len(send_length)) # Fills out the header to the full 64 bytes
+        return send_length + message
+
+    def compressed_frame(self, kind, payload):
+        """Deflates an encoded message and frames it with the COMPRESSED flag. Returns None if it didn't shrink."""
+        # Each message is compressed on its own, starting from COMPRESS_DICT rather than from the messages
+        # before it, so one set of bytes serves every recipient and any of them can decode it.
+        compressor = zlib.compressobj(self.COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=self.COMPRESS_DICT)
+        data = compressor.compress(payload) + compressor.flush()
+        if len(data) >= len(payload):
+            return None
+        self.stats.count("compressed")
+        self.stats.count("compressed_bytes_saved", len(payload) - len(data))
+        return self.V2_HEADER.pack(kind | self.COMPRESSED, len(data)) + data
+
+    def inflate(self, data):
+        """Decompresses a COMPRESSED message from a client, refusing anything that inflates past MAX_MESSAGE"""
+        decompressor = zlib.decompressobj(-15, zdict=self.COMPRESS_DICT)
+        try:
+            payload = decompressor.decompress(data, self.MAX_MESSAGE)
+        except zlib.error as err:
+            raise FrameError(f"Bad compressed message: {err}")
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise FrameError("Compressed message too large or cut short")
+        return payload
+
+    def evict_slow_consumer(self, conn):
+        """Drops a client that can't keep up with its outbound queue (slow_policy "disconnect")"""
+        self.log.warning(f"[SLOW CONSUMER] Outbound queue overflowed, disconnecting {conn}")
+        conn.abort()
+
+    def count_outbox(self, event):
+        """Counts a slow consumer policy event ("dropped", "coalesced" or "disconnected")"""
+        with self.outbox_lock:
+            self.outbox_counts[event] += 1
+
+    def flush_outboxes(self, timeout=5):
+        """Waits up to 'timeout' seconds for the writer threads to empty their queues"""
+        deadline = time() + timeout
+        while any(client.outbox for client in list(self.thread_clients)) and time() < deadline:
+            sleep(0.05)
+
+    def list_outbox_counts(self):
+        """Prints the slow consumer policy counters and the current queue depths"""
+        print(f"Outbound queues (policy: {self.SLOW_POLICY}, limit {self.OUTBOX_FRAMES} messages / {self.OUTBOX_BYTES} bytes):")
+        with self.outbox_lock:
+            for event, count in self.outbox_counts.items():
+                print(f"{event} ......... {count}")
+        for conn, details in self.user_list.items():
+            if conn.outbox:
+                print(f"{details['username']} has {len(conn.outbox)} messages ({conn.outbox.size} bytes) waiting")
+        return True
     
     def send_dm(self, msg, sender_conn):
         """Sends a direct message from one user to another"""
@@ -249,39 +1114,71 @@ class Clicserver:
             #                followed by 0 or more whitespace or not-whitespace characters (depending on messge)
             dm_parse = re.match(r"\s*(/dm)\s+(\S+)\s+(\S+[\s\S]*)", msg)       
             target_username = dm_parse.group(2) # Recipient username is the second capture group
-            for conn in self.user_list: # Search through the connection list for that username
-                found = False # Flag for if username is found
-                if self.user_list[conn]['username'] == target_username:
-                    target = conn # If the username is found assign that connection to 'target'
-                    found = True #  and set 'found' to True
-                    break
-            if found == False: # If the username is not found, log it and notify sender
-                print(f"[*DM*] Error: {sender} tried to send to '{target_username}'")
-                dm_not_found = (f"[*DM*] Error: '{target_username}' is not a valid user")
-                print(dm_not_found)
-                self.send_msg(dm_not_found, sender_conn)
-                return False
-            message = dm_parse.group(3) # If the username is valid log message and send to target
-            print(f"\n[*DM*] {sender} to {target_username}: {message}")
-            dm_msg = f"\n[*DM*] [{sender}]: {message}"
-            self.send_msg(dm_msg, target)
-            return True
+            message = dm_parse.group(3) # Message is the third
+            if self.bus and self.user_list.lookup(target_username) is None: # They may be on another worker.
+                self.bus.send_dm(sender, target_username, message)               # The hub knows where.
+                return True
+            return self.deliver_dm(sender, target_username, message)
         except Exception as err:
-            print(Exception)
-            self.handle_errors(self, err) 
+            self.handle_errors(err)
+
+    def deliver_dm(self, sender, target_username, message):
+        """Sends a direct message to a user on this process, or tells the sender there's no such user"""
+        # 'sender' is the sender's username, they may be on another worker in sharded mode
+        target = self.user_list.lookup(target_username) # Finds that username's connection, ignoring case
+        if target is None: # If the username is not found, log it and notify sender
+            self.dm_not_found(sender, target_username, message)
+            return False
+        self.log.message("[*DM*] %s to %s: %s", sender, target_username, message) # If the username is valid log message and send to target
+        dm_msg = f"\n[*DM*] [{sender}]: {message}"
+        self.send_msg(dm_msg, target, self.MSG_DM)
+        return True
+
+    def dm_not_found(self, sender, target_username, message):
+        """Keeps a direct message for a recipient who is offline, or tells the sender they aren't a valid user"""
+        sender_conn = self.user_list.lookup(sender)
+        if sender_conn is None: # The sender is on another worker, the hub passes the news on
+            if self.bus:
+                self.bus.dm_failed(sender, target_username, message)
+            return False
+        if self.offline: # Whether they've ever been here is a question for the disk, so the offline thread answers it
+            self.offline.store(sender, target_username, message)
+            return True
+        self.log.message("[*DM*] Error: %s tried to send to '%s', not a valid user", sender, target_username)
+        dm_not_found = (f"[*DM*] Error: '{target_username}' is not a valid user")
+        self.send_msg(dm_not_found, sender_conn)
+        return True
 
 
-    def disseminate(self, sender_conn, message):
+    def disseminate(self, sender_conn, message, kind=None, channel=None):
         """Sends received messages to all users."""
         # 'sender_conn' is the connection object for message sender
         # 'message' is the text content of the sender's message
-        for conn in self.user_list:
+        # 'kind' is the v2 message type, MSG_SERVER if not given
+        # 'channel' limits it to that channel's members, otherwise everyone gets it
+        if self.bus: # Users on the other workers get it from the hub
+            self.bus.publish(message, kind, channel)
+        frames = self.history.record(message, kind, channel, persist=True) # Only the worker it started on logs it
+        return self.fan_out(sender_conn, message, kind, channel, frames)
+
+    def fan_out(self, sender_conn, message, kind=None, channel=None, frames=None):
+        """Sends a message to every user on this process, or every member of a channel, but the sender"""
+        # 'sender_conn' is None for messages relayed from other workers
+        # 'frames' are the message already framed by version, if the history has done it
+        started = perf_counter()
+        recipients = self.user_list if channel is None else self.channels.members(channel)
+        frames = dict(frames or {}) # Encoded and framed once per framing version, the same bytes are queued for every recipient
+        for conn in recipients: # Iterates a snapshot, so users coming and going can't interrupt it
             try:
                 if conn != sender_conn: # Sends the message to everyone but the sender
-                    self.send_msg(message, conn)
+                    frame = frames.get(conn.proto)
+                    if frame is None:
+                        frame = frames[conn.proto] = self.frame_msg(message, kind, conn.proto)
+                    conn.sendall(frame)
             except Exception as err:
-                print('[UNEXPECTED ERROR]', err , f'for {conn}')
-                print(traceback.format_exc())
+                self.log.error(f"[UNEXPECTED ERROR] {err} for {conn}", exc_info=True)
+        self.stats.timing("disseminate", perf_counter() - started)
+        self.stats.count("broadcasts")
         return True
 
     def disconnect_query(self):
@@ -291,31 +1188,29 @@ class Clicserver:
             if kick == '':
                 return None
             else:
-                user_found = False
-                for conn in self.user_list: # Check if the user is in the active user list
-                    username = self.user_list[conn]['username']
-                    if kick == username: # If so, passes them to disconnect function
-                        self.disconnect_user(conn)
-                        user_found = True
-                        return True
-                if user_found == False: # If the provided username isn't found informs the server operator
+                conn = self.user_list.lookup(kick) # Check if the user is in the active user list
+                if conn is not None: # If so, passes them to disconnect function
+                    self.disconnect_user(conn)
+                    return True
+                elif self.hub and self.hub.kick(kick): # In sharded mode their worker disconnects them
+                    return True
+                else: # If the provided username isn't found informs the server operator
                     print(f"\n[DISCONNECT] User '{kick}' doesn't seem to be connected.")
                     continue
 
     def disconnect_user(self, conn):
         """Forcibly disconnects the provided connection"""
-        username = self.user_list[conn]['username']
+        # 'conn' is the connection object for the connecting client
+        user = self.unregister_user(conn) # Removes the connection from active user list
+        if user is None: # Already on its way out
+            return None
+        username = user['username']
         try:
-            # 'conn' is the connection object for the connecting client
-            self.send_msg("\n\n[DISCONNECTED] You have been disconnected by the server.\n\n", conn)
+            self.send_msg("\n\n[DISCONNECTED] You have been disconnected by the server.\n\n", conn, self.MSG_DISCONNECT)
             self.kicked_user_flag.set() # Sets the kicked user flag to indicate to other functions that this was intentional
-            conn.shutdown(2) # Removes the socket's read/write ability
-            conn.close() # Closes the socket
-            print(f"\n[DISCONNECT] User {username} has been forcibly disconnected.")
+            conn.close() # Closes the connection once the notice has been sent
+            self.log.info(f"[DISCONNECT] User {username} has been forcibly disconnected.")
             self.disseminate(conn, f"\n[DISCONNECT] User \"{username}\" has been disconnected by the server")
-            if self.shutdown_flag.is_set():
-                return True
-            del self.user_list[conn] # Removes the connection from active user list
             return True
         except Exception as err:
             self.handle_errors(err)
@@ -324,8 +1219,11 @@ class Clicserver:
     def list_users(self):
         """Prints all the users currently in the active user list"""
         print("Current users are:")
-        for user in self.user_list:
-            print(f"{self.user_list[user]['username']} at {self.user_list[user]['addr']}")
+        for user, details in self.user_list.items():
+            print(f"{details['username']} at {details['addr']}")
+        if self.hub: # In sharded mode the workers have the users
+            for username, worker_id in self.hub.usernames():
+                print(f"{username} on worker {worker_id}")
         return True
 
     def server_shutdown(self):
@@ -335,34 +1233,62 @@ class Clicserver:
             print("[SHUTDOWN] Type YES to shut down.\n")
             yes_shut = input("[SHUTDOWN] ")
             if yes_shut == "YES": # Shutdown must be confirmed with the word 'YES' in all caps
-                self.shutdown_flag.set() # Set the shutdown flag to cleanly end running functions and threads
-                print("\n[SHUTDOWN] Disconnecting all users.")
-                for conn in self.user_list: # Disconnect all connected users
-                    self.disconnect_user(conn)
-                self.user_list = {}
-                print("\n[SHUTDOWN] Shutting down. Goodbye.\n\n")
-                self.server_socket.shutdown(2) # Removes the socket's read/write ability
-                self.server_socket.close() # Closes the socket
-                exit()
+                self.stop_server()
             else: # Any confirmation reply other than 'YES' aborts the shutdown
                 print("[SHUTDOWN] Shutdown aborted.")
                 return False
         except Exception as err:
             self.handle_errors(err)
 
-    def handle_errors(self, err, third):
-        print(f"Mysterious third argument: {third}")
+    def stop_server(self):
+        """Disconnects all users, closes the server socket, then ends the process. Doesn't ask first."""
+        self.shutdown_flag.set() # Set the shutdown flag to cleanly end running functions and threads
+        if self.hub: # In sharded mode the workers have the users and the sockets
+            self.log.info("[SHUTDOWN] Stopping the workers.")
+            self.hub.shutdown()
+            for worker in self.processes:
+                worker.join(timeout=10)
+            self.log.info("[SHUTDOWN] Shutting down. Goodbye.\n\n")
+            self.log.stop()
+            exit()
+        self.log.info("[SHUTDOWN] Disconnecting all users.")
+        for conn in self.user_list: # Disconnect all connected users
+            self.disconnect_user(conn)
+        self.user_list.clear()
+        self.flush_outboxes() # Gives the writer threads a chance to deliver the disconnect notices
+        self.log.info("[SHUTDOWN] Shutting down. Goodbye.\n\n")
+        if self.mode == "async": # The event loop owns the server socket and flushes the goodbyes
+            asyncio.run_coroutine_threadsafe(self.async_shutdown(), self.loop).result(timeout=10)
+        else:
+            self.handshake_pool.shutdown(wait=False) # Queued handshakes are for a server that is going away
+            self.server_socket.shutdown(2) # Removes the socket's read/write ability
+            self.server_socket.close() # Closes the socket
+        if self.history.log:
+            self.history.log.stop() # Writes out the last of the history
+        self.log.stop() # Writes out the last of the log
+        exit()
+
+    async def async_shutdown(self):
+        """Stops accepting connections and gives open transports a moment to flush before the loop stops"""
+        self.loop.remove_reader(self.server_socket)
+        self.server_socket.close()
+        for client in list(self.async_clients):
+            client.transport.close()
+        for _ in range(100): # Waits up to 5 seconds for every connection_lost() callback
+            if not self.async_clients:
+                break
+            await asyncio.sleep(0.05)
+        self.loop.call_soon(self.loop.stop)
+
+    def handle_errors(self, err):
+        """Logs errors raised while talking to a client"""
         if self.kicked_user_flag.is_set():
-            print(f"\n[DISCONNECT] Connection for user was closed after being disconnected.")
+            self.log.info("[DISCONNECT] Connection for user was closed after being disconnected.")
         if err.args[0] == 9:
-            print("\n[ERROR] Errno 9 BAD FILE DESCRIPTOR")
-            print("\n[ERROR] Connection already closed")
-            print(traceback.format_exc())
+            self.log.error("[ERROR] Errno 9 BAD FILE DESCRIPTOR, connection already closed", exc_info=True)
             return True
         else:
-            print('[ERROR] UNEXPECTED ERROR', err)
-            print(traceback.format_exc())
-            print(f"err.args[0] = {err.args[0]}")
+            self.log.error(f"[ERROR] UNEXPECTED ERROR {err} (err.args[0] = {err.args[0]})", exc_info=True)
             return False
 
     def get_help(self):
@@ -371,6 +1297,9 @@ class Clicserver:
         print("'/q' ......... Shutdown (quit) server")
         print("'/u' ......... Print a list of users")
         print("'/d' ......... Disconnect a user")
+        print("'/o' ......... Print outbound queue counters")
+        print("'/t' ......... Print TLS handshake stats")
+        print("'/s' ......... Print server stats: counters, latency and the busiest connections")
         print("\n")
 
     def server_control(self):
@@ -382,6 +1311,18 @@ class Clicserver:
             elif cmd == '/u': # 'u' prints the list of users
                 self.list_users()
                 continue
+            elif self.hub and cmd in ('/o', '/t', '/s', '/stats'): # In sharded mode each worker prints its own counters
+                self.hub.report(cmd)
+                continue
+            elif cmd in ('/s', '/stats'): # 's' prints the counters, stage latencies and busiest connections
+                self.list_stats()
+                continue
+            elif cmd == '/t': # 't' prints handshake latency and the session resumption hit rate
+                self.list_tls_stats()
+                continue
+            elif cmd == '/o': # 'o' prints the slow consumer counters and queue depths
+                self.list_outbox_counts()
+                continue
             elif cmd == '/d': # 'd' begins the process of disconnecting a user
                 self.disconnect_query()
                 self.kicked_user_flag.clear()
@@ -391,7 +1332,1852 @@ class Clicserver:
                 continue 
 
 
+class UserRegistry:
+    """Thread-safe list of active users, indexed by connection and by case-folded username"""
+    # Client threads (or the event loop) and the server control thread all add, remove and look up
+    # users at once. Changes are made under a lock with both indexes updated together, so a username
+    # can never be taken twice. Iterating gives an immutable snapshot that is only rebuilt after a
+    # change, so fan-out never holds the lock while sending and never sees the list change size.
+
+    def __init__(self):
+        """Init class for the user registry"""
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards every change to the indexes
+        self.users = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Connection -> {"username": ..., "addr": ...}
+        self.names = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Case-folded username -> connection
+        self.snapshot = () #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> (connection, details) pairs as of the last change
+        self.stale = False #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Set when the snapshot needs rebuilding
+
+    def register(self, conn, username, addr):
+        """Adds a user. Returns False if the username is already taken, in any case."""
+        key = username.casefold()
+        with self.lock:
+            if key in self.names:
+                return False
+            self.users[conn] = {"username": username, "addr": addr}
+            self.names[key] = conn
+            self.stale = True
+        return True
+
+    def unregister(self, conn):
+        """Removes a user. Returns their details, or None if they were already gone."""
+        with self.lock:
+            user = self.users.pop(conn, None)
+            if user is not None:
+                del self.names[user["username"].casefold()]
+                self.stale = True
+        return user
+
+    def lookup(self, username):
+        """Returns the connection using a username, in any case, or None"""
+        return self.names.get(username.casefold())
+
+    def items(self):
+        """Returns a snapshot of (connection, details) pairs that later changes won't touch"""
+        if self.stale:
+            with self.lock:
+                if self.stale:
+                    self.snapshot = tuple(self.users.items())
+                    self.stale = False
+        return self.snapshot
+
+    def clear(self):
+        """Removes every user"""
+        with self.lock:
+            self.users.clear()
+            self.names.clear()
+            self.stale = True
+
+    def __iter__(self):
+        return (conn for conn, details in self.items())
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, conn):
+        return conn in self.users
+
+    def __getitem__(self, conn):
+        return self.users[conn]
+
+    def get(self, conn):
+        """Returns a connection's details, or None if it isn't registered"""
+        return self.users.get(conn)
+
+
+class LatencyHistogram:
+    """Counts durations in power-of-two microsecond buckets, cheap enough to record on every call"""
+    # Bucket n holds durations under 2**n microseconds, so percentiles are accurate to within a factor
+    # of two, which is plenty to tell a 50us fan-out from a 5ms one.
+
+    BUCKETS = 32 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> The last bucket takes anything over about 18 minutes
+
+    def __init__(self):
+        """Init class for a latency histogram"""
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards the counts
+        self.buckets = [0] * self.BUCKETS #>>>>>>>>>>>>>>>>> Number of durations in each bucket
+        self.count = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Durations recorded
+        self.total = 0.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Sum of the durations, in seconds
+        self.max = 0.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Longest duration, in seconds
+
+    def record(self, seconds):
+        """Adds one duration"""
+        bucket = min(int(seconds * 1000000).bit_length(), self.BUCKETS - 1)
+        with self.lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """Returns the upper bound, in seconds, of the bucket holding the given fraction of durations"""
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min(2 ** bucket / 1000000, self.max)
+        return 0.0
+
+    def snapshot(self):
+        """Returns the histogram as plain data. Bucket keys are upper bounds in microseconds."""
+        with self.lock:
+            return {"count": self.count, "total": self.total, "max": self.max,
+                    "buckets": {2 ** bucket: count for bucket, count in enumerate(self.buckets) if count}}
+
+
+class ServerStats:
+    """Counters and per-stage latency histograms for the server's hot paths"""
+    # The stages are where a lag spike can hide:
+    #   "accept"      - accept() until a handshake worker picks the connection up (thread mode)
+    #   "tls"         - the TLS handshake
+    #   "username"    - connecting until a username is registered (includes the user's typing)
+    #   "disseminate" - queueing one broadcast for every recipient
+    #   "sendall"     - one write to a client's socket or transport
+
+    STAGES = ("accept", "tls", "username", "disseminate", "sendall")
+
+    def __init__(self):
+        """Init class for the server stats"""
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards the counters
+        self.histograms = {stage: LatencyHistogram() for stage in self.STAGES}
+        self.counters = {"accepted": 0, "registered": 0, "disconnected": 0, "messages_in": 0, "broadcasts": 0,
+                         "heartbeats": 0, "evicted_unresponsive": 0, "evicted_idle": 0, "throttled": 0, "rate_disconnected": 0,
+                         "compressed": 0, "compressed_bytes_saved": 0, "log_dropped": 0, "log_sampled": 0,
+                         "rejected_full": 0, "history_dropped": 0, "offline_dms_stored": 0, "offline_dms_delivered": 0}
+
+    def timing(self, stage, seconds):
+        """Records how long one pass through a stage took"""
+        self.histograms[stage].record(seconds)
+
+    def count(self, counter, amount=1):
+        """Adds to a counter"""
+        with self.lock:
+            self.counters[counter] += amount
+
+    def counters_snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class ServerLog:
+    """Server log lines, queued for a background writer thread so a slow console or disk never holds up a client"""
+    # Hot paths only build a LogRecord and put it on a bounded queue. The writer thread formats it and
+    # writes it to stdout and, if there is one, a log file that is rotated by size. When the queue is
+    # full the line is dropped and counted rather than waited for. Lines logged for every chat message
+    # and DM go through message(), which logs the first MESSAGE_RATE of them each second and then only
+    # every SAMPLE_EVERYth, so a flood can't fill the queue with them.
+
+    LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+    QUEUE = 10000 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Most lines waiting for the writer before new ones are dropped
+    MESSAGE_RATE = 100 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Per-message lines logged each second before sampling starts
+    SAMPLE_EVERY = 100 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Past MESSAGE_RATE, only every this many per-message lines is logged
+
+    def __init__(self, stats, level="info", path=None, max_bytes=10485760, backups=5):
+        """Init class for the server log. Nothing is written until start()."""
+        # 'stats' is the ServerStats that counts dropped and sampled lines.
+        # 'level' is the least important level logged: "debug", "info", "warning" or "error".
+        # 'path' is a log file to write as well as stdout, None for stdout only. Once it reaches
+        # 'max_bytes' it is moved to path.1 (and so on, keeping 'backups' of them) and started again.
+        self.stats = stats
+        self.level = self.LEVELS[level]
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(self.QUEUE) #>>>>>>>>>>>>>>>> Records waiting for the writer thread
+        self.handlers = [] #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Where the writer thread writes each record, once started
+        self.writer = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> The writer thread, once started
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>>>>> Guards second and in_second
+        self.second = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> The second in_second is counting
+        self.in_second = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Per-message lines so far this second
+
+    def start(self, worker_id=None):
+        """Opens the log file and starts the writer thread. Each sharded mode worker calls this after forking."""
+        # Workers log to their own file, path.workerN, so they never rotate a file out from under each other.
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter("\n%(message)s" if worker_id is None else f"\n[WORKER {worker_id}] %(message)s"))
+        self.handlers = [console]
+        if self.path: # The file gets everything, the console only what needs the operator's attention
+            console.setLevel(logging.WARNING)
+            path = self.path if worker_id is None else f"{self.path}.worker{worker_id}"
+            logfile = logging.handlers.RotatingFileHandler(path, maxBytes=self.max_bytes, backupCount=self.backups)
+            logfile.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+            self.handlers.append(logfile)
+        self.writer = threading.Thread(name="log", target=self.write, daemon=True)
+        self.writer.start()
+
+    def write(self):
+        """Runs in the writer thread. Formats and writes each queued record until stop() queues None."""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            handler.close()
+
+    def stop(self, timeout=5):
+        """Gives the writer thread up to 'timeout' seconds to write out what is still queued, then stops it"""
+        if self.writer is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full: # The console or disk is stuck, so whatever is queued is lost with the process
+            return
+        self.writer.join(timeout)
+        self.writer = None
+
+    def log(self, level, msg, *args, exc_info=False):
+        """Queues a line at 'level'. 'msg' is %-formatted with 'args' by the writer thread, not the caller."""
+        # 'exc_info' adds the traceback of the exception being handled.
+        if level < self.level:
+            return
+        record = logging.LogRecord("clic", level, __file__, 0, msg, args, sys.exc_info() if exc_info else None)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.stats.count("log_dropped")
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args, exc_info=False):
+        self.log(logging.ERROR, msg, *args, exc_info=exc_info)
+
+    def message(self, msg, *args):
+        """Queues an info line about a single chat message or DM, sampling them once they get busy"""
+        if logging.INFO < self.level:
+            return
+        second = int(time())
+        with self.lock:
+            if second != self.second:
+                self.second, self.in_second = second, 0
+            self.in_second += 1
+            count = self.in_second
+        if count > self.MESSAGE_RATE and count % self.SAMPLE_EVERY:
+            self.stats.count("log_sampled")
+            return
+        self.log(logging.INFO, msg, *args)
+
+
+class TimerWheel:
+    """Hierarchical timing wheel. Timers are set and cancelled in O(1), and a tick only touches timers that are due."""
+    # Level 0 has a slot per TICK, and each slot of the level above covers a whole turn of the level
+    # below. A timer goes in the lowest level that reaches its due time. As the wheel turns, the
+    # timers in the slot it reaches on level 0 are due, and each time level 0 wraps around the next
+    # slot up is emptied in to the levels below it. However many timers there are, a tick does no
+    # work for the ones that aren't due yet, and each timer is moved at most once per level.
+    # With 1 second ticks and 3 levels of 64 slots, timers reach out to about 3 days.
+
+    TICK = 1.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds per slot on the lowest level
+    SLOTS = 64 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Slots per level
+    LEVELS = 3 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Longer delays are cut down to what the top level reaches
+
+    def __init__(self):
+        """Init class for a timer wheel"""
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards everything below (thread mode sets timers from many threads)
+        self.wheels = [[set() for slot in range(self.SLOTS)] for level in range(self.LEVELS)]
+        self.timers = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> key -> (due tick, the slot's set), to cancel in O(1)
+        self.origin = time() #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Time of tick 0
+        self.current = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> The last tick handled
+
+    def schedule(self, key, delay, now=None):
+        """Sets (or moves) the timer for 'key' to go off in 'delay' seconds"""
+        now = time() if now is None else now
+        due = int((now + delay - self.origin) / self.TICK) + 1 # Never early, at most a tick late
+        with self.lock:
+            self.remove(key)
+            self.place(key, max(due, self.current + 1))
+
+    def cancel(self, key):
+        """Removes the timer for 'key', if it has one"""
+        with self.lock:
+            self.remove(key)
+
+    def remove(self, key):
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer[1].discard(key)
+
+    def place(self, key, due):
+        """Puts a timer in the lowest level that reaches its due tick"""
+        span = due - self.current
+        for level in range(self.LEVELS):
+            if span < self.SLOTS ** (level + 1) or level == self.LEVELS - 1:
+                due = min(due, self.current + self.SLOTS ** (level + 1) - 1)
+                slot = self.wheels[level][(due // self.SLOTS ** level) % self.SLOTS]
+                slot.add(key)
+                self.timers[key] = (due, slot)
+                return
+
+    def advance(self, now=None):
+        """Turns the wheel up to 'now'. Returns the keys whose timers went off, which are removed."""
+        now = time() if now is None else now
+        target = int((now - self.origin) / self.TICK)
+        expired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                for level in range(1, self.LEVELS): # Each wrap of a level empties the next slot up in to the levels below
+                    if self.current % self.SLOTS ** level:
+                        break
+                    self.cascade(self.wheels[level][(self.current // self.SLOTS ** level) % self.SLOTS])
+                self.cascade(self.wheels[0][self.current % self.SLOTS], expired)
+        return expired
+
+    def cascade(self, slot, expired=None):
+        """Empties a slot. Timers that are due go on 'expired', the rest move down a level."""
+        keys = list(slot)
+        slot.clear()
+        for key in keys:
+            due = self.timers.pop(key)[0]
+            if due <= self.current and expired is not None:
+                expired.append(key)
+            else: # Due on this tick lands in level 0's current slot, which is emptied next
+                self.place(key, due)
+
+    def __len__(self):
+        return len(self.timers)
+
+
+class TokenBucket:
+    """Refills at 'rate' tokens a second, up to 'burst'. Taking more than is there runs up a debt."""
+    # Letting the debt happen means a message that is already read can always be handled; the
+    # sender then waits out the debt, so over time they get exactly 'rate' and no more.
+
+    def __init__(self, rate, burst):
+        """Init class for a token bucket, starting full"""
+        self.rate = rate #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Tokens added per second
+        self.burst = burst #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Most tokens the bucket holds
+        self.tokens = burst #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Tokens as of 'updated', below 0 when in debt
+        self.updated = time() #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> When 'tokens' was last worked out
+
+    def take(self, amount, now):
+        """Takes 'amount' tokens. Returns how many seconds until the bucket is out of debt, 0 if it isn't in any."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+        self.updated = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def refilled(self, now):
+        """Returns how many seconds until the bucket is full again"""
+        return max(0.0, (self.burst - self.tokens) / self.rate - (now - self.updated))
+
+
+class RateLimiter:
+    """Token buckets limiting how fast each connection, and each username, can send messages and bytes"""
+    # Every connection gets its own buckets. Once registered, the username's buckets are charged as
+    # well, and they outlive the connection until they have refilled, so dropping the connection and
+    # coming back under the same name doesn't buy a fresh burst.
+
+    def __init__(self, msg_rate, byte_rate, burst):
+        """Init class for the rate limiter"""
+        # 'msg_rate' is messages per second, 'byte_rate' bytes per second. None leaves that one unlimited.
+        # 'burst' is how many seconds' worth of either can be sent at once.
+        self.msg_rate = msg_rate
+        self.byte_rate = byte_rate
+        self.burst = burst
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards users and expiring
+        self.users = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Case-folded username -> its buckets
+        self.online = set() #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Case-folded usernames registered right now
+        self.expiring = [] #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Heap of (time full again, username) for users who left in debt
+
+    def __bool__(self):
+        return bool(self.msg_rate or self.byte_rate)
+
+    def buckets(self):
+        """Returns a new (messages, bytes) pair of buckets, None for a limit that isn't set. None if nothing is limited."""
+        if not self:
+            return None
+        return (TokenBucket(self.msg_rate, self.msg_rate * self.burst) if self.msg_rate else None,
+                TokenBucket(self.byte_rate, self.byte_rate * self.burst) if self.byte_rate else None)
+
+    def user_buckets(self, username):
+        """Returns the buckets for a username, picking up where they left off if they were in debt last time"""
+        if not self:
+            return None
+        with self.lock:
+            self.expire(time())
+            key = username.casefold()
+            self.online.add(key)
+            if key not in self.users:
+                self.users[key] = self.buckets()
+            return self.users[key]
+
+    def release(self, username):
+        """Forgets a username's buckets once they have refilled, which may be right away"""
+        if not self:
+            return
+        now = time()
+        with self.lock:
+            key = username.casefold()
+            self.online.discard(key)
+            buckets = self.users.get(key)
+            if buckets is None:
+                return
+            refilled = max(bucket.refilled(now) for bucket in buckets if bucket)
+            if refilled:
+                heapq.heappush(self.expiring, (now + refilled, key))
+            else:
+                del self.users[key]
+            self.expire(now)
+
+    def expire(self, now):
+        """Drops the buckets of users who left in debt and have since refilled (called with the lock held)"""
+        while self.expiring and self.expiring[0][0] <= now:
+            key = heapq.heappop(self.expiring)[1]
+            buckets = self.users.get(key)
+            if key in self.online or not buckets: # Came back, release() will look again when they leave
+                continue
+            if any(bucket.refilled(now) for bucket in buckets if bucket): # Not quite yet
+                heapq.heappush(self.expiring, (now + max(bucket.refilled(now) for bucket in buckets if bucket), key))
+            else:
+                del self.users[key]
+
+
+class MessageHistory:
+    """The last few chat messages in each channel, framed and ready to replay to users as they join"""
+    # Each channel keeps a ring of its last HISTORY_FRAMES messages, framed for every framing version,
+    # so catching a user up is one join and one write. Messages are also appended to a HistoryLog on
+    # disk, which '/history' searches for anything older and which refills the rings on restart.
+    # Messages older than HISTORY_AGE are never replayed.
+
+    def __init__(self, server):
+        """Init class for the message history"""
+        # 'server' is the Clicserver holding the limits
+        self.server = server
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards the rings
+        self.rings = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Channel key -> deque of (time, {framing version: frame})
+        self.log = HistoryLog(server) if server.HISTORY_DIR else None #> Messages on disk, see HistoryLog
+        if self.log: # Picks up where the last run left off
+            latest = {} # Channel key -> deque of its last HISTORY_FRAMES records, so only those get framed
+            for when, channel, kind, payload in self.log.records(time() - server.HISTORY_AGE):
+                if channel not in latest:
+                    latest[channel] = deque(maxlen=server.HISTORY_FRAMES)
+                latest[channel].append((when, kind, payload))
+            for channel, records in latest.items():
+                for when, kind, payload in records:
+                    self.remember(when, channel, self.frames(kind, payload))
+
+    def record(self, message, kind, channel, persist):
+        """Keeps a channel's chat message for replay, and writes it to the log if 'persist'. Returns its frames, or None."""
+        if kind != self.server.MSG_CHAT or channel is None: # Server notices and broadcasts to everyone aren't kept
+            return None
+        now = time()
+        payload = message.encode(self.server.FORMAT)
+        frames = self.frames(kind, payload)
+        self.remember(now, channel, frames)
+        if persist and self.log:
+            self.log.append(now, channel, kind, payload)
+        return frames
+
+    def frames(self, kind, payload):
+        """Frames an encoded message for every framing version. Large ones are compressed for v3 here, once."""
+        server = self.server
+        v1_header = str(len(payload)).encode(server.FORMAT).ljust(server.HEADER)
+        v2 = server.V2_HEADER.pack(kind, len(payload)) + payload
+        big = server.PROTO_VERSION >= 3 and len(payload) > server.COMPRESS_MIN
+        v3 = server.compressed_frame(kind, payload) if big else None
+        return {1: v1_header + payload, 2: v2, 3: v3 or v2}
+
+    def remember(self, when, channel, frames):
+        with self.lock:
+            ring = self.rings.get(channel)
+            if ring is None:
+                ring = self.rings[channel] = deque(maxlen=self.server.HISTORY_FRAMES)
+            ring.append((when, frames))
+            cutoff = time() - self.server.HISTORY_AGE
+            while ring[0][0] < cutoff: # Ages out old messages as new ones arrive
+                ring.popleft()
+
+    def recent(self, channel, proto):
+        """Returns a channel's remembered messages, oldest first, framed for 'proto'"""
+        cutoff = time() - self.server.HISTORY_AGE
+        with self.lock:
+            ring = self.rings.get(channel, ())
+            return [frames[proto] for when, frames in ring if when >= cutoff]
+
+    def search(self, channel, proto, count):
+        """Returns up to 'count' of a channel's latest messages from the log, oldest first, framed for 'proto'"""
+        if not self.log: # Nothing on disk, so memory is all there is
+            return self.recent(channel, proto)[-count:]
+        return [self.frames(kind, payload)[proto] for when, kind, payload in self.log.latest(channel, count)]
+
+
+class HistoryLog:
+    """Append-only log of chat messages on disk, split in to segment files that are read with mmap"""
+    # Each record is a RECORD header (time, message type, channel length, message length), then the
+    # channel key and the encoded message. A segment is closed once it passes HISTORY_SEGMENT_BYTES,
+    # then the oldest segments are deleted once they pass HISTORY_AGE or the process has more than
+    # HISTORY_LOG_BYTES of them. In sharded mode each worker writes its own segments and reads everyone's.
+    # Records are written by a background thread, so a broadcast never waits on the disk. Searches
+    # index each segment by channel as they read it, and a segment only ever grows, so a repeated
+    # '/history' only reads what was written since the last one.
+
+    RECORD = struct.Struct("!dBHI")
+    QUEUE = 10000 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Most records waiting for the writer thread before new ones are dropped
+
+    def __init__(self, server):
+        """Init class for the history log"""
+        # 'server' is the Clicserver holding the directory and limits
+        self.server = server
+        self.directory = server.HISTORY_DIR
+        self.queue = queue.Queue(self.QUEUE) #>>>>>>>>>>>>>> Encoded records waiting for the writer thread
+        self.writer = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> The writer thread, once started
+        self.segment = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Open segment file, opened on the first message. Writer thread only.
+        self.segment_size = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Bytes written to the open segment
+        self.index_lock = threading.Lock() #>>>>>>>>>>>>>>>> Guards index
+        self.index = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Segment path -> [bytes indexed, {channel key: array of record offsets}]
+        os.makedirs(self.directory, exist_ok=True)
+        owners = {os.path.basename(path)[:-len(".seg")].partition("-")[2] for path in self.segments()}
+        for owner in owners: # Clears out what a previous run left past its limits, each process against its own
+            self.evict(self.segments(owner))
+
+    def owner(self):
+        """Tag on this process's segment names"""
+        return "main" if self.server.worker_id is None else f"worker{self.server.worker_id}"
+
+    def segments(self, owner=None):
+        """Returns segment paths, oldest first. Names start with the time the segment was opened."""
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".seg"))
+        if owner is not None:
+            names = [name for name in names if name.endswith(f"-{owner}.seg")]
+        return [os.path.join(self.directory, name) for name in names]
+
+    def start(self):
+        """Starts the writer thread. Each sharded mode worker calls this after forking."""
+        self.writer = threading.Thread(name="history", target=self.write, daemon=True)
+        self.writer.start()
+
+    def append(self, when, channel, kind, payload):
+        """Queues a message for the writer thread. Never waits on the disk; drops the message if the writer is that far behind."""
+        key = channel.encode(self.server.FORMAT)
+        record = self.RECORD.pack(when, kind, len(key), len(payload)) + key + payload
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.server.stats.count("history_dropped")
+
+    def write(self):
+        """Runs in the writer thread. Appends queued records to the open segment until stop() queues None."""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                if self.segment is None or self.segment_size >= self.server.HISTORY_SEGMENT_BYTES:
+                    self.rotate()
+                self.segment.write(record)
+                self.segment_size += len(record)
+                if self.queue.empty(): # Goes to the page cache, where readers' mmaps can see it, once per burst
+                    self.segment.flush()
+            except OSError as err: # A full disk costs the message, not the writer
+                self.server.log.error(f"[HISTORY] Couldn't write to the log: {err}")
+        if self.segment:
+            self.segment.close()
+
+    def stop(self, timeout=5):
+        """Gives the writer thread up to 'timeout' seconds to write out what is still queued, then stops it"""
+        if self.writer is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full: # The disk is stuck, so whatever is queued is lost with the process
+            return
+        self.writer.join(timeout)
+        self.writer = None
+
+    def rotate(self):
+        # Writer thread only
+        if self.segment:
+            self.segment.close()
+        path = os.path.join(self.directory, f"{int(time() * 1000000):016d}-{self.owner()}.seg")
+        self.segment = open(path, "ab")
+        self.segment_size = 0
+        self.evict(self.segments(self.owner())[:-1]) # Never the segment just opened
+
+    def evict(self, paths):
+        """Deletes segments, oldest first, that are past HISTORY_AGE or over HISTORY_LOG_BYTES"""
+        cutoff = time() - self.server.HISTORY_AGE
+        sizes = [os.path.getsize(path) for path in paths]
+        total = sum(sizes)
+        for path, size in zip(paths, sizes):
+            if os.path.getmtime(path) >= cutoff and total <= self.server.HISTORY_LOG_BYTES:
+                break
+            os.remove(path)
+            total -= size
+
+    def records(self, since):
+        """Returns (time, channel, type, message) for every record since 'since', in time order"""
+        found = []
+        for path in self.segments():
+            try:
+                if os.path.getmtime(path) < since: # Nothing this old gets replayed
+                    continue
+                with open(path, "rb") as segment, mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                    found.extend(self.parse(log, since))
+            except (OSError, ValueError): # Deleted since it was listed, or empty (mmap can't map nothing)
+                continue
+        found.sort(key=lambda record: record[0]) # Interleaves the workers' segments
+        return found
+
+    def latest(self, channel, count):
+        """Returns (time, type, message) for up to 'count' of a channel's latest records, oldest first"""
+        # Segments are read newest first, and only until the rest can't hold anything newer than
+        # what's been found: nothing in a segment is newer than when it was last written to.
+        key = channel.encode(self.server.FORMAT)
+        since = time() - self.server.HISTORY_AGE
+        found = [] # Heap of the newest records so far, oldest on top
+        with self.index_lock:
+            dated = []
+            for path in self.segments():
+                try:
+                    dated.append((os.path.getmtime(path), path))
+                except OSError: # Deleted since it was listed
+                    continue
+            for path in self.index.keys() - {path for modified, path in dated}: # Deleted segments
+                del self.index[path]
+            for modified, path in sorted(dated, reverse=True):
+                if modified < since or (len(found) >= count and found[0][0] >= modified):
+                    break
+                try:
+                    with open(path, "rb") as segment, mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                        for offset in reversed(self.indexed(path, log).get(key, ())):
+                            when, kind, key_length, length = self.RECORD.unpack_from(log, offset)
+                            if when < since or (len(found) >= count and when <= found[0][0]):
+                                break
+                            start = offset + self.RECORD.size + key_length
+                            record = (when, kind, log[start:start + length])
+                            if len(found) < count:
+                                heapq.heappush(found, record)
+                            else:
+                                heapq.heapreplace(found, record)
+                except (OSError, ValueError): # Deleted since it was listed, or empty (mmap can't map nothing)
+                    continue
+        return sorted(found)
+
+    def indexed(self, path, log):
+        """Returns a mapped segment's {channel key: record offsets}, indexing whatever was added since last time"""
+        # Caller holds index_lock
+        entry = self.index.setdefault(path, [0, {}])
+        offset, channels = entry
+        end = len(log)
+        while offset + self.RECORD.size <= end:
+            when, kind, key_length, length = self.RECORD.unpack_from(log, offset)
+            start = offset + self.RECORD.size
+            if start + key_length + length > end: # Partly written
+                break
+            key = log[start:start + key_length]
+            offsets = channels.get(key)
+            if offsets is None:
+                offsets = channels[key] = array("Q")
+            offsets.append(offset)
+            offset = start + key_length + length
+        entry[0] = offset
+        return channels
+
+    def parse(self, log, since):
+        """Yields the records from one mapped segment, stopping at a partly written one"""
+        offset, end = 0, len(log)
+        while offset + self.RECORD.size <= end:
+            when, kind, key_length, length = self.RECORD.unpack_from(log, offset)
+            start = offset + self.RECORD.size
+            offset = start + key_length + length
+            if offset > end:
+                break
+            if when >= since:
+                yield when, str(log[start:start + key_length], self.server.FORMAT), kind, log[start + key_length:offset]
+
+
+class Presence:
+    """Users subscribed to presence updates, so they can keep a roster without asking for the user list"""
+    # Subscribing gets a user the whole roster, then an update each time someone joins or leaves.
+    # An update is one message: a first line of "<version> <change>" and then one username per
+    # line. The change is "=" for the whole roster, "+" for users who joined and "-" for users
+    # who left. Each update's version is one more than the last, so a client that sees a version
+    # skipped (its outbound queue may have dropped one) knows to subscribe again for a fresh roster.
+    # Updates are queued while holding the lock so they reach every subscriber in version order.
+    # In sharded mode every worker counts versions for its own subscribers.
+
+    def __init__(self, server):
+        """Init class for presence subscriptions"""
+        # 'server' is the Clicserver the subscribers are connected to
+        self.server = server
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards version and subscribers, and orders the updates
+        self.version = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Joins and leaves so far
+        self.subscribers = set() #>>>>>>>>>>>>>>>>>>>>>>>>>> Connections getting updates
+
+    def subscribe(self, conn):
+        """Sends a connection the whole roster and signs it up for updates. Subscribing again starts afresh."""
+        server = self.server
+        with self.lock:
+            self.subscribers.add(conn)
+            server.send_msg(self.update(self.version, "=", server.usernames()), conn, server.MSG_PRESENCE)
+
+    def unsubscribe(self, conn):
+        """Stops a connection's updates"""
+        with self.lock:
+            self.subscribers.discard(conn)
+
+    def changed(self, change, username):
+        """Tells every subscriber a user has joined ("+") or left ("-")"""
+        server = self.server
+        with self.lock:
+            self.version += 1
+            frames = {} # Framed once per framing version, like a broadcast
+            for conn in self.subscribers:
+                frame = frames.get(conn.proto)
+                if frame is None:
+                    frame = frames[conn.proto] = server.frame_msg(self.update(self.version, change, [username]),
+                                                                  server.MSG_PRESENCE, conn.proto)
+                conn.sendall(frame)
+
+    def update(self, version, change, usernames):
+        """Returns the text of an update"""
+        return "\n".join([f"{version} {change}"] + list(usernames))
+
+
+class OfflineDMs:
+    """Direct messages for users who are offline, kept in SQLite until they come back"""
+    # A DM to a username that isn't online, but has been seen on this server before, is stored
+    # rather than refused, and delivered in one write right after its recipient next registers.
+    # Every disk access happens on the "offline" thread, fed by a bounded queue, so neither a DM
+    # between online users nor anything on the event loop ever waits on the disk. Each recipient
+    # can have OFFLINE_DM_LIMIT messages waiting, and any older than OFFLINE_DM_AGE are thrown away,
+    # as are usernames that haven't been seen for that long.
+    # In sharded mode every worker runs its own thread on the same database file.
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS users (key TEXT PRIMARY KEY, username TEXT, seen REAL)",
+              "CREATE TABLE IF NOT EXISTS dms (id INTEGER PRIMARY KEY, recipient TEXT, sender TEXT, message TEXT, sent REAL)",
+              "CREATE INDEX IF NOT EXISTS dms_recipient ON dms (recipient, id)",
+              "CREATE INDEX IF NOT EXISTS dms_sent ON dms (sent)",
+              "CREATE INDEX IF NOT EXISTS users_seen ON users (seen)")
+    QUEUE = 10000 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Most requests waiting for the thread before DMs are refused
+    EXPIRE_EVERY = 3600 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Seconds between sweeps for expired messages
+
+    def __init__(self, server):
+        """Init class for the offline DM store. Nothing touches the disk until start()."""
+        # 'server' is the Clicserver holding the database path and limits
+        self.server = server
+        self.path = server.OFFLINE_DB
+        self.requests = queue.Queue(self.QUEUE) #>>>>>>>>>>>>> (action, arguments) for the offline thread
+        self.db = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> SQLite connection, only ever used by the offline thread
+
+    def start(self):
+        """Starts the offline thread. Each sharded mode worker calls this after forking."""
+        thread = threading.Thread(name="offline", target=self.run, daemon=True)
+        thread.start()
+
+    def request(self, action, *args):
+        """Hands a request to the offline thread. Returns False if it is too far behind to take it."""
+        try:
+            self.requests.put_nowait((action, args))
+        except queue.Full:
+            return False
+        return True
+
+    def arrived(self, conn, username):
+        """Remembers a username as one that can be sent offline DMs, and delivers any waiting for it"""
+        self.request("arrived", conn, username, time())
+
+    def left(self, username):
+        """Notes when a user was last here, so a long stay doesn't count as being away"""
+        self.request("left", username, time())
+
+    def store(self, sender, target_username, message):
+        """Keeps a DM for a user who is offline. The sender is told how that went once it's done."""
+        if not self.request("store", sender, target_username, message, time()):
+            self.tell(sender, f"[*DM*] Error: couldn't save your message for '{target_username}', try again later")
+
+    def tell(self, username, text):
+        """Sends a notice to a user on this process, if they're still here"""
+        conn = self.server.user_list.lookup(username)
+        if conn is not None:
+            self.server.send_msg(text, conn)
+
+    def run(self):
+        """Runs in the offline thread. Opens the database, then works through requests until the process ends."""
+        try:
+            self.db = sqlite3.connect(self.path, timeout=10)
+            self.db.execute("PRAGMA journal_mode=WAL") # Workers can read while another writes
+            with self.db:
+                for statement in self.SCHEMA:
+                    self.db.execute(statement)
+        except sqlite3.Error as err: # DMs then pile up in the queue until senders are told it's full
+            self.server.log.error(f"[OFFLINE DM] Can't open {self.path}: {err}")
+            return
+        swept = 0
+        while True:
+            if time() - swept >= self.EXPIRE_EVERY:
+                swept = time()
+                self.expire(swept)
+            try:
+                action, args = self.requests.get(timeout=self.EXPIRE_EVERY)
+            except queue.Empty:
+                continue
+            try:
+                getattr(self, f"do_{action}")(*args)
+            except sqlite3.Error as err:
+                self.server.log.error(f"[OFFLINE DM] {action} failed: {err}")
+
+    def do_arrived(self, conn, username, now):
+        """Offline thread side of arrived()"""
+        key = username.casefold()
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?)", (key, username, now))
+        self.deliver(conn, key, now)
+
+    def do_left(self, username, now):
+        """Offline thread side of left()"""
+        with self.db:
+            self.db.execute("UPDATE users SET seen = ? WHERE key = ?", (now, username.casefold()))
+
+    def do_store(self, sender, target_username, message, now):
+        """Offline thread side of store(). Only usernames seen here before can be sent offline DMs."""
+        key = target_username.casefold()
+        server = self.server
+        if self.db.execute("SELECT 1 FROM users WHERE key = ?", (key,)).fetchone() is None:
+            server.log.message("[*DM*] Error: %s tried to send to '%s', not a valid user", sender, target_username)
+            self.tell(sender, f"[*DM*] Error: '{target_username}' is not a valid user")
+            return
+        waiting, = self.db.execute("SELECT COUNT(*) FROM dms WHERE recipient = ? AND sent >= ?",
+                                   (key, now - server.OFFLINE_DM_AGE)).fetchone()
+        if waiting >= server.OFFLINE_DM_LIMIT:
+            self.tell(sender, f"[*DM*] '{target_username}' is offline and has too many messages waiting. Try again later.")
+            return
+        with self.db:
+            self.db.execute("INSERT INTO dms (recipient, sender, message, sent) VALUES (?, ?, ?, ?)",
+                            (key, sender, message, now))
+        server.stats.count("offline_dms_stored")
+        server.log.message("[*DM*] %s to %s (offline): %s", sender, target_username, message)
+        self.tell(sender, f"[*DM*] '{target_username}' is offline. They'll get your message when they're back.")
+        conn = server.user_list.lookup(target_username)
+        if conn is not None: # They arrived while the DM was on its way here
+            self.deliver(conn, key, now)
+
+    def deliver(self, conn, key, now):
+        """Sends a user every DM waiting for them as one write, then forgets them"""
+        server = self.server
+        if conn not in server.user_list: # Gone again already, the DMs can wait for next time
+            return
+        rows = self.db.execute("SELECT id, sender, message, sent FROM dms WHERE recipient = ? AND sent >= ? ORDER BY id",
+                               (key, now - server.OFFLINE_DM_AGE)).fetchall()
+        if not rows:
+            return
+        came = "1 direct message came" if len(rows) == 1 else f"{len(rows)} direct messages came"
+        frames = [server.frame_msg(f"\n[*DM*] {came} while you were away:", server.MSG_SERVER, conn.proto)]
+        for dm_id, sender, message, sent in rows:
+            frames.append(server.frame_msg(f"[*DM*] [{sender}] ({strftime('%b %d %H:%M', localtime(sent))}): {message}",
+                                           server.MSG_DM, conn.proto))
+        conn.sendall(b"".join(frames))
+        with self.db:
+            self.db.execute("DELETE FROM dms WHERE recipient = ? AND id <= ?", (key, rows[-1][0]))
+        server.stats.count("offline_dms_delivered", len(rows))
+
+    def expire(self, now):
+        """Deletes messages older than OFFLINE_DM_AGE, and users not seen in that long"""
+        cutoff = now - self.server.OFFLINE_DM_AGE
+        with self.db:
+            self.db.execute("DELETE FROM dms WHERE sent < ?", (cutoff,))
+            self.db.execute("DELETE FROM users WHERE seen < ?", (cutoff,))
+
+
+class ChannelIndex:
+    """Thread-safe index of chat channels and the users in each"""
+    # Chat lines go to the sender's channel rather than to everyone, so fan-out only walks that
+    # channel's members. Like UserRegistry, changes are made under a lock and each channel's members
+    # are handed out as an immutable snapshot that is only rebuilt after someone joins or leaves.
+    # Channels are keyed by case-folded name and disappear when their last member leaves.
+
+    def __init__(self):
+        """Init class for the channel index"""
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards every change to the indexes
+        self.names = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Channel key -> channel name as first joined
+        self.index = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Channel key -> set of member connections
+        self.snapshots = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Channel key -> tuple of members as of the last change
+        self.subscriptions = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>> Connection -> channel keys, the one they talk in last
+
+    def join(self, conn, channel):
+        """Adds a connection to a channel, creating it if needed, and makes it their active one. Returns its key."""
+        key = channel.casefold()
+        with self.lock:
+            self.names.setdefault(key, channel)
+            self.index.setdefault(key, set()).add(conn)
+            self.snapshots.pop(key, None)
+            subscriptions = self.subscriptions.setdefault(conn, [])
+            if key in subscriptions:
+                subscriptions.remove(key)
+            subscriptions.append(key)
+        return key
+
+    def leave(self, conn, key):
+        """Takes a connection out of a channel. Returns False if it wasn't in it."""
+        with self.lock:
+            subscriptions = self.subscriptions.get(conn, [])
+            if key not in subscriptions:
+                return False
+            subscriptions.remove(key)
+            self.remove_member(conn, key)
+        return True
+
+    def drop(self, conn):
+        """Takes a connection out of every channel. Returns the keys of the channels it was in."""
+        with self.lock:
+            subscriptions = self.subscriptions.pop(conn, [])
+            for key in subscriptions:
+                self.remove_member(conn, key)
+        return subscriptions
+
+    def remove_member(self, conn, key):
+        # Caller holds the lock
+        members = self.index[key]
+        members.discard(conn)
+        self.snapshots.pop(key, None)
+        if not members:
+            del self.index[key]
+            del self.names[key]
+
+    def members(self, key):
+        """Returns a snapshot of a channel's members that later changes won't touch"""
+        snapshot = self.snapshots.get(key)
+        if snapshot is None:
+            with self.lock:
+                snapshot = tuple(self.index.get(key, ()))
+                if key in self.index:
+                    self.snapshots[key] = snapshot
+        return snapshot
+
+    def active(self, conn):
+        """Returns the key of the channel a connection talks in, or None if it isn't in any"""
+        subscriptions = self.subscriptions.get(conn)
+        return subscriptions[-1] if subscriptions else None
+
+    def subscribed(self, conn):
+        """Returns the keys of every channel a connection is in"""
+        return list(self.subscriptions.get(conn, ()))
+
+    def name(self, key):
+        """Returns a channel's name as first joined"""
+        return self.names.get(key, key)
+
+    def counts(self):
+        """Returns (key, name, member count) for every channel"""
+        with self.lock:
+            return [(key, self.names[key], len(members)) for key, members in self.index.items()]
+
+
+class ShardHub:
+    """Relays messages between worker processes and keeps the one true list of usernames (sharded mode)"""
+    # Runs in the supervisor. Each worker connects to it over a Unix domain socket and tells it
+    # about every broadcast, DM and username change. Broadcasts go out to every other worker, DMs
+    # go to the worker holding the recipient, and username claims are settled here so a name is
+    # only ever taken once across the whole server. Joins and leaves are passed on so every worker
+    # can answer a user list request without asking.
+
+    def __init__(self, server):
+        """Init class for the shard hub"""
+        # 'server' is the supervising Clicserver
+        self.server = server
+        self.authkey = os.urandom(32) #>>>>>>>>>>>>>>>>>>>>> Only processes forked from this one know it
+        self.listener = Listener(family="AF_UNIX", authkey=self.authkey) # Unix domain socket the workers connect to
+        self.address = self.listener.address
+        self.shards = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Worker connection -> worker id
+        self.directory = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Case-folded username -> (worker connection, username)
+        self.channels = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Channel key -> {case-folded username: worker connection}
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards sends, a connection isn't thread-safe
+
+    def accept(self, count):
+        """Waits for 'count' workers to connect. Each one sends its worker id first."""
+        for _ in range(count):
+            conn = self.listener.accept()
+            self.shards[conn] = conn.recv()
+
+    def run(self):
+        """Relays messages between the workers until they have all gone"""
+        while self.shards:
+            for conn in wait(list(self.shards)):
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError): # The worker has stopped
+                    self.drop(conn)
+                    continue
+                self.handle(conn, msg)
+
+    def handle(self, conn, msg):
+        """Acts on one message from a worker"""
+        action = msg[0]
+        if action == "claim": # A worker wants a username for a new user
+            request, username = msg[1:]
+            key = username.casefold()
+            if key in self.directory:
+                self.send(conn, "claimed", request, False)
+                return
+            self.directory[key] = (conn, username)
+            self.send(conn, "claimed", request, True)
+            self.send_others(conn, "joined", username)
+        elif action == "release": # A user has left
+            username = msg[1]
+            key = username.casefold()
+            if self.directory.get(key, (None,))[0] is conn:
+                del self.directory[key]
+                self.forget_channels(key)
+                self.send_others(conn, "left", username)
+        elif action == "broadcast": # Channel messages only go to workers with someone in the channel
+            channel = msg[3]
+            if channel is None:
+                self.send_others(conn, *msg)
+            else:
+                for owner in set(self.channels.get(channel, {}).values()):
+                    if owner is not conn:
+                        self.send(owner, *msg)
+        elif action == "subscribe":
+            channel, username = msg[1], msg[3]
+            self.channels.setdefault(channel, {})[username.casefold()] = conn
+            self.send_others(conn, *msg)
+        elif action == "unsubscribe":
+            channel, username = msg[1:]
+            members = self.channels.get(channel, {})
+            members.pop(username.casefold(), None)
+            if not members:
+                self.channels.pop(channel, None)
+            self.send_others(conn, *msg)
+        elif action == "dm": # Goes to the recipient's worker, or back as undeliverable
+            sender, target_username = msg[1:3]
+            owner = self.owner(target_username)
+            if owner is not None:
+                self.send(owner, *msg)
+            else:
+                self.send(conn, "dm_failed", *msg[1:])
+        elif action == "dm_failed": # Goes to the sender's worker, unless that's where it came from
+            owner = self.owner(msg[1])
+            if owner is not None and owner is not conn:
+                self.send(owner, *msg)
+
+    def drop(self, conn):
+        """Forgets a worker that has stopped, and every user it had"""
+        worker_id = self.shards.pop(conn)
+        if not self.server.shutdown_flag.is_set():
+            self.server.log.warning(f"[SHARDED] Worker {worker_id} has stopped.")
+        for key, (owner, username) in list(self.directory.items()):
+            if owner is conn:
+                del self.directory[key]
+                self.forget_channels(key)
+                self.send_others(conn, "left", username)
+
+    def forget_channels(self, key):
+        """Takes a departed user, by case-folded username, out of every channel"""
+        for channel, members in list(self.channels.items()):
+            members.pop(key, None)
+            if not members:
+                del self.channels[channel]
+
+    def owner(self, username):
+        """Returns the connection of the worker holding a username, in any case, or None"""
+        return self.directory.get(username.casefold(), (None,))[0]
+
+    def send(self, conn, *msg):
+        """Sends a message to one worker"""
+        try:
+            with self.lock:
+                conn.send(msg)
+        except OSError: # The worker has stopped, run() drops it
+            pass
+
+    def send_others(self, sender, *msg):
+        """Sends a message to every worker but 'sender'"""
+        for conn in list(self.shards):
+            if conn is not sender:
+                self.send(conn, *msg)
+
+    def usernames(self):
+        """Returns (username, worker id) for every user on every worker"""
+        return [(username, self.shards.get(owner)) for owner, username in list(self.directory.values())]
+
+    def kick(self, username):
+        """Asks a user's worker to disconnect them. Returns False if nobody has that username."""
+        owner = self.owner(username)
+        if owner is None:
+            return False
+        self.send(owner, "kick", username)
+        return True
+
+    def report(self, cmd):
+        """Asks every worker to print its counters for a server command ('/o' or '/t')"""
+        for conn in list(self.shards):
+            self.send(conn, "report", cmd)
+
+    def shutdown(self):
+        """Tells every worker to disconnect its users and stop"""
+        for conn in list(self.shards):
+            self.send(conn, "shutdown")
+
+
+class ShardBus:
+    """A worker process's link to the ShardHub (sharded mode)"""
+    # The worker's main thread reads the bus and acts on what the other workers send: relayed
+    # broadcasts and DMs, users joining and leaving elsewhere, and commands from the server operator.
+    # Everything it does with them only queues messages, so the bus never waits on a client.
+
+    def __init__(self, server, conn):
+        """Init class for a worker's bus connection"""
+        # 'server' is the worker's Clicserver
+        # 'conn' is the connection to the hub
+        self.server = server
+        self.conn = conn
+        self.lock = threading.Lock() #>>>>>>>>>>>>>>>>>>>>>> Guards sends, a connection isn't thread-safe
+        self.names = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Case-folded username -> username, for users on other workers
+        self.channels = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Channel key -> [name, case-folded usernames] for users on other workers
+        self.claims = {} #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Claim request id -> function taking the hub's answer
+        self.next_claim = itertools.count() #>>>>>>>>>>>>>>> Claim request ids
+        self.conn.send(server.worker_id) # Tells the hub which worker this is
+
+    def send(self, *msg):
+        """Sends a message to the hub"""
+        try:
+            with self.lock:
+                self.conn.send(msg)
+        except OSError: # The supervisor has gone, run() stops the worker
+            pass
+
+    def claim(self, username):
+        """Asks the hub for a username and waits for the answer. Returns True if no other worker has it."""
+        # Blocks the caller (a client thread) for one round trip to the hub. The answer is picked
+        # up by run() on the worker's main thread. Async mode uses claim_later() instead.
+        answered = threading.Event()
+        answer = []
+        request = self.ask(username, lambda granted: (answer.append(granted), answered.set()))
+        if not answered.wait(self.server.BUS_TIMEOUT):
+            if self.give_up(request, username):
+                return False
+            answered.wait() # run() had already taken the answer, and is about to hand it over
+        return answer[0]
+
+    def claim_later(self, username, callback):
+        """Asks the hub for a username without waiting (async mode). 'callback' gets the answer on the event loop."""
+        loop = self.server.loop
+        def answered(granted): # Runs on the worker's main thread
+            loop.call_soon_threadsafe(finish, granted)
+        def finish(granted):
+            timer.cancel()
+            callback(granted)
+        def timed_out():
+            if self.give_up(request, username):
+                callback(False)
+        request = self.ask(username, answered)
+        timer = loop.call_later(self.server.BUS_TIMEOUT, timed_out)
+
+    def ask(self, username, answered):
+        """Sends a username claim to the hub. Returns the request id; 'answered' is called with the answer."""
+        request = next(self.next_claim)
+        self.claims[request] = answered
+        self.send("claim", request, username)
+        return request
+
+    def give_up(self, request, username):
+        """Abandons a claim the hub hasn't answered in time. Returns False if the answer beat it here after all."""
+        if self.claims.pop(request, None) is None:
+            return False
+        # The hub may yet grant it, and would then hold the name for a user who isn't coming. The
+        # release follows the claim down the same pipe, so the hub always sees them in that order.
+        self.release(username)
+        return True
+
+    def release(self, username):
+        """Tells the hub a username is free again"""
+        self.send("release", username)
+
+    def publish(self, message, kind, channel):
+        """Sends a broadcast, for everyone or for one channel, to the other workers"""
+        self.send("broadcast", message, kind, channel)
+
+    def subscribe(self, channel, name, username):
+        """Tells the other workers a user here joined a channel"""
+        self.send("subscribe", channel, name, username)
+
+    def unsubscribe(self, channel, username):
+        """Tells the other workers a user here left a channel"""
+        self.send("unsubscribe", channel, username)
+
+    def send_dm(self, sender, target_username, message):
+        """Passes a direct message to the hub for a user who isn't on this worker"""
+        self.send("dm", sender, target_username, message)
+
+    def dm_failed(self, sender, target_username, message):
+        """Tells the sender's worker their direct message had nowhere to go"""
+        self.send("dm_failed", sender, target_username, message)
+
+    def usernames(self):
+        """Returns the usernames of the users on other workers"""
+        return list(self.names.values())
+
+    def channel_name(self, channel):
+        """Returns a channel's name on other workers, in any case, or None if it has no members there"""
+        entry = self.channels.get(channel.casefold())
+        return entry[0] if entry else None
+
+    def channel_counts(self):
+        """Returns (channel key, name, member count) for users on other workers"""
+        return [(channel, name, len(members)) for channel, (name, members) in list(self.channels.items())]
+
+    def forget_member(self, channel, key):
+        """Takes a user on another worker, by case-folded username, out of a channel"""
+        entry = self.channels.get(channel)
+        if entry:
+            entry[1].discard(key)
+            if not entry[1]:
+                del self.channels[channel]
+
+    def run(self):
+        """Acts on messages from the hub until it says to stop or goes away"""
+        server = self.server
+        reports = {'/o': server.list_outbox_counts, '/t': server.list_tls_stats,
+                   '/s': server.list_stats, '/stats': server.list_stats}
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError): # The supervisor has gone
+                return False
+            action = msg[0]
+            if action == "claimed":
+                answered = self.claims.pop(msg[1], None)
+                if answered: # Unless the claim already timed out
+                    answered(msg[2])
+            elif action == "joined":
+                self.names[msg[1].casefold()] = msg[1]
+                server.presence.changed("+", msg[1])
+            elif action == "left":
+                key = msg[1].casefold()
+                if self.names.pop(key, None) is not None:
+                    server.presence.changed("-", msg[1])
+                for channel in list(self.channels):
+                    self.forget_member(channel, key)
+            elif action == "broadcast":
+                frames = server.history.record(*msg[1:], persist=False)
+                server.fan_out(None, *msg[1:], frames)
+            elif action == "subscribe":
+                channel, name, username = msg[1:]
+                self.channels.setdefault(channel, [name, set()])[1].add(username.casefold())
+            elif action == "unsubscribe":
+                self.forget_member(msg[1], msg[2].casefold())
+            elif action == "dm":
+                server.deliver_dm(*msg[1:])
+            elif action == "dm_failed":
+                server.dm_not_found(*msg[1:])
+            elif action == "kick":
+                conn = server.user_list.lookup(msg[1])
+                if conn is not None:
+                    server.disconnect_user(conn)
+            elif action == "report":
+                print(f"\n[WORKER {server.worker_id}]")
+                reports[msg[1]]()
+            elif action == "shutdown":
+                return True
+
+
+class FrameError(ValueError):
+    """Raised when a client sends bytes that can't be a valid message"""
+
+
+class FrameDecoder:
+    """Incrementally splits a connection's byte stream in to complete messages, v1 or v2 framing"""
+    # TCP and TLS split and merge messages as they please, so a single read can hold half a message
+    # or several. Bytes are read straight in to a preallocated buffer (recv_into, or get_buffer for
+    # asyncio) and frames() yields every complete message as a memoryview of that buffer, so nothing
+    # is copied until the text is decoded. The views are only good until the next read.
+
+    def __init__(self, server):
+        """Init class for a frame decoder"""
+        # 'server' is the Clicserver holding the header formats and size limits
+        self.server = server
+        self.proto = 1 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Framing version, switched by Clicserver.negotiate()
+        self.buffer = bytearray(server.RECV_BUFFER) #>>>>>>> Receive buffer
+        self.view = memoryview(self.buffer) #>>>>>>>>>>>>>>> View of the buffer that frames are sliced from
+        self.start = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> First byte not yet handed out as part of a frame
+        self.end = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> End of the bytes received so far
+        self.bytes_in = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Bytes received over the connection's life
+        self.frames_in = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Messages received over the connection's life
+
+    def recv_into(self, sock):
+        """Reads whatever the socket has in to the buffer. Returns the byte count, 0 if the peer hung up."""
+        count = sock.recv_into(self.get_buffer())
+        self.end += count
+        self.bytes_in += count
+        return count
+
+    def get_buffer(self, sizehint=-1):
+        """Returns a writable view of the free end of the buffer (asyncio.BufferedProtocol interface)"""
+        self.make_room()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """Records 'nbytes' written in to the view from get_buffer() (asyncio.BufferedProtocol interface)"""
+        self.end += nbytes
+        self.bytes_in += nbytes
+
+    def make_room(self, min_free=1024):
+        """Frees space at the end of the buffer, moving a partial frame to the front or growing the buffer"""
+        if self.start == self.end: # Everything has been handed out, so start again from the front
+            self.start = self.end = 0
+            if len(self.buffer) > self.server.RECV_BUFFER: # Drops the extra space a large message needed
+                self.buffer = bytearray(self.server.RECV_BUFFER)
+                self.view = memoryview(self.buffer)
+        elif self.start and len(self.buffer) - self.end < min_free:
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start, self.end = 0, remaining
+        if len(self.buffer) - self.end < min_free: # A message bigger than the buffer is on its way
+            buffer = bytearray(max(len(self.buffer) * 2, self.end + min_free))
+            buffer[:self.end] = self.view[:self.end]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+
+    def frames(self):
+        """Yields (type, payload) for every complete frame in the buffer. v1 frames have no type (None)."""
+        server = self.server
+        while True: # The framing version is checked per frame as HELLO can switch it
+            available = self.end - self.start
+            if self.proto >= 2:
+                header_size = server.V2_HEADER.size
+                if available < header_size:
+                    break
+                kind, msg_length = server.V2_HEADER.unpack_from(self.buffer, self.start)
+            else:
+                header_size = server.HEADER
+                if available < header_size:
+                    break
+                kind = None
+                try:
+                    msg_length = int(self.buffer[self.start:self.start + header_size])
+                except ValueError:
+                    raise FrameError("Malformed header")
+            if msg_length < 0 or msg_length > server.MAX_MESSAGE:
+                raise FrameError(f"Message length {msg_length} out of range")
+            if available < header_size + msg_length: # Waits for the rest of the message
+                break
+            payload_start = self.start + header_size
+            self.start = payload_start + msg_length
+            self.frames_in += 1
+            yield kind, self.view[payload_start:self.start]
+
+
+class Outbox:
+    """Bounded queue of encoded messages waiting to be written to one client"""
+    # Senders only ever append here, so a client on a bad link holds up its own writer rather
+    # than everybody behind it in a broadcast. Once the queue holds more than OUTBOX_FRAMES
+    # messages or OUTBOX_BYTES bytes the server's SLOW_POLICY decides what gives:
+    #   "drop_oldest" - the oldest queued messages are thrown away until the queue fits again
+    #   "coalesce"    - the backlog is merged in to one write so nothing is lost, unless it is
+    #                   over the byte limit too, in which case the oldest messages are dropped
+    #   "disconnect"  - the client is dropped
+
+    def __init__(self, server):
+        """Init class for an outbound queue"""
+        # 'server' is the Clicserver holding the limits, policy and counters
+        self.server = server
+        self.frames = deque() #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Encoded messages, oldest first
+        self.size = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Bytes currently queued
+        self.closed = False #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Set once the connection is on its way out
+        self.ready = threading.Condition() #>>>>>>>>>>>>>>>> Wakes the writer when something is queued
+        self.total_frames = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Messages sent to the client over its life, dropped ones included
+        self.total_bytes = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Bytes of those messages
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        """Queues an encoded message. Returns False if the client should be disconnected."""
+        with self.ready:
+            if self.closed: # Nothing more goes to a connection that is closing
+                return True
+            self.frames.append(frame)
+            self.size += len(frame)
+            self.total_frames += 1
+            self.total_bytes += len(frame)
+            if len(self.frames) > self.server.OUTBOX_FRAMES or self.size > self.server.OUTBOX_BYTES:
+                if not self.overflow():
+                    return False
+            self.ready.notify()
+        return True
+
+    def overflow(self):
+        """Applies the slow consumer policy to a full queue. Returns False if the client should be dropped."""
+        policy = self.server.SLOW_POLICY
+        if policy == "disconnect":
+            self.closed = True
+            self.frames.clear()
+            self.size = 0
+            self.ready.notify_all()
+            self.server.count_outbox("disconnected")
+            return False
+        if policy == "coalesce" and self.size <= self.server.OUTBOX_BYTES:
+            self.frames = deque([b"".join(self.frames)])
+            self.server.count_outbox("coalesced")
+            return True
+        while len(self.frames) > 1 and (len(self.frames) > self.server.OUTBOX_FRAMES or self.size > self.server.OUTBOX_BYTES):
+            self.size -= len(self.frames.popleft())
+            self.server.count_outbox("dropped")
+        return True
+
+    def get(self):
+        """Blocks until something is queued and returns it all as one buffer. Returns None once closed and empty."""
+        with self.ready:
+            while not self.frames and not self.closed:
+                self.ready.wait()
+            return self.take_queued()
+
+    def take(self):
+        """Returns everything queued as one buffer without waiting, or None if the queue is empty"""
+        with self.ready:
+            return self.take_queued()
+
+    def take_queued(self):
+        if not self.frames:
+            return None
+        data = self.frames[0] if len(self.frames) == 1 else b"".join(self.frames)
+        self.frames.clear()
+        self.size = 0
+        return data
+
+    def close(self):
+        """Stops new messages being queued. Anything already queued is still handed out."""
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+
+class ClientConnection:
+    """A single client connection served by its own threads (thread mode)"""
+    # Wraps the TLS socket so threaded and async connections look the same to the server:
+    # both carry the client's address, framing version and outbox, and offer sendall/close/abort.
+    # The client thread reads; a writer thread drains the outbox so sends never block the caller.
+
+    def __init__(self, server, sock, addr):
+        """Init class for a threaded client connection"""
+        # 'server' is the Clicserver the connection belongs to
+        # 'sock' is the TLS socket for the client
+        # 'addr' is the socket tuple for the client
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.proto = 1 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Framing version, switched by Clicserver.negotiate()
+        self.decoder = FrameDecoder(server) #>>>>>>>>>>>>>>> Splits what the client sends in to messages
+        self.outbox = Outbox(server) #>>>>>>>>>>>>>>>>>>>>>> Messages waiting for the writer thread
+        self.connected = perf_counter() #>>>>>>>>>>>>>>>>>>> When the TLS handshake finished, to time get_username
+        self.last_heard = time() #>>>>>>>>>>>>>>>>>>>>>>>>>> When the client last sent anything, for the heartbeat
+        self.last_active = self.last_heard #>>>>>>>>>>>>>>>> When the client last sent anything but a KEEPALIVE
+        self.pinged = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> When the unanswered KEEPALIVE was sent, if there is one
+        self.limits = server.rate_limits.buckets() #>>>>>>>> The connection's (messages, bytes) token buckets, None if unlimited
+        self.user_limits = None #>>>>>>>>>>>>>>>>>>>>>>>>>>> The username's token buckets, once registered
+        self.bytes_charged = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> How much of decoder.bytes_in the byte buckets have been charged for
+        self.throttled = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Times reading was paused for going over the rate limits
+        self.strikes = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Times over the limits since the slate was last wiped
+        self.last_strike = 0.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> When they last went over
+        self.over_limits = False #>>>>>>>>>>>>>>>>>>>>>>>>>> Set while they stay over the limits, so one flood is one strike
+        self.paused_until = 0.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>> When reading resumes after going over the limits
+        self.close_timer = None #>>>>>>>>>>>>>>>>>>>>>>>>>>> Aborts the connection if close() can't flush in time
+        self.server.thread_clients.add(self)
+        writer = threading.Thread(name=f"writer {addr}", target=self.writer_handler, daemon=True)
+        writer.start()
+
+    def writer_handler(self):
+        """Drains the outbox in to the socket. A slow client only ever blocks its own writer."""
+        try:
+            while True:
+                data = self.outbox.get() # Blocks until something is queued, returns None once closed and empty
+                if data is None:
+                    break
+                started = perf_counter()
+                self.sock.sendall(data)
+                self.server.stats.timing("sendall", perf_counter() - started)
+        except OSError: # Covers SSL errors, resets and sockets shut down by abort()
+            pass
+        finally:
+            self.outbox.close()
+            if self.close_timer:
+                self.close_timer.cancel()
+            self.server.thread_clients.discard(self)
+            self.server.release_connection()
+            try:
+                self.sock.shutdown(2) # Removes the socket's read/write ability
+            except OSError: # The other end is already gone
+                pass
+            self.sock.close() # Closes the socket
+
+    def sendall(self, data):
+        """Queues bytes for the writer thread. Never blocks the caller."""
+        if not self.outbox.put(data):
+            self.server.evict_slow_consumer(self)
+
+    def fill(self):
+        """Reads what the client has sent in to the decoder. Returns the byte count, 0 if the client hung up."""
+        count = self.decoder.recv_into(self.sock)
+        while count and self.sock.pending(): # TLS can hold decrypted bytes that poll() never reports
+            count += self.decoder.recv_into(self.sock)
+        self.last_heard = time()
+        return count
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        """Closes the connection once anything already queued has been sent, or after CLOSE_TIMEOUT if it can't be"""
+        self.outbox.close() # The writer thread closes the socket after the last queued message
+        if self.close_timer is None: # A client that stopped reading would otherwise keep the writer in sendall() for good
+            self.close_timer = threading.Timer(self.server.CLOSE_TIMEOUT, self.abort)
+            self.close_timer.daemon = True
+            self.close_timer.start()
+
+    def abort(self):
+        """Closes the connection immediately, throwing away anything queued"""
+        self.outbox.close()
+        try:
+            self.sock.shutdown(2) # Unblocks the writer and client threads, which clean up after themselves
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return f"<ClientConnection {self.addr}>"
+
+
+class AsyncClientProtocol(asyncio.BufferedProtocol):
+    """A single client connection served by the asyncio event loop (async mode)"""
+    # Offers the same attributes and sendall/close/abort calls as ClientConnection, so
+    # send_msg, disseminate and disconnect_user don't care which engine is running.
+    # Those calls can come from the server control thread, so they are handed to the loop.
+
+    def __init__(self, server):
+        """Init class for an async client connection"""
+        # 'server' is the Clicserver that owns the event loop
+        self.server = server
+        self.transport = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> TLS transport for the client
+        self.addr = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Socket tuple for the client
+        self.proto = 1 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Framing version, switched by Clicserver.negotiate()
+        self.decoder = FrameDecoder(server) #>>>>>>>>>>>>>>> The transport reads straight in to its buffer
+        self.username = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Set once the user has picked a valid username
+        self.user_timer = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Timer handle that closes the connection after USER_TIMEOUT
+        self.timeout = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Time at which the username wait runs out
+        self.outbox = Outbox(server) #>>>>>>>>>>>>>>>>>>>>>> Messages held back while the transport's buffer is full
+        self.writing_paused = False #>>>>>>>>>>>>>>>>>>>>>>> Set by the transport when its write buffer is full
+        self.reading_paused = False #>>>>>>>>>>>>>>>>>>>>>>> Set while reading is paused for the rate limits
+        self.accepted = perf_counter() #>>>>>>>>>>>>>>>>>>>> The loop builds the protocol on accept, before the TLS handshake
+        self.connected = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> When the TLS handshake finished, to time the username wait
+        self.last_heard = time() #>>>>>>>>>>>>>>>>>>>>>>>>>> When the client last sent anything, for the heartbeat
+        self.last_active = self.last_heard #>>>>>>>>>>>>>>>> When the client last sent anything but a KEEPALIVE
+        self.pinged = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> When the unanswered KEEPALIVE was sent, if there is one
+        self.limits = server.rate_limits.buckets() #>>>>>>>> The connection's (messages, bytes) token buckets, None if unlimited
+        self.user_limits = None #>>>>>>>>>>>>>>>>>>>>>>>>>>> The username's token buckets, once registered
+        self.bytes_charged = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> How much of decoder.bytes_in the byte buckets have been charged for
+        self.throttled = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Times reading was paused for going over the rate limits
+        self.strikes = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Times over the limits since the slate was last wiped
+        self.last_strike = 0.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> When they last went over
+        self.over_limits = False #>>>>>>>>>>>>>>>>>>>>>>>>>> Set while they stay over the limits, so one flood is one strike
+        self.paused_until = 0.0 #>>>>>>>>>>>>>>>>>>>>>>>>>>> When reading resumes after going over the limits
+        self.close_timer = None #>>>>>>>>>>>>>>>>>>>>>>>>>>> Timer handle that aborts the transport if close() can't flush in time
+        self.claiming = False #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Set while the hub decides on a username (sharded mode)
+        server.count_handshake("started")
+
+    def connection_made(self, transport):
+        """Called by the loop once the TLS handshake completes. Starts waiting for a username."""
+        self.transport = transport
+        self.connected = perf_counter()
+        self.transport.set_write_buffer_limits(high=65536) # Past this the transport pauses us and the outbox fills
+        if not self.server.TCP_NODELAY: # asyncio turns Nagle's algorithm off for every connection
+            transport.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+        self.addr = transport.get_extra_info("peername")
+        self.server.record_handshake(perf_counter() - self.accepted, transport.get_extra_info("ssl_object").session_reused)
+        self.server.async_clients.add(self)
+        self.server.log.info(f"[NEW CONNECTION] {self.addr} connected.")
+        self.server.log.debug(f"[ACTIVE CONNECTIONS] {len(self.server.async_clients)}")
+        self.server.log.debug(f"[WAITING FOR USERNAME] Awaiting username from {self.addr}")
+        self.server.send_msg("\n[SERVER] Hello! What is your username?", self)
+        self.timeout = time() + self.server.USER_TIMEOUT
+        self.user_timer = self.server.loop.call_later(self.server.USER_TIMEOUT, self.username_timeout)
+
+    def get_buffer(self, sizehint):
+        """Hands the transport the free end of the decoder's buffer to read in to"""
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        """Called by the transport after reading 'nbytes' in to the buffer. Handles every complete message."""
+        self.decoder.buffer_updated(nbytes)
+        self.last_heard = time()
+        if not self.reading_paused: # Otherwise resume_after_throttle() gets to what's buffered
+            self.handle_messages()
+
+    def handle_messages(self):
+        """Handles every complete message in the buffer, unless the rate limits say to stop"""
+        try:
+            for kind, msg in self.server.decode_messages(self.decoder):
+                if self.transport.is_closing():
+                    break
+                self.message_received(kind, msg)
+                if self.claiming: # The rest waits for the hub to answer, see claim_username()
+                    break
+                pause = self.server.throttle(self) if self.username else 0
+                if pause is None: # Disconnected for flooding
+                    break
+                if pause: # Over the rate limits. Stops reading until the buckets are out of debt, and TCP pushes back.
+                    self.reading_paused = True
+                    self.transport.pause_reading()
+                    self.server.loop.call_later(pause, self.resume_after_throttle)
+                    break
+        except FrameError as err: # Anything else means the stream can't be trusted
+            self.server.log.warning(f"[ERROR] {err} from {self.addr}, closing connection.")
+            self.transport.close()
+
+    def resume_after_throttle(self):
+        """Picks up reading where the rate limits stopped it"""
+        if self.transport.is_closing():
+            return
+        self.reading_paused = False
+        self.transport.resume_reading()
+        self.handle_messages() # Messages that were already read when reading paused
+
+    def message_received(self, kind, msg):
+        """Handles one complete message, either as part of the username handshake or as chat"""
+        if self.username is None:
+            if kind == self.server.MSG_HELLO:
+                self.server.negotiate(self, msg)
+            elif self.server.check_username(msg, self, self.timeout):
+                if self.server.bus: # Other workers' users have a say, and asking them mustn't hold up the loop
+                    self.claim_username(msg)
+                elif self.server.register_user(self, msg, self.addr):
+                    self.user_timer.cancel()
+                    self.username = msg
+            return
+        self.server.process_message(self, self.username, kind, msg)
+
+    def claim_username(self, username):
+        """Asks the hub for a username (sharded mode). Reading stops until it answers, the event loop carries on."""
+        self.claiming = True
+        self.reading_paused = True
+        self.transport.pause_reading()
+        self.server.bus.claim_later(username, lambda granted: self.claimed(username, granted))
+
+    def claimed(self, username, granted):
+        """Finishes registering a username once the hub has answered, then picks up reading again"""
+        server = self.server
+        self.claiming = False
+        if self.transport.is_closing(): # Gone while the hub was deciding, so the name goes back
+            if granted:
+                server.bus.release(username)
+            return
+        if not granted:
+            server.username_taken(username, self)
+        elif not server.user_list.register(self, username, self.addr): # Can't happen while the hub has it, but just in case
+            server.bus.release(username)
+            server.username_taken(username, self)
+        else:
+            server.welcome_user(self, username, self.addr)
+            self.user_timer.cancel()
+            self.username = username
+        self.reading_paused = False
+        self.transport.resume_reading()
+        self.handle_messages() # Messages that were already read when the claim went out
+
+    def username_timeout(self):
+        """Closes the connection if no valid username arrived in time"""
+        self.server.username_timeout(self)
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        """Called by the loop when the connection closes, for any reason"""
+        self.server.async_clients.discard(self)
+        self.server.release_connection()
+        if self.user_timer:
+            self.user_timer.cancel()
+        if self.close_timer:
+            self.close_timer.cancel()
+        if not self.server.shutdown_flag.is_set() and self.server.unregister_user(self):
+            # Still registered means neither the user nor the server closed it on purpose
+            self.server.log.info(f"[ABRUPT DISCONNECT] User \"{self.username}\" ({self.addr}) improperly disconnected.")
+            self.server.disseminate(self, f"\n[DISCONNECT] User \"{self.username}\" has been disconnected by the server")
+
+    def call_in_loop(self, func, *args):
+        """Runs 'func' now if on the event loop thread, otherwise schedules it there"""
+        if self.server.in_loop_thread():
+            func(*args)
+        else:
+            self.server.loop.call_soon_threadsafe(func, *args)
+
+    def sendall(self, data):
+        """Queues bytes for the client. Never blocks the caller."""
+        self.call_in_loop(self.write_frame, data)
+
+    def write_frame(self, data):
+        """Writes straight to the transport unless it is backed up, in which case the outbox takes it"""
+        if self.transport.is_closing():
+            return
+        if self.writing_paused or self.outbox:
+            if not self.outbox.put(data):
+                self.server.evict_slow_consumer(self)
+        else:
+            self.outbox.total_frames += 1 # Only ever touched on the loop thread
+            self.outbox.total_bytes += len(data)
+            self.write(data)
+
+    def write(self, data):
+        """Hands bytes to the transport, timing it as a sendall"""
+        started = perf_counter()
+        self.transport.write(data)
+        self.server.stats.timing("sendall", perf_counter() - started)
+
+    def pause_writing(self):
+        """Called by the transport when its write buffer passes the high-water mark"""
+        self.writing_paused = True
+
+    def resume_writing(self):
+        """Called by the transport once its write buffer has drained"""
+        self.writing_paused = False
+        self.flush_outbox()
+
+    def flush_outbox(self):
+        """Moves queued messages on to the transport until it pushes back again"""
+        while not self.writing_paused and not self.transport.is_closing():
+            data = self.outbox.take()
+            if data is None:
+                break
+            self.write(data)
+        if self.outbox.closed and not self.outbox: # close() was waiting for the outbox to empty
+            self.transport.close()
+
+    def close(self):
+        """Closes the transport once anything already queued has been sent"""
+        self.call_in_loop(self.close_after_flush)
+
+    def close_after_flush(self):
+        self.outbox.close()
+        if not self.outbox: # Otherwise flush_outbox() closes the transport once the queue is empty
+            self.transport.close()
+        if self.close_timer is None: # Either way a client that stopped reading never lets it finish
+            self.close_timer = self.server.loop.call_later(self.server.CLOSE_TIMEOUT, self.transport.abort)
+
+    def abort(self):
+        """Closes the transport immediately, throwing away anything queued"""
+        self.call_in_loop(self.transport.abort)
+
+    def __repr__(self):
+        return f"<AsyncClientProtocol {self.username or ''} {self.addr}>"
+
+
 if __name__ == "__main__":
-    clic = Clicserver() #>>> Instantiate a Clicserver on port 33333
+    parser = argparse.ArgumentParser(description="CLIc (Command Line Interface chat) server")
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread",
+                        help="'thread' runs a thread per client, 'async' serves every client from one asyncio event loop")
+    parser.add_argument("--slow-policy", choices=["drop_oldest", "coalesce", "disconnect"], default="drop_oldest",
+                        help="what to do when a client can't keep up with its outbound queue")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of server processes sharing the port, to use more than one core (Linux only)")
+    parser.add_argument("--history-dir", default="history",
+                        help="directory for the message history log, or '' to keep history in memory only")
+    parser.add_argument("--offline-db", default="offline.db",
+                        help="SQLite file that keeps DMs for offline users until they're back, or '' to refuse them")
+    parser.add_argument("--stats-socket", default=None,
+                        help="Unix socket path that hands out the server stats as JSON, for scraping")
+    parser.add_argument("--host", default=None, help="IP to listen on (default: this host's IP)")
+    parser.add_argument("--port", type=int, default=33333, help="port to listen on")
+    parser.add_argument("--certfile", default="acme_chain.pem", help="TLS certificate chain")
+    parser.add_argument("--keyfile", default="acme_key.pem", help="TLS private key")
+    parser.add_argument("--heartbeat", type=float, default=30,
+                        help="seconds a user can be quiet before they must answer a KEEPALIVE, 0 to turn heartbeats off")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="disconnect users who haven't sent a message in this many seconds (default: never)")
+    parser.add_argument("--msg-rate", type=float, default=None,
+                        help="messages per second each user can send, with bursts of 3 seconds' worth (default: no limit)")
+    parser.add_argument("--byte-rate", type=float, default=None,
+                        help="bytes per second each user can send, with bursts of 3 seconds' worth (default: no limit)")
+    parser.add_argument("--rate-disconnect", type=int, default=None,
+                        help="disconnect users who go over --msg-rate or --byte-rate this many times in a minute")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="don't offer clients compression of large messages")
+    parser.add_argument("--log-level", choices=("debug", "info", "warning", "error"), default="info",
+                        help="least important log lines to write (default: info)")
+    parser.add_argument("--log-file", default=None,
+                        help="also write the log to this file, rotated by size (console then only gets warnings and errors)")
+    parser.add_argument("--log-max-bytes", type=int, default=10485760,
+                        help="size at which the log file is rotated (default: 10MB)")
+    parser.add_argument("--log-backups", type=int, default=5,
+                        help="rotated log files to keep (default: 5)")
+    parser.add_argument("--user-timeout", type=float, default=30,
+                        help="seconds a new connection gets to pick a username (default: 30)")
+    # The socket profile
+    parser.add_argument("--backlog", type=int, default=1024,
+                        help="connections the kernel queues for accept(), capped by net.core.somaxconn (default: 1024)")
+    parser.add_argument("--no-nodelay", action="store_true",
+                        help="leave Nagle's algorithm on (it's off by default, as every message is written whole)")
+    parser.add_argument("--send-buffer", type=int, default=None, help="SO_SNDBUF for each connection, in bytes (default: OS)")
+    parser.add_argument("--recv-buffer", type=int, default=None, help="SO_RCVBUF for each connection, in bytes (default: OS)")
+    parser.add_argument("--tcp-keepalive", type=int, default=None,
+                        help="idle seconds before the kernel starts probing a connection (default: no probes)")
+    parser.add_argument("--tcp-keepalive-interval", type=int, default=10, help="seconds between keepalive probes (default: 10)")
+    parser.add_argument("--tcp-keepalive-probes", type=int, default=3,
+                        help="unanswered keepalive probes before the connection is dropped (default: 3)")
+    parser.add_argument("--max-connections", type=int, default=None,
+                        help="connections open at once, per worker; more are reset before the TLS handshake (default: no cap)")
+    parser.add_argument("--accept-batch", type=int, default=64,
+                        help="most connections accepted each time the listening socket wakes up (default: 64)")
+    parser.add_argument("--config", default=None,
+                        help="JSON file of settings keyed by the options above, e.g. {\"backlog\": 4096, \"mode\": \"async\"}."
+                             " Options given on the command line win.")
+    args = parser.parse_args()
+    if args.config: # The file's settings go in front of the command line, so argparse checks them and the command line wins
+        with open(args.config) as config_file:
+            settings = {key.replace("-", "_"): value for key, value in json.load(config_file).items()}
+        unknown = sorted(key for key in settings if key not in vars(args) or key == "config")
+        if unknown:
+            parser.error(f"unknown settings in {args.config}: {', '.join(unknown)}")
+        config_args = []
+        for key, value in settings.items():
+            flag = "--" + key.replace("_", "-")
+            if value is True: # Switches like "no-compression": true
+                config_args.append(flag)
+            elif value is not None and value is not False: # null and false leave the default alone
+                config_args.append(f"{flag}={value}")
+        args = parser.parse_args(config_args + sys.argv[1:])
+    clic = Clicserver(mode=args.mode, slow_policy=args.slow_policy, workers=args.workers,
+                      history_dir=args.history_dir or None, stats_socket=args.stats_socket,
+                      host=args.host, port=args.port, certfile=args.certfile, keyfile=args.keyfile,
+                      heartbeat=args.heartbeat, idle_timeout=args.idle_timeout,
+                      msg_rate=args.msg_rate, byte_rate=args.byte_rate, rate_disconnect=args.rate_disconnect,
+                      compression=not args.no_compression, log_level=args.log_level, log_file=args.log_file,
+                      log_max_bytes=args.log_max_bytes, log_backups=args.log_backups, user_timeout=args.user_timeout,
+                      backlog=args.backlog, nodelay=not args.no_nodelay, send_buffer=args.send_buffer,
+                      recv_buffer=args.recv_buffer, tcp_keepalive=args.tcp_keepalive,
+                      tcp_keepalive_interval=args.tcp_keepalive_interval, tcp_keepalive_probes=args.tcp_keepalive_probes,
+                      max_connections=args.max_connections, accept_batch=args.accept_batch,
+                      offline_db=args.offline_db or None) #>>> Instantiate a Clicserver on port 33333
     clic.start_server() #>>>>>>>> Start the server
     clic.server_control() #>>>>>> Start the server controls
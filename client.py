@@ -1,21 +1,72 @@
 #! /usr/bin/python3
 
-import socket
+"""CLIc client. Run it to chat, or import ClicClient to drive a connection from code:
+
+    async with ClicClient("sub.domain.tld") as client:
+        await client.register("bot")
+        client.send("Hello everyone!")
+        async for message in client:
+            print(message.text)
+"""
+
+import asyncio
+import collections
+import random
 import ssl
-import threading
+import struct
 import sys
-import traceback
+import threading
+import zlib
 
 HEADER = 64 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Size in bytes of header used to communicate message size
 PORT = 33333 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Port the server will run on (integer, not string)
-HOSTNAME = "sub.domain.tld" #>>>>>>>>>>>>>>>>> Returns the hostname of the host chat server is running on
-server = socket.gethostbyname(HOSTNAME) #>>>>>> Returns the server's IP address
-# server = '10.10.10.10' #>>>>>>>>>>>>>>>>>>>>> Alternatively you can enter a specific IP
-ADDR = (server, PORT) #>>>>>>>>>>>>>>>>>>>>>>>> Tuple holding socket info
+HOSTNAME = "sub.domain.tld" #>>>>>>>>>>>>>>>>> Hostname of the chat server, resolved when connecting
+# HOSTNAME = '10.10.10.10' #>>>>>>>>>>>>>>>>>>> Alternatively you can enter a specific IP
 FORMAT = 'utf-8' #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> self.FORMAT text will be transmitted in
 DISCONNECT_MESSAGE = "#!@!DISCONNECT!@!#" #>>>> Message the client will send to disconnect
 KEEPALIVE = "#!@!KEEPALIVE!@!#" #>>>>>>>>>>>>>> Message sent to client to confirm socket is up
 GIVECLIENTS = "#!@!GIVECLIENT!@!#" #>>>>>>>>>>> Message triggers server to send client list
+HELLO = "#!@!HELLO!@!#" #>>>>>>>>>>>>>>>>>>>>>> Offers the server newer framing during the username handshake
+PROTO_VERSION = 3 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Newest framing version the client speaks. v3 is v2 plus compression.
+NEGOTIATE_TIMEOUT = 5 #>>>>>>>>>>>>>>>>>>>>>>>> Seconds to wait for the server to answer HELLO before sticking with v1
+REGISTER_TIMEOUT = 30 #>>>>>>>>>>>>>>>>>>>>>>>> Seconds to wait for the server to accept or refuse a username
+V2_HEADER = struct.Struct("!BI") #>>>>>>>>>>>>> v2 header: 1 byte message type, 4 byte big-endian length
+# v2 message types, matching clic-server.py
+MSG_CHAT = 1 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Chat line (also the username during the handshake)
+MSG_DM = 2 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Direct message
+MSG_SERVER = 3 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Notice from the server
+MSG_DISCONNECT = 4 #>>>>>>>>>>>>>>>>>>>>>>>>>>> Disconnect request to the server, or disconnect notice from it
+MSG_KEEPALIVE = 5 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Heartbeat from the server, answered with one back
+MSG_USERLIST = 6 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> User list request to the server, or the list sent back
+MSG_CHANNEL = 8 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Channel command (/join, /leave or /channels)
+MSG_PRESENCE = 9 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Presence subscription ("on" or "off"), or a roster update from the server
+CHANNEL_COMMANDS = ("/join", "/leave", "/channels", "/history") # Commands sent as MSG_CHANNEL
+MAX_MESSAGE = 16777216 #>>>>>>>>>>>>>>>>>>>>>>> Largest message accepted from the server, in bytes
+RECV_BUFFER = 65536 #>>>>>>>>>>>>>>>>>>>>>>>>>> Starting size of the receive buffer (grows as needed)
+COMPRESSED = 0x80 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> v3 flag on the type byte: the payload is deflated with COMPRESS_DICT
+COMPRESS_MIN = 256 #>>>>>>>>>>>>>>>>>>>>>>>>>>> Messages this size or smaller always go out uncompressed, in bytes
+COMPRESS_DICT = ( # Preset deflate dictionary of things chat is full of. Must match clic-server.py.
+    b"Traceback (most recent call last):\n  File \"\", line , in \n    def __init__(self, return None import from "
+    b"https://www.github.com/ http://localhost .com/ .org/ .py .txt error Error: exception warning failed "
+    b"because about after again already also always any anyone anything around back before being could "
+    b"didn't does doesn't don't even every first from going good got great have here how into it's just "
+    b"know let's like look make maybe more much need never new now only other people please pretty really "
+    b"right said see should since some something still sure than thanks that's their them then there these "
+    b"they thing think this those though time today too try want was way well were what when where which "
+    b"while who why will with work would yeah yes you you're your lol haha ok okay hey hi hello "
+    b"[CHANNEL] You joined #. Your messages go there now.\n[HISTORY] The last  messages in #Current users are:"
+    b"\n[SERVER] \n[DISCONNECT] User \" has been disconnected by the server has disconnected.\n"
+    b"[NEW CONNECTION]  has joined the chat\n\n[*DM*] [#lobby  the  and  to  of  a  in  is  that  for  it  I  "
+    b"you  on  be  with  not  but  so  do  if  can  what  this  are  was  have  just  ]: "
+)
+INBOX_FRAMES = 10000 #>>>>>>>>>>>>>>>>>>>>>>>>> Received messages held for the reader before the client stops reading
+PENDING_FRAMES = 1000 #>>>>>>>>>>>>>>>>>>>>>>>> Messages held while reconnecting (the oldest are dropped past this)
+WRITE_BUFFER = 262144 #>>>>>>>>>>>>>>>>>>>>>>>> Bytes queued on the socket before drain() makes senders wait
+RECONNECT_DELAY = 0.5 #>>>>>>>>>>>>>>>>>>>>>>>> Seconds before the first reconnect attempt, doubled each attempt
+RECONNECT_MAX_DELAY = 30 #>>>>>>>>>>>>>>>>>>>>> Longest wait between reconnect attempts, in seconds
+# Server notices that answer a username attempt
+WELCOME = "[SERVER] Welcome, "
+USERNAME_REFUSALS = ("is currently in use", "with less than 64 characters", "Any username.", "other control characters.")
 context = ssl.create_default_context() #>>>>>>> Context wrapper to apply TLS over sockets
 
 # !*!*!*!*!* WARNING: INSECURE! For testing/dev use only! *!*!*!*!*!
@@ -23,100 +74,475 @@ context = ssl.create_default_context() #>>>>>>> Context wrapper to apply TLS ove
 # context.verify_mode = ssl.CERT_NONE
 # context.check_hostname = False
 
-disconnect = threading.Event() # Event object to signal when a disconnect has triggered
+# A message from the server. 'kind' is the v2 message type, None on a v1 server.
+Message = collections.namedtuple("Message", "kind text")
 
 
+class UsernameRefused(Exception):
+    """ The server wouldn't take the username. The reason is the server's message. """
 
-def send_msg(msg):
-    """ Function that sends the user's message """
-    try:
-        message = msg.encode(FORMAT) # Encode the message in the format specified above
-        msg_length = len(message) # Calculate the length of the message
-        send_length = str(msg_length).encode(FORMAT) # Encode that
-        send_length += b' ' * (HEADER - len(send_length)) # Pad the remaining bits in the header
-        tlsclient.sendall(send_length) # Send the length header
-        tlsclient.sendall(message) # Send the message
-        return True
-    except Exception as err:
-        handle_error(err)
-
-def handle_error(err):
-    """ Does what it says on the tin """
-    if disconnect.is_set(): # If the user or server requested disconnect, no need to worry
-        return None
-    if err.args[0] != 9: # I can't remember what this specific error was but it happened too often
-        print('[UNEXPECTED ERROR]', err)
-        print(traceback.format_exc())
-        sys.exit()
-    else:
-        print("\n[ERROR: ABRUPT DISCONNECT] Connection to CLIc broke unexpectedly")
-        print(traceback.format_exc())
-        sys.exit()
 
-def receive_messages(conn):
-    "Handles message reception"
-    while True:
-        try: 
-            msg_length = conn.recv(HEADER).decode(FORMAT) # Receives the header detailing the message length
-            if msg_length == '': # if the message length is blank, ignore it
+class ClicClient:
+    """ One connection to a CLIc server, for people and bots alike """
+    # Everything runs on the asyncio event loop, so a script can hold many clients without a
+    # thread each. send() frames a message and hands it straight to the socket without waiting
+    # for anything, so many messages can be in flight (pipelined) at once; await drain() now and
+    # then when sending a lot. Messages from the server come out of 'async for message in client'.
+    # If the connection drops after register(), the client reconnects with jittered exponential
+    # backoff and registers the same username again, holding messages sent in the meantime.
+
+    def __init__(self, host=HOSTNAME, port=PORT, ssl_context=None, reconnect=True, compression=True):
+        """ Init class for a CLIc client """
+        # 'host' and 'port' are the server to connect to
+        # 'ssl_context' is the TLS context, the module's 'context' by default
+        # 'reconnect' turns automatic reconnection on or off
+        # 'compression' offers the server framing v3, so large messages are compressed both ways
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context or context
+        self.reconnect = reconnect
+        self.offer = PROTO_VERSION if compression else 2 # Framing version offered in HELLO
+        self.protocol = None #>>>>>>>>>>>>>>>>>>>>>>>>>>> ClicProtocol for the live connection, None while disconnected
+        self.proto = 1 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Framing version in use, switched once the server answers HELLO
+        self.username = None #>>>>>>>>>>>>>>>>>>>>>>>>>>> Set once the server accepts a username
+        self.registered = False #>>>>>>>>>>>>>>>>>>>>>>>> True while the server knows this connection by 'username'
+        self.closing = False #>>>>>>>>>>>>>>>>>>>>>>>>>>> Set by close(), stops any reconnecting
+        self.ended = False #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Set when the server disconnects us on purpose
+        self.done = False #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Set once the client has stopped for good
+        self.negotiated = None #>>>>>>>>>>>>>>>>>>>>>>>>> Future resolved when the server answers HELLO
+        self.answer = None #>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Future resolved when the server answers a username
+        self.reconnecting = None #>>>>>>>>>>>>>>>>>>>>>>> Task running reconnect_loop(), while one is
+        self.inbox = asyncio.Queue() #>>>>>>>>>>>>>>>>>>> Messages waiting for the reader, None once the client is done
+        self.pending = collections.deque(maxlen=PENDING_FRAMES) # (text, kind) sent while reconnecting, sent on re-registering
+        self.reconnects = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Successful reconnects over the client's life
+        self.dropped = 0 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Messages dropped from a full 'pending'
+        self.presence = False #>>>>>>>>>>>>>>>>>>>>>>>>>>> Set by subscribe_presence(), kept across reconnects
+        self.roster = set() #>>>>>>>>>>>>>>>>>>>>>>>>>>>> Usernames online, kept up to date while subscribed to presence
+        self.presence_version = None #>>>>>>>>>>>>>>>>>>> Version of the last presence update applied, None while waiting for the roster
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """ Returns the next Message from the server, waiting for one if need be """
+        message = await self.inbox.get()
+        if message is None: # The client is done. Left in place so every reader stops.
+            self.inbox.put_nowait(None)
+            raise StopAsyncIteration
+        if self.protocol and self.protocol.reading_paused and self.inbox.qsize() < INBOX_FRAMES // 2:
+            self.protocol.resume_reading()
+        return message
+
+    async def connect(self):
+        """ Opens the TLS connection and settles the framing version. Call register() next. """
+        loop = asyncio.get_running_loop()
+        self.negotiated = loop.create_future()
+        transport, protocol = await loop.create_connection(lambda: ClicProtocol(self), self.host, self.port,
+                                                           ssl=self.ssl_context, server_hostname=self.host)
+        self.protocol = protocol
+        self.proto = protocol.decoder.proto = 1
+        transport.write(frame_v1(f"{HELLO} {self.offer}".encode(FORMAT))) # Offers newer framing before anything else
+        try:
+            await asyncio.wait_for(asyncio.shield(self.negotiated), NEGOTIATE_TIMEOUT)
+        except asyncio.TimeoutError: # No answer to HELLO, so this server only speaks v1
+            pass
+
+    @property
+    def peercert(self):
+        """ The server's certificate, None while disconnected """
+        return self.protocol.transport.get_extra_info("peercert") if self.protocol else None
+
+    async def register(self, username):
+        """ Asks the server for a username. Raises UsernameRefused with the server's reason if it says no. """
+        # The server gives another try after a refusal, until its username timeout runs out
+        if not self.protocol:
+            raise ConnectionError("Not connected")
+        self.answer = asyncio.get_running_loop().create_future()
+        self.protocol.transport.write(self.frame(username, MSG_CHAT))
+        await asyncio.wait_for(asyncio.shield(self.answer), REGISTER_TIMEOUT)
+        self.username = username
+        self.registered = True
+        if self.presence: # A new connection starts without a subscription
+            self.subscribe_presence()
+        while self.pending: # Whatever was sent while the connection was down
+            self.send(*self.pending.popleft())
+
+    def frame(self, text, kind=MSG_CHAT):
+        """ Encodes and frames one message for the framing version in use """
+        # v1 servers get the magic strings instead of message types
+        message = text.encode(FORMAT)
+        if self.proto >= 2:
+            if self.proto == 3 and len(message) > COMPRESS_MIN:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=COMPRESS_DICT)
+                data = compressor.compress(message) + compressor.flush()
+                if len(data) < len(message):
+                    return V2_HEADER.pack(kind | COMPRESSED, len(data)) + data
+            return V2_HEADER.pack(kind, len(message)) + message
+        if kind == MSG_DISCONNECT:
+            message = DISCONNECT_MESSAGE.encode(FORMAT)
+        elif kind == MSG_USERLIST:
+            message = GIVECLIENTS.encode(FORMAT)
+        return frame_v1(message)
+
+    def send(self, text, kind=MSG_CHAT):
+        """ Sends a message without waiting. Held until the client is registered again if the connection is down. """
+        if self.registered:
+            self.protocol.transport.write(self.frame(text, kind))
+        elif not (self.closing or self.ended):
+            if len(self.pending) == PENDING_FRAMES:
+                self.dropped += 1
+            self.pending.append((text, kind)) # A full deque drops its oldest
+        else:
+            raise ConnectionError("The client is closed")
+
+    def send_many(self, messages, kind=MSG_CHAT):
+        """ Sends several messages of one type in a single write """
+        if not self.registered:
+            for text in messages:
+                self.send(text, kind)
+            return
+        self.protocol.transport.write(b"".join(self.frame(text, kind) for text in messages))
+
+    def dm(self, username, text):
+        """ Sends a direct message to one user """
+        self.send(f"/dm {username} {text}", MSG_DM)
+
+    def subscribe_presence(self):
+        """ Keeps 'roster' up to date with who is online. Presence messages also come out of 'async for'. """
+        # Needs a server that speaks framing v2 or newer, v1 servers don't send presence updates
+        self.presence = True
+        self.presence_version = None
+        if self.registered and self.proto >= 2: # Otherwise register() subscribes
+            self.send("on", MSG_PRESENCE)
+
+    def unsubscribe_presence(self):
+        """ Stops the presence updates. 'roster' is left as it was. """
+        self.presence = False
+        if self.registered and self.proto >= 2:
+            self.send("off", MSG_PRESENCE)
+
+    def presence_update(self, msg):
+        """ Applies a presence update to 'roster', subscribing again if an update was missed """
+        # The first line is "<version> <change>", where the change is "=" for the whole roster, "+" for
+        # users who joined or "-" for users who left, and the usernames follow one per line.
+        head, _, names = msg.partition("\n")
+        version, change = head.split(" ", 1)
+        version = int(version)
+        names = names.split("\n") if names else []
+        if change == "=":
+            self.roster = set(names)
+        elif self.presence_version is None: # Still waiting for the roster
+            return
+        elif version != self.presence_version + 1: # Missed an update, so the roster can't be trusted
+            self.subscribe_presence()
+            return
+        elif change == "+":
+            self.roster.update(names)
+        else:
+            self.roster.difference_update(names)
+        self.presence_version = version
+
+    def command(self, line):
+        """ Sends a line typed the way a user would, e.g. '/join python', as the right message type """
+        if line == "/u" or line.startswith("/u "): # '/u 2' asks for the second page
+            self.send(line[3:], MSG_USERLIST)
+        elif line[0:3] == "/dm":
+            self.send(line, MSG_DM)
+        elif line.split(" ", 1)[0] in CHANNEL_COMMANDS:
+            self.send(line, MSG_CHANNEL)
+        else:
+            self.send(line)
+
+    async def drain(self):
+        """ Waits until the socket has room for more. Call it now and then when sending a lot. """
+        if self.protocol:
+            await self.protocol.writable.wait()
+
+    async def close(self, timeout=5):
+        """ Says goodbye to the server, if registered, and closes the connection. Stops any reconnecting. """
+        self.closing = True
+        if self.reconnecting:
+            self.reconnecting.cancel()
+        protocol = self.protocol
+        if protocol:
+            if self.registered:
+                protocol.transport.write(self.frame("", MSG_DISCONNECT))
+                try: # The server closes the connection once it has sent its goodbye
+                    await asyncio.wait_for(asyncio.shield(protocol.closed), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            protocol.transport.abort()
+        self.finish()
+
+    def finish(self):
+        """ Marks the client done, which ends 'async for' loops once the messages before it are read """
+        self.registered = False
+        if not self.done:
+            self.done = True
+            self.inbox.put_nowait(None)
+
+    def message_received(self, protocol, kind, payload):
+        """ Handles one complete message from the server, read by 'protocol' """
+        if kind and kind & COMPRESSED:
+            kind &= ~COMPRESSED
+            payload = zlib.decompressobj(-15, zdict=COMPRESS_DICT).decompress(payload, MAX_MESSAGE)
+        msg = str(payload, FORMAT, "replace")
+        if kind is None and msg.startswith(HELLO): # The server's answer to HELLO. Everything after it uses that version.
+            self.proto = protocol.decoder.proto = int(msg.split()[1])
+            if not self.negotiated.done():
+                self.negotiated.set_result(self.proto)
+            return
+        if kind == MSG_KEEPALIVE or msg == KEEPALIVE: # The server checking we're still here. Answering is all it needs.
+            protocol.transport.write(self.frame(KEEPALIVE, MSG_KEEPALIVE))
+            return
+        if self.answer and not self.answer.done():
+            if WELCOME in msg:
+                self.answer.set_result(True)
+            elif any(refusal in msg for refusal in USERNAME_REFUSALS):
+                self.answer.set_exception(UsernameRefused(msg.strip()))
+        if kind == MSG_PRESENCE:
+            self.presence_update(msg)
+        if kind == MSG_DISCONNECT or "[DISCONNECTED]" in msg[1:18]: # The server is closing the connection on purpose
+            self.ended = True
+            self.registered = False
+        self.inbox.put_nowait(Message(kind, msg))
+        if self.inbox.qsize() >= INBOX_FRAMES: # Lets TCP push back on the server until the reader catches up
+            protocol.pause_reading()
+
+    def connection_lost(self, protocol):
+        """ Called when the connection closes. Starts reconnecting if it wasn't meant to close. """
+        if protocol is not self.protocol:
+            return
+        self.protocol = None
+        was_registered, self.registered = self.registered, False
+        for waiter in (self.negotiated, self.answer):
+            if waiter and not waiter.done():
+                waiter.set_exception(ConnectionError("Connection closed"))
+        if self.reconnecting: # A reconnect attempt failed, reconnect_loop() will try again
+            return
+        if was_registered and self.reconnect and not (self.closing or self.ended):
+            self.inbox.put_nowait(Message(MSG_SERVER, "\n[RECONNECTING] Lost the connection to the server, reconnecting..."))
+            self.reconnecting = asyncio.ensure_future(self.reconnect_loop())
+        else:
+            self.finish()
+
+    async def reconnect_loop(self):
+        """ Reconnects and registers the username again, waiting longer after each failed attempt """
+        # Each wait is random between zero and the backoff ("full jitter"), so a crowd of clients
+        # dropped at the same moment doesn't come back at the same moment.
+        attempt = 0
+        try:
+            while not self.closing:
+                await asyncio.sleep(random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** attempt)))
+                attempt += 1
+                try:
+                    await self.connect()
+                    await self.register(self.username)
+                except (OSError, ssl.SSLError, asyncio.TimeoutError, UsernameRefused): # OSError covers ConnectionError
+                    if self.protocol:
+                        self.protocol.transport.abort()
+                    continue
+                self.reconnects += 1
+                return
+        finally:
+            self.reconnecting = None
+            if not self.registered and not self.protocol:
+                self.finish()
+
+
+class ClicProtocol(asyncio.BufferedProtocol):
+    """ The transport side of a ClicClient connection """
+    # The transport reads straight in to the FrameDecoder's buffer, and every complete
+    # message is handed to the client. Matches AsyncClientProtocol in clic-server.py.
+
+    def __init__(self, client):
+        self.client = client
+        self.transport = None #>>>>>>>>>>>>>>>>>>>>>>>>>> TLS transport to the server
+        self.decoder = FrameDecoder() #>>>>>>>>>>>>>>>>>> The transport reads straight in to its buffer
+        self.writable = asyncio.Event() #>>>>>>>>>>>>>>>> Cleared while the transport's write buffer is full
+        self.writable.set()
+        self.reading_paused = False #>>>>>>>>>>>>>>>>>>>> Set while the client's inbox is full
+        self.closed = asyncio.get_running_loop().create_future() # Resolved once the connection closes
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=WRITE_BUFFER)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        try:
+            for kind, payload in self.decoder.frames():
+                self.client.message_received(self, kind, payload)
+        except (ValueError, zlib.error) as err: # The stream can't be trusted after a bad header or a corrupt compressed message
+            print("[ERROR]", err)
+            self.transport.abort()
+
+    def pause_reading(self):
+        if not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        self.reading_paused = False
+        self.transport.resume_reading()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def connection_lost(self, exc):
+        self.writable.set() # Nobody waits in drain() on a dead connection
+        self.closed.set_result(exc)
+        self.client.connection_lost(self)
+
+
+def frame_v1(message):
+    """ Puts the 64 byte length header in front of an encoded message """
+    msg_length = len(message) # Calculate the length of the message
+    send_length = str(msg_length).encode(FORMAT) # Encode that
+    send_length += b' ' * (HEADER - len(send_length)) # Pad the remaining bits in the header
+    return send_length + message
+
+class FrameDecoder:
+    """ Incrementally splits the byte stream from the server in to complete messages """
+    # One read can hold half a message or several, so bytes are read straight in to a
+    # preallocated buffer (get_buffer, for asyncio) and frames() yields each complete message
+    # as a memoryview of it. Nothing is copied until the text is decoded. Matches clic-server.py.
+
+    def __init__(self):
+        self.proto = 1 # Framing version, switched once the server answers HELLO
+        self.buffer = bytearray(RECV_BUFFER) # Receive buffer
+        self.view = memoryview(self.buffer) # View of the buffer that frames are sliced from
+        self.start = 0 # First byte not yet handed out as part of a frame
+        self.end = 0 # End of the bytes received so far
+
+    def recv_into(self, sock):
+        """ Reads whatever the socket has in to the buffer. Returns the byte count, 0 if the server hung up. """
+        count = sock.recv_into(self.get_buffer())
+        self.end += count
+        return count
+
+    def get_buffer(self, sizehint=-1):
+        """ Returns a writable view of the free end of the buffer (asyncio.BufferedProtocol interface) """
+        self.make_room()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """ Records 'nbytes' written in to the view from get_buffer() (asyncio.BufferedProtocol interface) """
+        self.end += nbytes
+
+    def make_room(self, min_free=1024):
+        """ Frees space at the end of the buffer, moving a partial frame to the front or growing the buffer """
+        if self.start == self.end: # Everything has been handed out, so start again from the front
+            self.start = self.end = 0
+        elif self.start and len(self.buffer) - self.end < min_free:
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start, self.end = 0, remaining
+        if len(self.buffer) - self.end < min_free: # A message bigger than the buffer is on its way
+            buffer = bytearray(max(len(self.buffer) * 2, self.end + min_free))
+            buffer[:self.end] = self.view[:self.end]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+
+    def frames(self):
+        """ Yields (type, payload) for every complete frame in the buffer. v1 frames have no type (None). """
+        while True: # The framing version is checked per frame as the HELLO answer switches it
+            available = self.end - self.start
+            if self.proto >= 2: # v3 only adds the COMPRESSED flag
+                header_size = V2_HEADER.size
+                if available < header_size:
+                    break
+                kind, msg_length = V2_HEADER.unpack_from(self.buffer, self.start)
+            else:
+                header_size = HEADER
+                if available < header_size:
+                    break
+                kind = None
+                msg_length = int(self.buffer[self.start:self.start + header_size])
+            if msg_length < 0 or msg_length > MAX_MESSAGE:
+                raise ValueError(f"Message length {msg_length} out of range")
+            if available < header_size + msg_length: # Waits for the rest of the message
                 break
-            msg_length = int(msg_length) # Determine message length from headerr
-            msg = conn.recv(msg_length).decode(FORMAT) # Receive a message of that length
-            print(msg)
-            if "[DISCONNECTED]" in msg[1:18]: # If the client has been disconnected, or chose to, close connection
-                conn.shutdown(2)
-                conn.close()
-                disconnect.set()
-                print("[DISCONNECTED] Press 'Enter' to quit")
-                return False
-            if msg == KEEPALIVE: # If it's a keepalive message checking in, just carry on
-                continue
-        except Exception as err:
-            handle_error(err)
+            payload_start = self.start + header_size
+            self.start = payload_start + msg_length
+            yield kind, self.view[payload_start:self.start]
 
 def get_help():
     """Prints all the available server commands"""
     print("\nAvailable commands are:")
     print("'/q' ......... Shutdown (quit) server")
-    print("'/u' ......... See who is online")
+    print("'/u [page]' .. See who is online, all at once or a page at a time")
+    print("'/dm' ........ Message one user: /dm <username> <message>")
+    print("'/join' ...... Join a channel and talk there: /join <channel>")
+    print("'/leave' ..... Leave a channel: /leave [channel]")
+    print("'/channels' .. See every channel")
+    print("'/history' ... See older messages in your channel: /history [count]")
     print("\n")
     return None
 
-def client_input():
+def read_input(loop, lines):
+    """ Hands each line typed to the event loop. Runs in its own thread as input() blocks. """
     while True:
-        speak = input()
-        if disconnect.is_set():
-            sys.exit()
-        if speak == "":
-            get_help()
-        if speak == "/q":
-            send_msg(DISCONNECT_MESSAGE)
-            print("\nDisconnecting. Goodbye!")
-        if speak == "/u":
-            send_msg(GIVECLIENTS)
+        try:
+            speak = input()
+        except EOFError:
+            speak = None
+        loop.call_soon_threadsafe(lines.put_nowait, speak)
+        if speak is None:
+            return
 
-        else:
-            send_msg(speak)
-            continue
+async def print_messages(client, lines):
+    """ Prints everything the server sends until the client is done """
+    async for message in client:
+        print(message.text)
+    lines.put_nowait(None) # Wakes the input loop so it can stop
 
-def check_disco():
+async def main():
+    client = ClicClient(HOSTNAME, PORT)
     try:
-        while True:
-            if disconnect.is_set():
-                tlsclient.shutdown(2) # Removes the socket's read/write ability
-                tlsclient.close() # Closes the socket
-                sys.exit()
-    except Exception as err:
-        handle_error(err)
-
-# TLS context "wraps" the socket an all operations are performed on the new TLS socket.
-tlsclient = context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), server_hostname=HOSTNAME)
-tlsclient.connect(ADDR)
-print(tlsclient.getpeercert())
-
-# Creates a thread to listen for and print messages from the server
-server_listen = threading.Thread(name="listen",target=receive_messages, args=(tlsclient,), daemon=True)
-server_listen.start()
+        await client.connect()
+    except (OSError, ssl.SSLError) as err:
+        print("[ERROR: CONNECTION FAILED]", err)
+        return
+    print(client.peercert)
+    lines = asyncio.Queue()
+    threading.Thread(name="input", target=read_input, args=(asyncio.get_running_loop(), lines), daemon=True).start()
+    printer = asyncio.ensure_future(print_messages(client, lines))
+    while True:
+        speak = await lines.get()
+        if speak is None: # The server hung up, or input ended
+            break
+        if speak == "/q":
+            print("\nDisconnecting. Goodbye!")
+            break
+        if client.username is None: # Still picking a username. The server explains any refusal.
+            try:
+                await client.register(speak)
+            except (UsernameRefused, asyncio.TimeoutError, ConnectionError):
+                pass
+        elif speak == "":
+            get_help()
+        else:
+            client.command(speak)
+    await client.close()
+    await printer
 
-client_input()
 
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        sys.exit()
@@ -0,0 +1,46 @@
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT) # So the tests can import client.py
+
+
+def load_server_module():
+    """Imports clic-server.py, which the hyphen keeps 'import' from finding"""
+    spec = importlib.util.spec_from_file_location("clic_server", os.path.join(ROOT, "clic-server.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def clic_server():
+    return load_server_module()
+
+
+@pytest.fixture(scope="session")
+def certificate(tmp_path_factory):
+    """A throwaway self-signed certificate, as Clicserver loads one as it starts. Returns (certfile, keyfile)."""
+    if shutil.which("openssl") is None:
+        pytest.skip("needs openssl to make a certificate")
+    directory = tmp_path_factory.mktemp("cert")
+    certfile, keyfile = str(directory / "cert.pem"), str(directory / "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+@pytest.fixture
+def make_server(clic_server, certificate, tmp_path):
+    """Builds Clicservers that are never started, for testing the parts they're made of"""
+    def make(**kwargs):
+        kwargs.setdefault("history_dir", None)
+        kwargs.setdefault("offline_db", None)
+        return clic_server.Clicserver(host="127.0.0.1", port=0, certfile=certificate[0], keyfile=certificate[1], **kwargs)
+    return make
@@ -0,0 +1,78 @@
+import zlib
+
+import client
+
+PASTE = "Traceback (most recent call last):\n" + "".join(
+    f'  File "app.py", line {line}, in handler\n    return self.process(request)\n' for line in range(20))
+
+
+class FakeConnection:
+    """Stands in for a client connection, keeping whatever is sent to it"""
+
+    def __init__(self, proto):
+        self.proto = proto
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+def split_v2(server, frame):
+    kind, length = server.V2_HEADER.unpack_from(frame)
+    payload = frame[server.V2_HEADER.size:]
+    assert len(payload) == length
+    return kind, payload
+
+
+def test_large_message_round_trips(make_server):
+    server = make_server()
+    kind, payload = split_v2(server, server.frame_msg(PASTE, server.MSG_CHAT, 3))
+    assert kind == server.MSG_CHAT | server.COMPRESSED
+    assert len(payload) < len(PASTE)
+    assert server.inflate(payload) == PASTE.encode()
+    # client.py has its own copy of the dictionary, and has to be able to read it too
+    inflated = zlib.decompressobj(-15, zdict=client.COMPRESS_DICT).decompress(payload)
+    assert inflated == PASTE.encode()
+
+
+def test_small_messages_and_older_versions_go_uncompressed(make_server):
+    server = make_server()
+    kind, payload = split_v2(server, server.frame_msg("hello", server.MSG_CHAT, 3))
+    assert kind == server.MSG_CHAT and payload == b"hello"
+    kind, payload = split_v2(server, server.frame_msg(PASTE, server.MSG_CHAT, 2))
+    assert kind == server.MSG_CHAT and payload == PASTE.encode()
+    assert server.stats.counters["compressed"] == 0
+
+
+def test_client_compresses_the_same_way(make_server):
+    server = make_server()
+    sender = client.ClicClient("127.0.0.1", 0, None, reconnect=False)
+    sender.proto = 3
+    kind, payload = split_v2(server, sender.frame(PASTE))
+    assert kind == server.MSG_CHAT | server.COMPRESSED
+    assert server.inflate(payload) == PASTE.encode()
+
+
+def test_broadcast_is_compressed_once(make_server):
+    server = make_server()
+    listeners = [FakeConnection(3) for _ in range(3)]
+    for number, conn in enumerate(listeners):
+        server.user_list.register(conn, f"user{number}", ("127.0.0.1", number))
+        server.channels.join(conn, server.LOBBY)
+    server.disseminate(None, f"[someone]: {PASTE}", server.MSG_CHAT, server.LOBBY)
+    assert server.stats.counters["compressed"] == 1
+    assert len({conn.sent[0] for conn in listeners}) == 1 # The very same frame for everyone
+
+
+def test_restart_reloads_compressed_history(make_server, tmp_path):
+    history = str(tmp_path / "history")
+    server = make_server(history_dir=history)
+    server.history.log.start()
+    server.history.record(f"[someone]: {PASTE}", server.MSG_CHAT, server.LOBBY, persist=True)
+    server.history.log.stop()
+    restarted = make_server(history_dir=history) # Used to fail before the stats existed
+    frames = restarted.history.recent(restarted.LOBBY, 3)
+    assert len(frames) == 1
+    kind, payload = split_v2(restarted, frames[0])
+    assert kind & restarted.COMPRESSED
+    assert restarted.inflate(payload) == f"[someone]: {PASTE}".encode()
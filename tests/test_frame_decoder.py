@@ -0,0 +1,117 @@
+import pytest
+
+
+class FakeSocket:
+    """Hands recv_into() the given chunks of bytes, one per call, then nothing as if the peer hung up"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buffer):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        assert len(chunk) <= len(buffer)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def v1(server, text):
+    payload = text.encode(server.FORMAT)
+    return str(len(payload)).encode(server.FORMAT).ljust(server.HEADER) + payload
+
+
+def v2(server, text, kind=None):
+    payload = text.encode(server.FORMAT)
+    return server.V2_HEADER.pack(server.MSG_CHAT if kind is None else kind, len(payload)) + payload
+
+
+def feed(decoder, data):
+    """Copies bytes in the way asyncio does, and returns every (type, text) now complete"""
+    while data:
+        buffer = decoder.get_buffer()
+        count = min(len(buffer), len(data))
+        buffer[:count] = data[:count]
+        decoder.buffer_updated(count)
+        data = data[count:]
+    return [(kind, bytes(payload).decode()) for kind, payload in decoder.frames()]
+
+
+@pytest.fixture
+def decoder(make_server, clic_server):
+    return clic_server.FrameDecoder(make_server())
+
+
+def test_v1_messages_split_and_merged(decoder):
+    server = decoder.server
+    stream = v1(server, "hello") + v1(server, "there") + v1(server, "again")
+    assert feed(decoder, stream[:10]) == [] # Not even a whole header
+    assert feed(decoder, stream[10:80]) == [(None, "hello")]
+    assert feed(decoder, stream[80:]) == [(None, "there"), (None, "again")]
+    assert decoder.frames_in == 3 and decoder.bytes_in == len(stream)
+
+
+def test_v2_messages_byte_at_a_time(decoder):
+    server = decoder.server
+    decoder.proto = 2
+    stream = v2(server, "one") + v2(server, "", server.MSG_KEEPALIVE) + v2(server, "two")
+    found = []
+    for offset in range(len(stream)):
+        found += feed(decoder, stream[offset:offset + 1])
+    assert found == [(server.MSG_CHAT, "one"), (server.MSG_KEEPALIVE, ""), (server.MSG_CHAT, "two")]
+
+
+def test_switching_framing_mid_buffer(decoder):
+    server = decoder.server
+    data = v1(server, "first") + v2(server, "second")
+    buffer = decoder.get_buffer()
+    buffer[:len(data)] = data
+    decoder.buffer_updated(len(data))
+    frames = decoder.frames()
+    assert bytes(next(frames)[1]) == b"first"
+    decoder.proto = 2 # What negotiate() does on HELLO, before the next frame is read
+    kind, payload = next(frames)
+    assert (kind, bytes(payload)) == (server.MSG_CHAT, b"second")
+
+
+def test_large_message_grows_the_buffer_then_shrinks_it(decoder):
+    server = decoder.server
+    decoder.proto = 2
+    text = "x" * (server.RECV_BUFFER * 5)
+    stream = v2(server, text)
+    assert feed(decoder, stream[:server.RECV_BUFFER]) == []
+    assert feed(decoder, stream[server.RECV_BUFFER:]) == [(server.MSG_CHAT, text)]
+    assert len(decoder.buffer) > server.RECV_BUFFER
+    decoder.get_buffer() # Everything's been handed out, so the extra space goes
+    assert len(decoder.buffer) == server.RECV_BUFFER
+
+
+def test_partial_frame_moves_to_the_front(decoder):
+    server = decoder.server
+    decoder.proto = 2
+    filler = "f" * (server.RECV_BUFFER - server.V2_HEADER.size * 2 - 600)
+    stream = v2(server, filler) + v2(server, "y" * 1000)
+    assert feed(decoder, stream[:server.RECV_BUFFER - 100]) == [(server.MSG_CHAT, filler)]
+    assert feed(decoder, stream[server.RECV_BUFFER - 100:]) == [(server.MSG_CHAT, "y" * 1000)]
+    assert len(decoder.buffer) == server.RECV_BUFFER # Made room without growing
+
+
+def test_recv_into_reads_the_socket(decoder):
+    server = decoder.server
+    stream = v1(server, "over") + v1(server, "tcp")
+    sock = FakeSocket([stream[:70], stream[70:]])
+    assert decoder.recv_into(sock) == 70
+    assert [bytes(payload) for kind, payload in decoder.frames()] == [b"over"]
+    assert decoder.recv_into(sock) == len(stream) - 70
+    assert [bytes(payload) for kind, payload in decoder.frames()] == [b"tcp"]
+    assert decoder.recv_into(sock) == 0
+
+
+@pytest.mark.parametrize("proto, header", [(1, b"nonsense".ljust(64)), (1, b"-5".ljust(64)), (2, None)])
+def test_bad_headers_raise(decoder, clic_server, proto, header):
+    server = decoder.server
+    decoder.proto = proto
+    if header is None: # Longer than MAX_MESSAGE
+        header = server.V2_HEADER.pack(server.MSG_CHAT, server.MAX_MESSAGE + 1)
+    with pytest.raises(clic_server.FrameError):
+        feed(decoder, header)
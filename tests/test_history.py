@@ -0,0 +1,64 @@
+import os
+from time import time
+
+
+def split_v2(server, frame):
+    kind, length = server.V2_HEADER.unpack_from(frame)
+    return kind, frame[server.V2_HEADER.size:].decode(server.FORMAT)
+
+
+def write_history(server, messages):
+    """Writes (channel, message) pairs through the history, and waits for them to reach the disk"""
+    server.history.log.start()
+    for channel, message in messages:
+        server.history.record(message, server.MSG_CHAT, channel, persist=True)
+    server.history.log.stop()
+
+
+def test_restart_reloads_only_what_the_rings_hold(make_server, tmp_path, clic_server, monkeypatch):
+    history = str(tmp_path / "history")
+    server = make_server(history_dir=history)
+    write_history(server, [(server.LOBBY, f"lobby {number}") for number in range(250)] + [("dev", "dev 0")])
+    framed = []
+    frames = clic_server.MessageHistory.frames
+    monkeypatch.setattr(clic_server.MessageHistory, "frames", lambda self, kind, payload: framed.append(payload) or frames(self, kind, payload))
+    restarted = make_server(history_dir=history)
+    lobby = [split_v2(restarted, frame)[1] for frame in restarted.history.recent(restarted.LOBBY, 2)]
+    assert lobby == [f"lobby {number}" for number in range(150, 250)]
+    assert [split_v2(restarted, frame)[1] for frame in restarted.history.recent("dev", 2)] == ["dev 0"]
+    assert len(framed) == restarted.HISTORY_FRAMES + 1 # Nothing that fell out of a ring was framed
+
+
+def test_old_records_are_not_reloaded(make_server, tmp_path):
+    history = str(tmp_path / "history")
+    server = make_server(history_dir=history)
+    server.history.log.start()
+    server.history.log.append(time() - server.HISTORY_AGE - 60, server.LOBBY, server.MSG_CHAT, b"stale")
+    server.history.log.append(time(), server.LOBBY, server.MSG_CHAT, b"fresh")
+    server.history.log.stop()
+    restarted = make_server(history_dir=history)
+    assert [split_v2(restarted, frame)[1] for frame in restarted.history.recent(restarted.LOBBY, 2)] == ["fresh"]
+
+
+def test_latest_reads_across_segments(make_server, tmp_path):
+    server = make_server(history_dir=str(tmp_path / "history"))
+    server.HISTORY_SEGMENT_BYTES = 200 # A new segment every few records
+    write_history(server, [(channel, f"{channel} {number}") for number in range(30) for channel in ("a", "b")])
+    assert len(server.history.log.segments()) > 5
+    assert [message for when, kind, message in server.history.log.latest("a", 4)] == [f"a {number}".encode() for number in range(26, 30)]
+    assert [split_v2(server, frame)[1] for frame in server.history.search("b", 2, 2)] == ["b 28", "b 29"]
+    assert server.history.log.latest("nobody", 4) == []
+
+
+def test_startup_evicts_each_owner_against_its_own_budget(make_server, tmp_path, clic_server):
+    history = tmp_path / "history"
+    history.mkdir()
+    for number in range(4):
+        for owner in ("worker0", "worker1"):
+            (history / f"{number:016d}-{owner}.seg").write_bytes(b"\0" * 1000)
+    server = make_server()
+    server.HISTORY_DIR = str(history)
+    server.HISTORY_LOG_BYTES = 2500
+    log = clic_server.HistoryLog(server)
+    for owner in ("worker0", "worker1"): # The two newest of each, not the two newest overall
+        assert [os.path.basename(path) for path in log.segments(owner)] == [f"{number:016d}-{owner}.seg" for number in (2, 3)]
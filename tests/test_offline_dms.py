@@ -0,0 +1,81 @@
+import sqlite3
+
+import pytest
+
+
+class FakeConnection:
+    """Stands in for a client connection, keeping whatever is sent to it"""
+
+    def __init__(self, proto=2):
+        self.proto = proto
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+@pytest.fixture
+def offline(make_server, tmp_path):
+    """The offline DM store of a server, with its database open, driven straight from the test rather than its thread"""
+    server = make_server(offline_db=str(tmp_path / "offline.db"))
+    store = server.offline
+    store.db = sqlite3.connect(store.path)
+    for statement in store.SCHEMA:
+        store.db.execute(statement)
+    yield store
+    store.db.close()
+
+
+def messages(server, conn):
+    """Splits everything sent to a connection in to its messages"""
+    data, found = b"".join(conn.sent), []
+    while data:
+        kind, length = server.V2_HEADER.unpack_from(data)
+        end = server.V2_HEADER.size + length
+        found.append(data[server.V2_HEADER.size:end].decode(server.FORMAT))
+        data = data[end:]
+    return found
+
+
+def arrive(store, username, now):
+    conn = FakeConnection()
+    store.server.user_list.register(conn, username, ("127.0.0.1", 1))
+    store.do_arrived(conn, username, now)
+    return conn
+
+
+def test_waiting_dms_are_delivered_on_arrival(offline):
+    server = offline.server
+    conn = arrive(offline, "Bob", 1000.0)
+    server.user_list.unregister(conn)
+    offline.do_store("alice", "bob", "first", 1001.0)
+    offline.do_store("alice", "bob", "second", 1002.0)
+    conn = arrive(offline, "bob", 1003.0)
+    found = messages(server, conn)
+    assert found[0] == "\n[*DM*] 2 direct messages came while you were away:"
+    assert found[1].startswith("[*DM*] [alice]") and found[1].endswith(": first")
+    assert found[2].endswith(": second")
+    assert offline.db.execute("SELECT COUNT(*) FROM dms").fetchone() == (0,)
+
+
+def test_one_dm_is_singular(offline):
+    server = offline.server
+    server.user_list.unregister(arrive(offline, "bob", 1000.0))
+    offline.do_store("alice", "bob", "hello", 1001.0)
+    assert messages(server, arrive(offline, "bob", 1002.0))[0] == "\n[*DM*] 1 direct message came while you were away:"
+
+
+def test_unknown_users_cant_be_sent_dms(offline):
+    offline.do_store("alice", "nobody", "hello", 1000.0)
+    assert offline.db.execute("SELECT COUNT(*) FROM dms").fetchone() == (0,)
+
+
+def test_expiry_forgets_old_dms_and_users(offline):
+    server = offline.server
+    server.user_list.unregister(arrive(offline, "gone", 1000.0))
+    server.user_list.unregister(arrive(offline, "stayed", 1000.0))
+    offline.do_left("stayed", 1000.0 + server.OFFLINE_DM_AGE) # Was online all along
+    offline.do_store("alice", "gone", "hello", 1001.0)
+    offline.expire(1002.0 + server.OFFLINE_DM_AGE)
+    assert offline.db.execute("SELECT key FROM users").fetchall() == [("stayed",)]
+    assert offline.db.execute("SELECT COUNT(*) FROM dms").fetchone() == (0,)
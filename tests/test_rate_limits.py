@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def limited(make_server, monkeypatch):
+    """A server limited to 5 messages a second, with 3 strikes, that notes who it disconnects instead of doing it"""
+    server = make_server(msg_rate=5, rate_disconnect=3)
+    server.dropped = []
+    monkeypatch.setattr(server, "disconnect_user", server.dropped.append)
+    return server
+
+
+class FakeConnection:
+    """Just the parts of a connection that throttle() and check_heartbeat() look at"""
+
+    def __init__(self, server, now):
+        self.limits = server.rate_limits.buckets()
+        for bucket in self.limits:
+            if bucket:
+                bucket.updated = now
+        self.user_limits = None
+        self.decoder = SimpleNamespace(bytes_in=0)
+        self.bytes_charged = 0
+        self.throttled = self.strikes = 0
+        self.last_strike = self.paused_until = 0.0
+        self.over_limits = False
+        self.proto = 3
+        self.pinged = None
+        self.last_heard = self.last_active = now
+
+    def abort(self):
+        pass
+
+
+def test_bucket_runs_up_a_debt_and_pays_it_off(clic_server):
+    bucket = clic_server.TokenBucket(rate=10, burst=20)
+    bucket.updated = 100.0
+    assert bucket.take(20, 100.0) == 0
+    assert bucket.take(5, 100.0) == pytest.approx(0.5) # 5 tokens in debt at 10 a second
+    assert bucket.take(0, 100.5) == 0
+    assert bucket.refilled(100.5) == pytest.approx(2.0)
+    bucket.take(0, 200.0)
+    assert bucket.tokens == 20 # Never fills past the burst
+
+
+def test_limiter_builds_only_the_buckets_asked_for(clic_server):
+    assert not clic_server.RateLimiter(None, None, 3)
+    assert clic_server.RateLimiter(None, None, 3).buckets() is None
+    messages, size = clic_server.RateLimiter(5, None, 3).buckets()
+    assert messages.burst == 15 and size is None
+
+
+def test_username_buckets_outlive_the_connection_while_in_debt(clic_server):
+    limiter = clic_server.RateLimiter(5, None, 3)
+    messages, _ = limiter.user_buckets("Flood")
+    messages.take(30, messages.updated)
+    limiter.release("Flood")
+    assert limiter.user_buckets("flood")[0] is messages # Coming back doesn't buy a fresh burst
+    limiter.release("flood")
+    messages.tokens = messages.burst
+    limiter.expiring = [(0.0, "flood")]
+    limiter.expire(messages.updated)
+    assert "flood" not in limiter.users
+
+
+def test_one_flood_is_one_strike(limited):
+    now = limited.rate_limits.buckets()[0].updated
+    conn = FakeConnection(limited, now)
+    pauses = [limited.throttle(conn) for _ in range(40)]
+    assert pauses[:15] == [0] * 15 # The burst
+    assert all(pause > 0 for pause in pauses[15:])
+    assert conn.strikes == 1 and conn.throttled == 25
+    assert conn.paused_until > now
+    assert limited.dropped == []
+
+
+def test_repeated_floods_disconnect(limited):
+    now = limited.rate_limits.buckets()[0].updated
+    conn = FakeConnection(limited, now)
+    for flood in range(3):
+        for bucket in conn.limits:
+            if bucket:
+                bucket.tokens = bucket.burst # Waited long enough for the bucket to refill
+        while limited.throttle(conn) == 0:
+            pass
+    assert conn.strikes == 3
+    assert limited.dropped == [conn]
+
+
+def test_keepalive_deadline_waits_out_a_read_pause(make_server, monkeypatch):
+    server = make_server(heartbeat=2, msg_rate=5)
+    scheduled = []
+    monkeypatch.setattr(server.heartbeats, "schedule", lambda conn, due, now=None: scheduled.append(due))
+    monkeypatch.setattr(server, "disconnect_user", lambda conn: scheduled.append("dropped"))
+    conn = FakeConnection(server, 100.0)
+    server.user_list.register(conn, "paused", ("127.0.0.1", 1))
+    conn.pinged = 110.0
+    conn.paused_until = 115.0 # Reading stopped for the rate limits, so the answer hasn't been read
+    server.check_heartbeat(conn, 110.0 + server.HEARTBEAT_TIMEOUT)
+    assert scheduled == [pytest.approx(5.0)] # The full timeout again, counted from when reading resumes
+    server.check_heartbeat(conn, 115.0 + server.HEARTBEAT_TIMEOUT)
+    assert scheduled[-1] == "dropped"
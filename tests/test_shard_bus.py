@@ -0,0 +1,52 @@
+import threading
+import time
+
+
+class FakeHub:
+    """Stands in for the pipe to the hub, answering claims the way ShardBus.run() hands them over"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.bus = None
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+        if isinstance(msg, tuple) and msg[0] == "claim": # The first message is just the worker id
+            answered = self.bus.claims.pop(msg[1]) # run() takes the claim as the answer comes in...
+            threading.Thread(target=self.answer, args=(answered,)).start()
+
+    def answer(self, answered):
+        time.sleep(self.delay) # ...and is slow handing it over
+        answered(True)
+
+
+def make_bus(clic_server, server, delay):
+    hub = FakeHub(delay)
+    hub.bus = clic_server.ShardBus(server, hub)
+    return hub.bus, hub
+
+
+def test_claim_answered_in_time(make_server, clic_server):
+    server = make_server()
+    bus, hub = make_bus(clic_server, server, 0)
+    assert bus.claim("someone") is True
+    assert [msg[0] for msg in hub.sent[1:]] == ["claim"]
+
+
+def test_claim_answered_while_giving_up(make_server, clic_server):
+    server = make_server()
+    server.BUS_TIMEOUT = 0.05
+    bus, hub = make_bus(clic_server, server, 0.2)
+    assert bus.claim("someone") is True # Waits for the answer that was on its way, rather than failing
+    assert [msg[0] for msg in hub.sent[1:]] == ["claim"] # Nor tells the hub to release a name it was given
+
+
+def test_claim_never_answered(make_server, clic_server):
+    server = make_server()
+    server.BUS_TIMEOUT = 0.05
+    bus, hub = make_bus(clic_server, server, 0)
+    hub.send = hub.sent.append # The hub never answers
+    assert bus.claim("someone") is False
+    assert hub.sent[-1] == ("release", "someone")
+    assert bus.claims == {}
@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+
+@pytest.fixture
+def wheel(clic_server):
+    wheel = clic_server.TimerWheel()
+    wheel.origin = 0.0 # Tick n is then n seconds in
+    return wheel
+
+
+def fired_at(wheel, last_tick):
+    """Turns the wheel a tick at a time. Returns key -> the tick its timer went off on."""
+    fired = {}
+    for tick in range(1, last_tick + 1):
+        for key in wheel.advance(tick):
+            assert key not in fired
+            fired[key] = tick
+    return fired
+
+
+def test_timers_go_off_on_time_on_every_level(wheel):
+    slots = wheel.SLOTS
+    delays = {f"timer {number}": random.Random(number).uniform(0, slots ** 2 * 3) for number in range(500)}
+    delays.update({"now": 0, "last slot": slots - 1.5, "first wrap": slots - 1, "level 2": slots ** 2 + 0.5})
+    for key, delay in delays.items():
+        wheel.schedule(key, delay, now=0.0)
+    assert len(wheel) == len(delays)
+    fired = fired_at(wheel, slots ** 2 * 3 + 2)
+    assert fired == {key: int(delay) + 1 for key, delay in delays.items()} # Never early, at most a tick late
+    assert len(wheel) == 0
+
+
+def test_rescheduling_and_cancelling(wheel):
+    wheel.schedule("moved", 5, now=0.0)
+    wheel.schedule("moved", 100, now=0.0)
+    wheel.schedule("cancelled", 3, now=0.0)
+    wheel.cancel("cancelled")
+    wheel.cancel("never set")
+    assert fired_at(wheel, 200) == {"moved": 101}
+
+
+def test_advancing_many_ticks_at_once(wheel):
+    for delay in (3, 70, 5000):
+        wheel.schedule(delay, delay, now=0.0)
+    assert wheel.advance(2.5) == []
+    assert sorted(wheel.advance(100.0)) == [3, 70]
+    assert wheel.advance(6000.0) == [5000]
+
+
+def test_a_timer_in_the_past_goes_off_on_the_next_tick(wheel):
+    wheel.advance(10.0)
+    wheel.schedule("late", -30, now=10.0)
+    assert wheel.advance(10.5) == []
+    assert wheel.advance(11.0) == ["late"]
+
+
+def test_delays_past_the_top_level_are_cut_short(wheel):
+    reach = wheel.SLOTS ** wheel.LEVELS
+    wheel.schedule("far", reach * 2, now=0.0)
+    assert wheel.advance(reach - 2.0) == []
+    assert wheel.advance(float(reach)) == ["far"]